@@ -3,9 +3,12 @@
 #ifndef HELPER_HPP_
 #define HELPER_HPP_
 
+#include <algorithm>
 #include <cmath>
 #include <cstdlib>
 #include <iostream>
+#include <thread>
+#include <vector>
 
 #define SMALL 1.0e-10
 
@@ -107,4 +110,34 @@ inline void coords_to_index(double const * x,
   index[2] = std::min(index[2], size[2] - 1);  // edge case when x[2] = max[2]
 }
 
+
+// number of threads to use for `work` independent items, a non-positive
+// request means using all the available hardware threads
+inline int get_number_of_threads(int const requested, int const work)
+{
+  int n = requested;
+  if (n <= 0) { n = static_cast<int>(std::thread::hardware_concurrency()); }
+  n = std::min(n, work);
+  return std::max(n, 1);
+}
+
+
+// call func(t) for t = 0, ..., numberOfThreads - 1, each in its own thread
+// the calling thread runs t = 0
+template<typename Function>
+inline void parallel_run(int const numberOfThreads, Function const & func)
+{
+  if (numberOfThreads <= 1)
+  {
+    func(0);
+    return;
+  }
+
+  std::vector<std::thread> workers;
+  workers.reserve(numberOfThreads - 1);
+  for (int t = 1; t < numberOfThreads; t++) { workers.emplace_back(func, t); }
+  func(0);
+  for (std::size_t t = 0; t < workers.size(); t++) { workers[t].join(); }
+}
+
 #endif  // HELPER_HPP_
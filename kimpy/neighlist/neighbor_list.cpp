@@ -3,14 +3,824 @@
 #include "neighbor_list.h"
 #include "helper.hpp"
 
+#include <algorithm>
+#include <atomic>
 #include <cmath>
+#include <cstddef>
+#include <cstdlib>
 #include <cstring>
+#include <limits>
+#include <mutex>
 #include <sstream>
 #include <string>
+#include <unordered_map>
+#include <utility>
 #include <vector>
 
+// the tiles of a tiled build can be stored in a memory-mapped file
+#if defined(__unix__) || defined(__APPLE__)
+#define NBL_HAVE_MMAP
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
 #define TOL 1.0e-10
 
+// growth factor of the buffers that need to be enlarged
+#define GROWTH 1.125
+
+// The distance kernel is also compiled for AVX2 and AVX-512, and the version
+// for the CPU is picked when the module is loaded. This relies on indirect
+// functions, which are only resolved by the glibc loader.
+#if defined(__x86_64__) && defined(__GLIBC__)         \
+    && ((defined(__clang__) && __clang_major__ >= 14) \
+        || (!defined(__clang__) && defined(__GNUC__) && __GNUC__ >= 6))
+#define NBL_TARGET_CLONES \
+  __attribute__((target_clones("avx512f", "avx2", "default")))
+#else
+#define NBL_TARGET_CLONES
+#endif
+
+// NBL_ENGINE_AUTO checks all the pairs of at most BRUTE_MAX_SIZE particles,
+// and otherwise uses a sparse cell grid if the dense one would have more than
+// SPARSE_RATIO cells per particle
+#define BRUTE_MAX_SIZE 256
+#define SPARSE_RATIO 8
+
+// a sparse cell grid packs the 3 indices of a cell in 21 bits each
+#define SPARSE_MAX_SIZE 2097152
+
+// a periodic build gathers the images of a small cell per cell of the grid
+// if there are at most 8 per particle plus MAX_PLANNED_IMAGES of them, and
+// then stores the ghost of each possible image directly if there are at
+// most MAX_DIRECT_IMAGES of them over all the chunks
+#define MAX_PLANNED_IMAGES 1048576
+#define MAX_DIRECT_IMAGES 1048576
+
+
+// cells of edge length (at least) binSizeFactor * influenceDistance covering
+// the bounding box of the particles
+//
+// The particles are sorted by cell (counting sort): the particles in cell c
+// are cellParticles[cellBegin[c] : cellBegin[c + 1]], in increasing order, and
+// their coordinates are gathered in the same order in cellCoordinates, so the
+// particles of a cell are contiguous in memory. cellCoordinates holds all the
+// x coordinates, then all the y and all the z coordinates (see x(), y() and
+// z()), such that the distances to a run of particles can be computed in
+// vector registers.
+//
+// A dense grid stores all the cells of the box, and cell (i, j, k) is
+// c = i + j * size[0] + k * size[0] * size[1]. A sparse grid only stores the
+// occupied cells, and occupiedCells maps the packed indices of a cell to c.
+struct CellGrid
+{
+  int size[3];
+  double min[3];
+  double max[3];
+  int sparse;
+  std::unordered_map<long long, int> occupiedCells;
+  std::vector<int> cellBegin;
+  std::vector<int> cellParticles;
+  std::vector<double> cellCoordinates;
+  std::vector<int> cellOfParticle;
+  // With cells smaller than the influence distance, the cells that can hold
+  // particles within influenceDistance of a particle in cell (i, j, k) are
+  // the rows of cells (i + stencil[4*r+2] : i + stencil[4*r+3] + 1,
+  // j + stencil[4*r], k + stencil[4*r+1]). Empty for cells of at least the
+  // influence distance, whose particles look in the 27 cells around.
+  std::vector<int> stencil;
+
+  static long long pack(int const i, int const j, int const k)
+  {
+    return static_cast<long long>(i) | (static_cast<long long>(j) << 21)
+           | (static_cast<long long>(k) << 42);
+  }
+
+  double const * x() const { return cellCoordinates.data(); }
+  double const * y() const { return x() + cellParticles.size(); }
+  double const * z() const { return y() + cellParticles.size(); }
+
+  // the position of cell (i, j, k), or -1 if it is known to be empty
+  int find(int const i, int const j, int const k) const
+  {
+    if (!sparse) { return i + j * size[0] + k * size[0] * size[1]; }
+
+    auto const it = occupiedCells.find(pack(i, j, k));
+    return it == occupiedCells.end() ? -1 : it->second;
+  }
+
+  std::size_t memory() const
+  {
+    std::size_t bytes = (sizeof(long long) + sizeof(int) + 2 * sizeof(void *))
+                        * occupiedCells.size();
+    bytes += sizeof(void *) * occupiedCells.bucket_count();
+    bytes += sizeof(int) * cellBegin.capacity();
+    bytes += sizeof(int) * cellParticles.capacity();
+    bytes += sizeof(double) * cellCoordinates.capacity();
+    bytes += sizeof(int) * cellOfParticle.capacity();
+    bytes += sizeof(int) * stencil.capacity();
+    return bytes;
+  }
+};
+
+
+// the inputs shared by all the particles of a build
+struct BuildContext
+{
+  int numberOfParticles;
+  double const * coordinates;
+  double influenceDistance;
+  int numberOfCutoffs;
+  std::vector<double> cutsqs;
+  // the skin added to the cutoffs and the influence distance
+  double skin;
+  int const * needNeighbors;
+  // if not nullptr, the lists are only built for the particles subset[r],
+  // which all need neighbors (see nbl_build_subset), and only the particles
+  // binnedParticles near them are binned; otherwise, all the particles are
+  // binned
+  int const * subset;
+  std::vector<int> binnedParticles;
+  // the particle of row 0 if subset is nullptr, i.e. the first particle of
+  // the tile of a tiled build, and 0 otherwise
+  int firstParticle;
+  // the squared cutoffs of the particles that do not need neighbors:
+  // cutsqs[k] if list k is built for all the particles (see NeighList::hints),
+  // and -1 otherwise; otherNeedNeighbors is nonzero if there is such a list
+  std::vector<double> otherCutsqs;
+  int otherNeedNeighbors;
+  // the squared cutoffs (plus the skin) of the species pairs, see
+  // NeighList::speciesCutoffs; empty if there are none
+  int numberOfSpecies;
+  int const * speciesCode;
+  std::vector<double> pairCutsqs;
+  // In a half list, a pair of particles is stored only once: under the
+  // smaller index if both particles need neighbors, otherwise under the one
+  // that needs neighbors
+  int half;
+  // see NeighList::sharedStorage; the cutoffs in increasing order are
+  // cutoffs[cutoffOrder[0]], cutoffs[cutoffOrder[1]], ...
+  int sharedStorage;
+  std::vector<int> cutoffOrder;
+  // see NeighList::storeDistances
+  int storeDistances;
+  // see NeighList::engine
+  int engine;
+  // see NeighList::binSizeFactor
+  double binSizeFactor;
+  CellGrid grid;
+};
+
+
+// periodic images are labeled by the shift (in units of the cell vectors)
+// that is applied to their master particle
+struct ImageShifts
+{
+  int range[3];
+
+  int number() const
+  { return (2 * range[0] + 1) * (2 * range[1] + 1) * (2 * range[2] + 1); }
+
+  int id(int const * s) const
+  {
+    return ((s[0] + range[0]) * (2 * range[1] + 1) + (s[1] + range[1]))
+               * (2 * range[2] + 1)
+           + (s[2] + range[2]);
+  }
+
+  void shift(int id, int * const s) const
+  {
+    s[2] = id % (2 * range[2] + 1) - range[2];
+    id /= 2 * range[2] + 1;
+    s[1] = id % (2 * range[1] + 1) - range[1];
+    s[0] = id / (2 * range[1] + 1) - range[0];
+  }
+};
+
+
+// the additional inputs of a periodic build
+struct PeriodicContext
+{
+  double const * cell;
+  int const * PBC;
+  std::vector<double> fracCoordinates;
+  double fracMin[3];
+  double fracMax[3];
+  // the influence distance in units of the distance between cell faces
+  double ratio[3];
+  ImageShifts shifts;
+  // the shift of each shift id, and its translation, i.e. the shift times
+  // the cell vectors
+  std::vector<int> shiftOfId;
+  std::vector<double> shiftVectors;
+  // With more than the 27 nearest images, i.e. a cell smaller than the
+  // influence distance, the images that can be neighbors of the particles
+  // of a cell of the grid are gathered once for the cell (see
+  // nbl_plan_cell_images): those of cell c are the particles
+  // images.cellParticles[m] shifted by imageShift[m], at images.x()[m],
+  // images.y()[m] and images.z()[m], for m in
+  // [images.cellBegin[c], images.cellBegin[c + 1]). Empty otherwise.
+  CellGrid images;
+  std::vector<int> imageShift;
+  // the (shift, cell) pairs of the images of each cell, used to plan them
+  std::vector<int> visitBegin;
+  std::vector<std::pair<int, int> > visits;
+  // the number of possible images (shifts times particles) if the ghost of
+  // each is stored directly in the GhostTables, and 0 otherwise
+  std::size_t numberOfDirectImages;
+};
+
+
+// The ghosts numbered in the order their images (shift_id *
+// numberOfParticles + master) are first found, with an open addressing hash
+// table from image to ghost. Unlike std::unordered_map, it does not allocate
+// a node per image, and clearing it keeps its memory for the next build.
+// With few possible images, the ghost of each is stored directly instead.
+struct GhostTable
+{
+  // the image of each ghost
+  std::vector<long long> images;
+  // the image (-1 for an empty slot) and ghost of each slot
+  std::vector<long long> slotImages;
+  std::vector<int> slotGhosts;
+  // if not empty, the ghost of each possible image (-1 if none), used
+  // instead of the slots
+  std::vector<int> ghostOfImage;
+
+  // forget the ghosts; the ghosts of numberOfImages (if positive) possible
+  // images are stored directly
+  void clear(std::size_t const numberOfImages = 0)
+  {
+    images.clear();
+    ghostOfImage.assign(numberOfImages, -1);
+    if (numberOfImages > 0) { return; }
+    if (slotImages.empty())
+    {
+      slotImages.resize(64);
+      slotGhosts.resize(64);
+    }
+    std::fill(slotImages.begin(), slotImages.end(), -1);
+  }
+
+  std::size_t slot_of(long long const image) const
+  {
+    // Fibonacci hashing, the number of slots is a power of 2
+    unsigned long long const h
+        = static_cast<unsigned long long>(image) * 0x9E3779B97F4A7C15ULL;
+    return static_cast<std::size_t>(h >> 32) & (slotImages.size() - 1);
+  }
+
+  // the ghost of image, which is appended if it is a new one
+  int find_or_insert(long long const image)
+  {
+    if (!ghostOfImage.empty())
+    {
+      int & ghost = ghostOfImage[static_cast<std::size_t>(image)];
+      if (ghost < 0)
+      {
+        ghost = static_cast<int>(images.size());
+        images.push_back(image);
+      }
+      return ghost;
+    }
+
+    std::size_t const mask = slotImages.size() - 1;
+    std::size_t slot = slot_of(image);
+    while (slotImages[slot] != image)
+    {
+      if (slotImages[slot] < 0)
+      {
+        int const ghost = static_cast<int>(images.size());
+        images.push_back(image);
+        slotImages[slot] = image;
+        slotGhosts[slot] = ghost;
+        if (2 * images.size() > slotImages.size()) { grow(); }
+        return ghost;
+      }
+      slot = (slot + 1) & mask;
+    }
+    return slotGhosts[slot];
+  }
+
+  // double the number of slots, keeping at most half of them used
+  void grow()
+  {
+    slotImages.assign(2 * slotImages.size(), -1);
+    slotGhosts.resize(slotImages.size());
+    std::size_t const mask = slotImages.size() - 1;
+    for (std::size_t g = 0; g < images.size(); g++)
+    {
+      std::size_t slot = slot_of(images[g]);
+      while (slotImages[slot] >= 0) { slot = (slot + 1) & mask; }
+      slotImages[slot] = images[g];
+      slotGhosts[slot] = static_cast<int>(g);
+    }
+  }
+
+  std::size_t memory() const
+  {
+    return sizeof(long long) * (images.capacity() + slotImages.capacity())
+           + sizeof(int) * (slotGhosts.capacity() + ghostOfImage.capacity());
+  }
+};
+
+
+// Particles are split into contiguous chunks, each with its own temporary
+// neigh container. Using more chunks than threads balances the load when the
+// particles that need neighbors are not evenly distributed (e.g. contributing
+// particles followed by paddings).
+template<typename T>
+struct ChunkedNeighbors
+{
+  int numberOfParticles = 0;
+  int numberOfThreads = 1;
+  int numberOfChunks = 0;
+  // neigh[c][k] is the neighbors of chunk c for cutoff k
+  std::vector<std::vector<std::vector<T> > > neigh;
+  // pairs[c][k] is dx, dy, dz, r of each neighbor in neigh[c][k], if the
+  // pair data is stored
+  std::vector<std::vector<std::vector<double> > > pairs;
+  // offset[c][k] is the position of neigh[c][k] in the merged list
+  std::vector<std::vector<long long> > offset;
+  std::vector<long long> total;
+
+  // empty the containers, but keep their memory for reuse
+  void
+  reset(int const nparticles, int const nthreads, int const numberOfCutoffs)
+  {
+    numberOfParticles = nparticles;
+    numberOfThreads = get_number_of_threads(nthreads, nparticles);
+    numberOfChunks
+        = numberOfThreads == 1 ? 1 : std::min(nparticles, 8 * numberOfThreads);
+
+    if (static_cast<int>(neigh.size()) < numberOfChunks)
+    {
+      neigh.resize(numberOfChunks);
+      pairs.resize(numberOfChunks);
+      offset.resize(numberOfChunks);
+    }
+    for (int c = 0; c < numberOfChunks; c++)
+    {
+      neigh[c].resize(numberOfCutoffs);
+      pairs[c].resize(numberOfCutoffs);
+      for (int k = 0; k < numberOfCutoffs; k++)
+      {
+        neigh[c][k].clear();
+        pairs[c][k].clear();
+      }
+      offset[c].resize(numberOfCutoffs);
+    }
+    total.assign(numberOfCutoffs, 0);
+  }
+
+  std::size_t memory() const
+  {
+    std::size_t bytes = 0;
+    for (std::size_t c = 0; c < neigh.size(); c++)
+    {
+      for (std::size_t k = 0; k < neigh[c].size(); k++)
+      {
+        bytes += sizeof(T) * neigh[c][k].capacity();
+        bytes += sizeof(double) * pairs[c][k].capacity();
+      }
+      bytes += sizeof(long long) * offset[c].capacity();
+    }
+    return bytes;
+  }
+
+  int begin(int const c) const
+  {
+    return static_cast<int>(static_cast<long long>(numberOfParticles) * c
+                            / numberOfChunks);
+  }
+
+  // let the threads call func(c) for all the chunks
+  template<typename Function>
+  void run(Function const & func) const
+  {
+    std::atomic<int> next_chunk(0);
+    parallel_run(numberOfThreads, [&](int const) {
+      for (int c = next_chunk++; c < numberOfChunks; c = next_chunk++)
+      {
+        func(c);
+      }
+    });
+  }
+
+  void compute_offsets()
+  {
+    for (int c = 0; c < numberOfChunks; c++)
+    {
+      for (std::size_t k = 0; k < total.size(); k++)
+      {
+        offset[c][k] = total[k];
+        total[k] += static_cast<long long>(neigh[c][k].size());
+      }
+    }
+  }
+
+  // shift beginIndex of the particles from chunk-relative to absolute
+  void shift_begin_index(NeighList * const nl) const
+  {
+    run([&](int const c) {
+      for (int k = 0; k < nl->numberOfNeighborLists; k++)
+      {
+        // with shared storage, there is a single neigh container per chunk
+        long long const shift = offset[c][total.size() == 1 ? 0 : k];
+        long long * const beginIndex = nl->lists[k].beginIndex;
+        for (int i = begin(c); i < begin(c + 1); i++)
+        {
+          beginIndex[i] += shift;
+        }
+      }
+    });
+  }
+};
+
+// Collects the neighbors of one particle at a time into the neigh (and pairs)
+// containers of a chunk, which have one vector per cutoff, or a single vector
+// shared by all the cutoffs if ctx.sharedStorage
+template<typename T>
+struct NeighborCollector
+{
+  BuildContext const & ctx;
+  std::vector<std::vector<T> > & neigh;
+  std::vector<std::vector<double> > & pairs;
+  // neighbors of the current particle (and their pair data), binned by the
+  // smallest cutoff that contains them (shared storage only)
+  std::vector<std::vector<T> > shells;
+  std::vector<std::vector<double> > shellPairs;
+  std::vector<int> numberOfNeighbors;
+  // the squared cutoffs of the current particle, and the largest of them
+  double const * cutsqs;
+  double maxCutsq;
+
+  NeighborCollector(BuildContext const & context,
+                    std::vector<std::vector<T> > & neighbors,
+                    std::vector<std::vector<double> > & pairData) :
+      ctx(context),
+      neigh(neighbors),
+      pairs(pairData),
+      shells(context.sharedStorage ? context.numberOfCutoffs : 0),
+      shellPairs(context.sharedStorage ? context.numberOfCutoffs : 0),
+      numberOfNeighbors(context.numberOfCutoffs, 0),
+      cutsqs(context.cutsqs.data()),
+      maxCutsq(-1.0)
+  {
+  }
+
+  // start collecting the neighbors of a particle
+  void start(int const needNeighbors)
+  {
+    cutsqs = needNeighbors ? ctx.cutsqs.data() : ctx.otherCutsqs.data();
+    maxCutsq = -1.0;
+    for (int k = 0; k < ctx.numberOfCutoffs; k++)
+    {
+      maxCutsq = std::max(maxCutsq, cutsqs[k]);
+    }
+  }
+
+  // neighbor n is at displacement (dx, dy, dz) from the particle
+  void add(T const n,
+           double const dx,
+           double const dy,
+           double const dz,
+           double const rsq)
+  {
+    int const numberOfCutoffs = ctx.numberOfCutoffs;
+
+    if (ctx.sharedStorage)
+    {
+      for (int r = 0; r < numberOfCutoffs; r++)
+      {
+        if (rsq < cutsqs[ctx.cutoffOrder[r]])
+        {
+          shells[r].push_back(n);
+          if (ctx.storeDistances)
+          {
+            append_pair(shellPairs[r], dx, dy, dz, rsq);
+          }
+          return;
+        }
+      }
+    }
+    else
+    {
+      for (int k = 0; k < numberOfCutoffs; k++)
+      {
+        if (rsq < cutsqs[k])
+        {
+          neigh[k].push_back(n);
+          if (ctx.storeDistances) { append_pair(pairs[k], dx, dy, dz, rsq); }
+          numberOfNeighbors[k]++;
+        }
+      }
+    }
+  }
+
+  static void append_pair(std::vector<double> & data,
+                          double const dx,
+                          double const dy,
+                          double const dz,
+                          double const rsq)
+  {
+    data.push_back(dx);
+    data.push_back(dy);
+    data.push_back(dz);
+    data.push_back(std::sqrt(rsq));
+  }
+
+  // store the neighbors of particle i; its beginIndex is set relative to the
+  // start of `neigh`
+  void finish(NeighList * const nl, int const i)
+  {
+    int const numberOfCutoffs = ctx.numberOfCutoffs;
+
+    if (ctx.sharedStorage)
+    {
+      std::vector<T> & storage = neigh[0];
+      long long const begin = static_cast<long long>(storage.size());
+      for (int r = 0; r < numberOfCutoffs; r++)
+      {
+        storage.insert(storage.end(), shells[r].begin(), shells[r].end());
+        shells[r].clear();
+        pairs[0].insert(
+            pairs[0].end(), shellPairs[r].begin(), shellPairs[r].end());
+        shellPairs[r].clear();
+        numberOfNeighbors[ctx.cutoffOrder[r]]
+            = static_cast<int>(static_cast<long long>(storage.size()) - begin);
+      }
+      for (int k = 0; k < numberOfCutoffs; k++)
+      {
+        // the lists not built for the particle are empty
+        nl->lists[k].Nneighbors[i] = cutsqs[k] < 0.0 ? 0 : numberOfNeighbors[k];
+        nl->lists[k].beginIndex[i] = begin;
+        numberOfNeighbors[k] = 0;
+      }
+    }
+    else
+    {
+      for (int k = 0; k < numberOfCutoffs; k++)
+      {
+        nl->lists[k].Nneighbors[i] = numberOfNeighbors[k];
+        nl->lists[k].beginIndex[i]
+            = static_cast<long long>(neigh[k].size()) - numberOfNeighbors[k];
+        numberOfNeighbors[k] = 0;
+      }
+    }
+  }
+};
+
+
+// memory kept by a NeighList between builds to avoid reallocating the
+// temporary containers
+struct NeighListWorkspace
+{
+  BuildContext ctx;
+  PeriodicContext pctx;
+  ChunkedNeighbors<int> chunks;
+  // the ghosts of each chunk of a periodic build, and their number among
+  // all the ghosts
+  std::vector<GhostTable> chunkGhosts;
+  std::vector<std::vector<int> > ghostOfChunkGhost;
+  GhostTable ghostTable;
+  PaddingPlan paddingPlan;
+
+  std::size_t memory() const
+  {
+    std::size_t bytes = sizeof(NeighListWorkspace);
+    bytes += sizeof(double) * ctx.cutsqs.capacity();
+    bytes += ctx.grid.memory();
+    bytes += sizeof(int) * ctx.binnedParticles.capacity();
+    bytes += sizeof(double) * pctx.fracCoordinates.capacity();
+    bytes += sizeof(int) * pctx.shiftOfId.capacity();
+    bytes += sizeof(double) * pctx.shiftVectors.capacity();
+    bytes += pctx.images.memory();
+    bytes += sizeof(int) * pctx.imageShift.capacity();
+    bytes += sizeof(int) * pctx.visitBegin.capacity();
+    bytes += sizeof(std::pair<int, int>) * pctx.visits.capacity();
+    bytes += chunks.memory();
+    for (std::size_t c = 0; c < chunkGhosts.size(); c++)
+    {
+      bytes += chunkGhosts[c].memory();
+      bytes += sizeof(int) * ghostOfChunkGhost[c].capacity();
+    }
+    bytes += ghostTable.memory();
+    bytes += sizeof(double) * paddingPlan.fracCoordinates.capacity();
+    bytes += sizeof(int) * paddingPlan.shifts.capacity();
+    bytes += sizeof(int) * paddingPlan.shiftClass.capacity();
+    for (std::size_t c = 0; c < paddingPlan.particlesOfClass.size(); c++)
+    {
+      bytes += sizeof(int) * paddingPlan.particlesOfClass[c].capacity();
+    }
+    bytes += sizeof(std::size_t) * paddingPlan.offsets.capacity();
+    return bytes;
+  }
+};
+
+
+// The lists of the tiles of a tiled build (see NeighList::tileSize). The
+// particles are only sorted by cell in `index`, which has the cells of a
+// full build, and the lists of a tile are built from ws.ctx.grid, which only
+// holds the cells around the tile (see nbl_bin_tile). The lists of a tile
+// are built by the first nbl_get_tile for it, and copied into a buffer of
+// their own, which is kept until the object is destroyed, so the neighbors
+// returned for a tile stay valid while the other tiles are built. The
+// buffers are mapped from a temporary file if NeighList::tileDirectory is
+// set, such that the operating system can page them out.
+struct NeighListTiles
+{
+  NeighListWorkspace ws;
+  CellGrid index;
+  std::vector<int> speciesCode;
+  int numberOfTiles = 0;
+
+  // serializes the builds of the tiles by concurrent nbl_get_tile calls
+  std::mutex mutex;
+  // built[t] is set once lists[t], the lists of tile t (one per cutoff),
+  // point into their buffer
+  std::unique_ptr<std::atomic<int>[]> built;
+  std::vector<std::vector<NeighListOne> > lists;
+  std::vector<char *> buffers;
+  std::vector<std::size_t> bufferSizes;
+  // bytes of the buffers allocated in memory
+  std::size_t heapBytes = 0;
+  // the temporary file of the buffers, or -1 if they are in memory
+  int file = -1;
+  std::size_t fileSize = 0;
+
+  ~NeighListTiles() { clear(); }
+
+  // forget the tiles, but keep ws and index for reuse
+  void clear()
+  {
+    for (std::size_t b = 0; b < buffers.size(); b++)
+    {
+#ifdef NBL_HAVE_MMAP
+      if (file >= 0)
+      {
+        munmap(buffers[b], bufferSizes[b]);
+        continue;
+      }
+#endif
+      delete[] buffers[b];
+    }
+    buffers.clear();
+    bufferSizes.clear();
+    heapBytes = 0;
+#ifdef NBL_HAVE_MMAP
+    if (file >= 0) { close(file); }
+#endif
+    file = -1;
+    fileSize = 0;
+    lists.clear();
+    built.reset();
+    numberOfTiles = 0;
+  }
+
+  // set up `number` tiles, whose buffers are in a temporary file in
+  // `directory`, or in memory if it is empty
+  int reset(int const number, std::string const & directory)
+  {
+    clear();
+    numberOfTiles = number;
+    lists.resize(number);
+    built.reset(new std::atomic<int>[number]);
+    for (int t = 0; t < number; t++) { built[t] = 0; }
+
+    if (directory.empty()) { return 0; }
+#ifdef NBL_HAVE_MMAP
+    std::string name = directory + "/kimpy-tiles-XXXXXX";
+    file = mkstemp(&name[0]);
+    if (file < 0)
+    {
+      MY_WARNING("Cannot create a file for the tiles in " + directory);
+      return 1;
+    }
+    // the file is only reachable through its descriptor
+    unlink(name.c_str());
+    return 0;
+#else
+    MY_WARNING("The tiles cannot be stored in a file on this platform.");
+    return 1;
+#endif
+  }
+
+  // a new buffer of `bytes` bytes, or nullptr if it cannot be allocated
+  char * allocate(std::size_t const bytes)
+  {
+    char * buffer = nullptr;
+    std::size_t size = std::max(bytes, static_cast<std::size_t>(1));
+#ifdef NBL_HAVE_MMAP
+    if (file >= 0)
+    {
+      std::size_t const page = static_cast<std::size_t>(sysconf(_SC_PAGESIZE));
+      size = (size + page - 1) / page * page;
+      if (ftruncate(file, static_cast<off_t>(fileSize + size)))
+      {
+        return nullptr;
+      }
+      void * const map = mmap(nullptr,
+                              size,
+                              PROT_READ | PROT_WRITE,
+                              MAP_SHARED,
+                              file,
+                              static_cast<off_t>(fileSize));
+      if (map == MAP_FAILED) { return nullptr; }
+      buffer = static_cast<char *>(map);
+      fileSize += size;
+    }
+#endif
+    if (!buffer)
+    {
+      buffer = new char[size];
+      heapBytes += size;
+    }
+    buffers.push_back(buffer);
+    bufferSizes.push_back(size);
+    return buffer;
+  }
+
+  std::size_t memory() const
+  {
+    std::size_t bytes = sizeof(NeighListTiles) + ws.memory() + index.memory();
+    bytes += sizeof(int) * speciesCode.capacity();
+    bytes += (sizeof(std::atomic<int>) + sizeof(std::vector<NeighListOne>)
+              + sizeof(char *) + sizeof(std::size_t))
+             * numberOfTiles;
+    for (std::size_t t = 0; t < lists.size(); t++)
+    {
+      bytes += sizeof(NeighListOne) * lists[t].capacity();
+    }
+    return bytes + heapBytes;
+  }
+};
+
+
+// Set up by the first nbl_move_particle after a build. The particles are
+// binned into cells of edge cellSize (the largest cutoff), found by their
+// packed cell indices, which can change with each move. The neighbors of
+// particle i in list k have room for capacity[k][i] entries from its
+// beginIndex, so a move rarely has to relocate a list.
+struct NeighListMoves
+{
+  int active = 0;
+  double cellSize = 1.0;
+  std::unordered_map<long long, std::vector<int> > cells;
+  std::vector<std::vector<int> > capacity;
+
+  // a list changed by the last move, as it was before
+  struct SavedList
+  {
+    int list;
+    int particle;
+    long long beginIndex;
+    int numberOfNeighbors;
+    int capacity;
+    // its neighbors are savedNeighbors[offset : offset + numberOfNeighbors]
+    std::size_t offset;
+  };
+
+  // the last move, undone by nbl_undo_move
+  int lastParticle = -1;
+  double lastPosition[3];
+  std::vector<SavedList> savedLists;
+  std::vector<int> savedNeighbors;
+  std::vector<long long> savedListSize;
+
+  // the particles near the new position, and their squared distances
+  std::vector<int> candidates;
+  std::vector<double> candidateRsqs;
+
+  std::size_t memory() const
+  {
+    std::size_t bytes = sizeof(NeighListMoves);
+    for (auto const & c : cells)
+    {
+      bytes += sizeof(long long) + 3 * sizeof(void *)
+               + sizeof(int) * c.second.capacity();
+    }
+    bytes += sizeof(void *) * cells.bucket_count();
+    for (std::size_t k = 0; k < capacity.size(); k++)
+    {
+      bytes += sizeof(int) * capacity[k].capacity();
+    }
+    bytes += sizeof(SavedList) * savedLists.capacity();
+    bytes += sizeof(int) * savedNeighbors.capacity();
+    bytes += sizeof(long long) * savedListSize.capacity();
+    bytes += sizeof(int) * candidates.capacity();
+    bytes += sizeof(double) * candidateRsqs.capacity();
+    return bytes;
+  }
+};
+
+
+static NeighListWorkspace * nbl_get_workspace(NeighList * const nl)
+{
+  if (!nl->workspace) { nl->workspace = new NeighListWorkspace; }
+  return nl->workspace;
+}
+
 
 void nbl_clean_content(NeighList * const nl)
 {
@@ -21,396 +831,3711 @@ void nbl_clean_content(NeighList * const nl)
       for (int i = 0; i < nl->numberOfNeighborLists; i++)
       {
         NeighListOne * cnl = &(nl->lists[i]);
-        if (cnl->Nneighbors) delete[] cnl->Nneighbors;
-        if (cnl->neighborList) delete[] cnl->neighborList;
-        if (cnl->beginIndex) delete[] cnl->beginIndex;
+        cnl->NneighborsOwner.reset();
+        cnl->neighborListOwner.reset();
+        cnl->beginIndexOwner.reset();
+        cnl->neighborDisplacementsOwner.reset();
+        cnl->neighborDistancesOwner.reset();
         cnl->numberOfParticles = 0;
         cnl->cutoff = 0.0;
         cnl->Nneighbors = nullptr;
         cnl->neighborList = nullptr;
         cnl->beginIndex = nullptr;
+        cnl->neighborListSize = 0;
+        cnl->particleCapacity = 0;
+        cnl->neighborListCapacity = 0;
+        cnl->sharesNeighborList = 0;
+        cnl->neighborDisplacements = nullptr;
+        cnl->neighborDistances = nullptr;
+        cnl->pairDataCapacity = 0;
       }
       delete[] nl->lists;
     }
     nl->lists = nullptr;
     nl->numberOfNeighborLists = 0;
+
+    nl->numberOfGhosts = 0;
+    nl->ghostMaster.clear();
+    nl->ghostShift.clear();
+    nl->ghostCoordinates.clear();
+
+    nl->hasSubset = 0;
+    nl->numberOfAllParticles = 0;
+    nl->subset.clear();
+
+    nl->numberOfTiles = 0;
+    nl->builtTileSize = 0;
+    nl->currentTile = -1;
+    nl->tiles.reset();
+    nl->tileInputs.reset();
+
+    nl->cutoffs.clear();
+    nl->needNeighbors.clear();
+    nl->referenceCoordinates.clear();
+    nl->builtSkin = 0.0;
+
+    if (nl->moves) { nl->moves->active = 0; }
   }
 }
 
 
-void nbl_allocate_memory(NeighList * const nl,
-                         int const numberOfCutoffs,
-                         int const numberOfParticles)
+// empty the neighbor lists, but keep their memory for reuse
+static void nbl_reset_lists(NeighList * const nl)
 {
-  if (nl)
+  for (int i = 0; i < nl->numberOfNeighborLists; i++)
+  {
+    NeighListOne * cnl = &(nl->lists[i]);
+    cnl->numberOfParticles = 0;
+    cnl->cutoff = 0.0;
+    cnl->neighborListSize = 0;
+    if (cnl->sharesNeighborList)
+    {
+      cnl->neighborList = nullptr;
+      cnl->neighborDisplacements = nullptr;
+      cnl->neighborDistances = nullptr;
+      cnl->sharesNeighborList = 0;
+    }
+  }
+}
+
+
+// empty the neighbor lists and the inputs of the last build, but keep their
+// memory for reuse
+static void nbl_reset_content(NeighList * const nl)
+{
+  nbl_reset_lists(nl);
+
+  nl->numberOfGhosts = 0;
+  nl->ghostMaster.clear();
+  nl->ghostShift.clear();
+  nl->ghostCoordinates.clear();
+
+  nl->hasSubset = 0;
+  nl->numberOfAllParticles = 0;
+  nl->subset.clear();
+
+  nl->numberOfTiles = 0;
+  nl->builtTileSize = 0;
+  nl->currentTile = -1;
+  nl->tiles.reset();
+  nl->tileInputs.reset();
+
+  nl->cutoffs.clear();
+  nl->needNeighbors.clear();
+  nl->referenceCoordinates.clear();
+  nl->builtSkin = 0.0;
+
+  if (nl->moves) { nl->moves->active = 0; }
+}
+
+
+// a new array of `size` elements, owned by `owner`
+template<typename T>
+static T * nbl_new_array(std::shared_ptr<T> & owner, std::size_t const size)
+{
+  owner.reset(new T[size], std::default_delete<T[]>());
+  return owner.get();
+}
+
+
+// grow `array` (if needed) to hold `size` elements, keeping the first `keep`;
+// Size is int for the arrays of the particles, and long long for the arrays
+// of the neighbors
+template<typename T, typename Size>
+static void nbl_reserve(T *& array,
+                        std::shared_ptr<T> & owner,
+                        Size & capacity,
+                        Size const size,
+                        Size const keep,
+                        double const growth)
+{
+  if (size <= capacity) { return; }
+
+  double const largest = static_cast<double>(std::numeric_limits<Size>::max());
+  Size const new_capacity
+      = std::max(size, static_cast<Size>(std::min(growth * size, largest)));
+  std::shared_ptr<T> new_owner;
+  T * const new_array = nbl_new_array(new_owner, new_capacity);
+  if (array) { std::memcpy(new_array, array, sizeof(T) * keep); }
+  owner = new_owner;
+  array = new_array;
+  capacity = new_capacity;
+}
+
+
+// make room for the neighbors of `numberOfParticles` particles, keeping the
+// current content of the first `keep` particles
+static void nbl_reserve_particles(NeighListOne * const cnl,
+                                  int const numberOfParticles,
+                                  int const keep)
+{
+  if (numberOfParticles <= cnl->particleCapacity) { return; }
+
+  // the number of particles rarely changes, so no extra room is reserved
+  int capacity = cnl->particleCapacity;
+  nbl_reserve(cnl->Nneighbors,
+              cnl->NneighborsOwner,
+              capacity,
+              numberOfParticles,
+              keep,
+              1.0);
+  capacity = cnl->particleCapacity;
+  nbl_reserve(cnl->beginIndex,
+              cnl->beginIndexOwner,
+              capacity,
+              numberOfParticles,
+              keep,
+              1.0);
+  cnl->particleCapacity = capacity;
+}
+
+
+static void nbl_reserve_neighbors(NeighListOne * const cnl,
+                                  long long const size,
+                                  int const storeDistances)
+{
+  nbl_reserve(cnl->neighborList,
+              cnl->neighborListOwner,
+              cnl->neighborListCapacity,
+              size,
+              0LL,
+              GROWTH);
+  cnl->neighborListSize = size;
+
+  if (storeDistances && size > cnl->pairDataCapacity)
+  {
+    long long const capacity
+        = std::max(size, static_cast<long long>(GROWTH * size));
+    cnl->neighborDisplacements
+        = nbl_new_array(cnl->neighborDisplacementsOwner, 3 * capacity);
+    cnl->neighborDistances
+        = nbl_new_array(cnl->neighborDistancesOwner, capacity);
+    cnl->pairDataCapacity = capacity;
+  }
+}
+
+
+// the list whose neighborList stores the neighbors of cutoff k
+static NeighListOne *
+nbl_storage_of(NeighList * const nl, BuildContext const & ctx, int const k)
+{
+  if (ctx.sharedStorage) { return &(nl->lists[ctx.cutoffOrder.back()]); }
+  return &(nl->lists[k]);
+}
+
+
+// copy the pair data of a chunk (dx, dy, dz, r of each neighbor) to position
+// `offset` of the displacements and distances of a list
+static void nbl_copy_pair_data(NeighListOne * const cnl,
+                               std::vector<double> const & src,
+                               long long const offset)
+{
+  double * const displacements = cnl->neighborDisplacements + 3 * offset;
+  double * const distances = cnl->neighborDistances + offset;
+  for (std::size_t m = 0; 4 * m < src.size(); m++)
+  {
+    displacements[3 * m] = src[4 * m];
+    displacements[3 * m + 1] = src[4 * m + 1];
+    displacements[3 * m + 2] = src[4 * m + 2];
+    distances[m] = src[4 * m + 3];
+  }
+}
+
+
+// the largest number of neighbors a neighborList of nl can hold
+static long long nbl_max_list_size(NeighList const * const nl,
+                                   int const storeDistances)
+{
+  // the displacements are the largest array per neighbor, and the capacity
+  // grows by up to GROWTH times the size
+  double const bytes
+      = GROWTH * (storeDistances ? 3 * sizeof(double) : sizeof(int));
+  long long const largest = static_cast<long long>(
+      static_cast<double>(std::numeric_limits<std::ptrdiff_t>::max()) / bytes);
+  if (nl->maxListSize > 0) { return std::min(nl->maxListSize, largest); }
+  return largest;
+}
+
+
+// make room for `total[s]` neighbors in storage s, which is the neighborList
+// of list s, or, with shared storage, the one neighborList of all the lists;
+// returns 1 if they do not fit
+static int nbl_reserve_storage(NeighList * const nl,
+                               BuildContext const & ctx,
+                               std::vector<long long> const & total)
+{
+  long long const largest = nbl_max_list_size(nl, ctx.storeDistances);
+  for (std::size_t s = 0; s < total.size(); s++)
+  {
+    if (total[s] > largest)
+    {
+      MY_WARNING("The neighbor list needs "
+                 << total[s] << " entries, more than the " << largest
+                 << " it can hold.");
+      return 1;
+    }
+  }
+
+  if (!ctx.sharedStorage)
+  {
+    for (int k = 0; k < ctx.numberOfCutoffs; k++)
+    {
+      nbl_reserve_neighbors(&(nl->lists[k]), total[k], ctx.storeDistances);
+    }
+    return 0;
+  }
+
+  NeighListOne * const owner = nbl_storage_of(nl, ctx, 0);
+  nbl_reserve_neighbors(owner, total[0], ctx.storeDistances);
+  for (int k = 0; k < ctx.numberOfCutoffs; k++)
+  {
+    NeighListOne * const cnl = &(nl->lists[k]);
+    if (cnl == owner) { continue; }
+
+    cnl->neighborListOwner.reset();
+    cnl->neighborDisplacementsOwner.reset();
+    cnl->neighborDistancesOwner.reset();
+    cnl->neighborListCapacity = 0;
+    cnl->pairDataCapacity = 0;
+    cnl->neighborList = owner->neighborList;
+    cnl->neighborDisplacements = owner->neighborDisplacements;
+    cnl->neighborDistances = owner->neighborDistances;
+    cnl->neighborListSize = owner->neighborListSize;
+    cnl->sharesNeighborList = 1;
+  }
+  return 0;
+}
+
+
+// leave `array` to its other owners, if any: with `keep`, it is replaced by a
+// copy, and otherwise by nothing, so it is reallocated by the next reserve
+template<typename T, typename Size>
+static void nbl_detach_array(T *& array,
+                             std::shared_ptr<T> & owner,
+                             Size & capacity,
+                             int const keep)
+{
+  if (owner.use_count() <= 1) { return; }
+
+  if (keep)
+  {
+    std::shared_ptr<T> copy;
+    std::memcpy(nbl_new_array(copy, capacity), array, sizeof(T) * capacity);
+    owner = copy;
+    array = copy.get();
+  }
+  else
+  {
+    owner.reset();
+    array = nullptr;
+    capacity = 0;
+  }
+}
+
+
+// leave the arrays of the lists that are still viewed by the Python binding
+// (see NeighListOne) to the views, before the lists are changed; `keep` is
+// nonzero if the changes start from the current content, as for a move
+static void nbl_detach_views(NeighList * const nl, int const keep)
+{
+  for (int k = 0; k < nl->numberOfNeighborLists; k++)
+  {
+    NeighListOne * const cnl = &(nl->lists[k]);
+
+    int Nneighbors = cnl->particleCapacity;
+    int beginIndex = cnl->particleCapacity;
+    nbl_detach_array(cnl->Nneighbors, cnl->NneighborsOwner, Nneighbors, keep);
+    nbl_detach_array(cnl->beginIndex, cnl->beginIndexOwner, beginIndex, keep);
+    cnl->particleCapacity = std::min(Nneighbors, beginIndex);
+
+    nbl_detach_array(cnl->neighborList,
+                     cnl->neighborListOwner,
+                     cnl->neighborListCapacity,
+                     keep);
+
+    long long displacements = 3 * cnl->pairDataCapacity;
+    long long distances = cnl->pairDataCapacity;
+    nbl_detach_array(cnl->neighborDisplacements,
+                     cnl->neighborDisplacementsOwner,
+                     displacements,
+                     keep);
+    nbl_detach_array(
+        cnl->neighborDistances, cnl->neighborDistancesOwner, distances, keep);
+    cnl->pairDataCapacity = std::min(displacements / 3, distances);
+  }
+}
+
+
+void nbl_allocate_memory(NeighList * const nl,
+                         int const numberOfCutoffs,
+                         int const numberOfParticles)
+{
+  if (nl)
+  {
+    // the lists of a previous build are reused if the number of them is the
+    // same; their arrays are only reallocated if they are too small
+    if (nl->numberOfNeighborLists != numberOfCutoffs)
+    {
+      nbl_clean_content(nl);
+      nl->lists = new NeighListOne[numberOfCutoffs];
+      nl->numberOfNeighborLists = numberOfCutoffs;
+    }
+    else
+    {
+      nbl_reset_content(nl);
+      nbl_detach_views(nl, 0);
+    }
+
+    for (int i = 0; i < numberOfCutoffs; i++)
+    {
+      nbl_reserve_particles(&(nl->lists[i]), numberOfParticles, 0);
+    }
+  }
+}
+
+
+void nbl_initialize(NeighList ** const nl) { *nl = new NeighList; }
+
+
+void nbl_clean(NeighList ** const nl)
+{
+  if (*nl)
+  {
+    nbl_clean_content(*nl);
+
+    delete (*nl)->workspace;
+    delete (*nl)->moves;
+
+    delete (*nl);
+  }
+
+  // nullify pointer
+  (*nl) = nullptr;
+}
+
+
+template<typename T, typename Size>
+static void nbl_shrink_array(T *& array,
+                             std::shared_ptr<T> & owner,
+                             Size & capacity,
+                             Size const size)
+{
+  if (capacity == size) { return; }
+
+  std::shared_ptr<T> new_owner;
+  if (size > 0)
+  {
+    std::memcpy(nbl_new_array(new_owner, size), array, sizeof(T) * size);
+  }
+  owner = new_owner;
+  array = new_owner.get();
+  capacity = size;
+}
+
+
+void nbl_shrink(NeighList * const nl)
+{
+  for (int i = 0; i < nl->numberOfNeighborLists; i++)
+  {
+    NeighListOne * cnl = &(nl->lists[i]);
+
+    int capacity = cnl->particleCapacity;
+    nbl_shrink_array(cnl->Nneighbors,
+                     cnl->NneighborsOwner,
+                     capacity,
+                     cnl->numberOfParticles);
+    capacity = cnl->particleCapacity;
+    nbl_shrink_array(cnl->beginIndex,
+                     cnl->beginIndexOwner,
+                     capacity,
+                     cnl->numberOfParticles);
+    cnl->particleCapacity = capacity;
+
+    if (!cnl->sharesNeighborList)
+    {
+      nbl_shrink_array(cnl->neighborList,
+                       cnl->neighborListOwner,
+                       cnl->neighborListCapacity,
+                       cnl->neighborListSize);
+
+      long long const pairs = nl->storeDistances ? cnl->neighborListSize : 0;
+      long long pair_capacity = 3 * cnl->pairDataCapacity;
+      nbl_shrink_array(cnl->neighborDisplacements,
+                       cnl->neighborDisplacementsOwner,
+                       pair_capacity,
+                       3 * pairs);
+      nbl_shrink_array(cnl->neighborDistances,
+                       cnl->neighborDistancesOwner,
+                       cnl->pairDataCapacity,
+                       pairs);
+    }
+  }
+
+  // the lists sharing a neighborList follow its owner, which may have moved
+  for (int i = 0; i < nl->numberOfNeighborLists; i++)
+  {
+    NeighListOne * cnl = &(nl->lists[i]);
+    if (!cnl->sharesNeighborList) { continue; }
+    for (int j = 0; j < nl->numberOfNeighborLists; j++)
+    {
+      NeighListOne const * owner = &(nl->lists[j]);
+      if (!owner->sharesNeighborList)
+      {
+        cnl->neighborList = owner->neighborList;
+        cnl->neighborDisplacements = owner->neighborDisplacements;
+        cnl->neighborDistances = owner->neighborDistances;
+      }
+    }
+  }
+
+  nl->ghostMaster.shrink_to_fit();
+  nl->ghostShift.shrink_to_fit();
+  nl->ghostCoordinates.shrink_to_fit();
+
+  delete nl->workspace;
+  nl->workspace = nullptr;
+
+  // the next move sets it up again
+  delete nl->moves;
+  nl->moves = nullptr;
+}
+
+
+void nbl_get_memory_usage(NeighList const * const nl,
+                          std::size_t * const allocated,
+                          std::size_t * const used)
+{
+  std::size_t capacity = 0;
+  std::size_t size = 0;
+
+  for (int i = 0; i < nl->numberOfNeighborLists; i++)
+  {
+    NeighListOne const * cnl = &(nl->lists[i]);
+    capacity += sizeof(NeighListOne);
+    capacity += (sizeof(int) + sizeof(long long)) * cnl->particleCapacity;
+    capacity += sizeof(int) * cnl->neighborListCapacity;
+    capacity += 4 * sizeof(double) * cnl->pairDataCapacity;
+    size += sizeof(NeighListOne);
+    size += (sizeof(int) + sizeof(long long)) * cnl->numberOfParticles;
+    if (!cnl->sharesNeighborList)
+    {
+      size += sizeof(int) * cnl->neighborListSize;
+      if (nl->storeDistances)
+      {
+        size += 4 * sizeof(double) * cnl->neighborListSize;
+      }
+    }
+  }
+
+  capacity += sizeof(int) * nl->ghostMaster.capacity();
+  capacity += sizeof(int) * nl->ghostShift.capacity();
+  capacity += sizeof(double) * nl->ghostCoordinates.capacity();
+  size += sizeof(int) * nl->ghostMaster.size();
+  size += sizeof(int) * nl->ghostShift.size();
+  size += sizeof(double) * nl->ghostCoordinates.size();
+
+  // the inputs kept for nbl_update
+  capacity += sizeof(int) * nl->subset.capacity();
+  capacity += sizeof(double) * nl->cutoffs.capacity();
+  capacity += sizeof(int) * nl->needNeighbors.capacity();
+  capacity += sizeof(double) * nl->referenceCoordinates.capacity();
+  capacity += sizeof(double) * nl->speciesCutoffs.capacity();
+  capacity += sizeof(int) * nl->speciesCode.capacity();
+  size += sizeof(int) * nl->subset.size();
+  size += sizeof(double) * nl->cutoffs.size();
+  size += sizeof(int) * nl->needNeighbors.size();
+  size += sizeof(double) * nl->referenceCoordinates.size();
+  size += sizeof(double) * nl->speciesCutoffs.size();
+  size += sizeof(int) * nl->speciesCode.size();
+
+  if (nl->padded)
+  {
+    PaddedConfiguration const & padded = *nl->padded;
+    capacity += sizeof(double) * padded.coordinates.capacity();
+    capacity += sizeof(int) * padded.speciesCode.capacity();
+    capacity += sizeof(int) * padded.needNeighbors.capacity();
+    capacity += sizeof(int) * padded.masterOfPaddings.capacity();
+    capacity += sizeof(int) * padded.shiftOfPaddings.capacity();
+    size += sizeof(double) * padded.coordinates.size();
+    size += sizeof(int) * padded.speciesCode.size();
+    size += sizeof(int) * padded.needNeighbors.size();
+    size += sizeof(int) * padded.masterOfPaddings.size();
+    size += sizeof(int) * padded.shiftOfPaddings.size();
+  }
+
+  // the lists of the tiles built so far, and what they are built from
+  if (nl->tiles)
+  {
+    capacity += nl->tiles->memory();
+    size += nl->tiles->heapBytes;
+  }
+
+  // the workspace is only used during a build
+  if (nl->workspace) { capacity += nl->workspace->memory(); }
+  if (nl->moves) { capacity += nl->moves->memory(); }
+
+  *allocated = capacity;
+  *used = size;
+}
+
+
+static void nbl_init_context(BuildContext & ctx,
+                             int const numberOfParticles,
+                             double const * coordinates,
+                             double const influenceDistance,
+                             int const numberOfCutoffs,
+                             double const * cutoffs,
+                             double const skin,
+                             int const * needNeighbors)
+{
+  ctx.numberOfParticles = numberOfParticles;
+  ctx.coordinates = coordinates;
+  ctx.influenceDistance = influenceDistance + skin;
+  ctx.skin = skin;
+  ctx.numberOfCutoffs = numberOfCutoffs;
+  ctx.cutsqs.resize(numberOfCutoffs);
+  for (int i = 0; i < numberOfCutoffs; i++)
+  {
+    ctx.cutsqs[i] = (cutoffs[i] + skin) * (cutoffs[i] + skin);
+  }
+  ctx.needNeighbors = needNeighbors;
+  ctx.subset = nullptr;
+  ctx.binnedParticles.clear();
+  ctx.firstParticle = 0;
+  ctx.half = 0;
+  ctx.sharedStorage = 0;
+  ctx.storeDistances = 0;
+  ctx.engine = NBL_ENGINE_AUTO;
+  ctx.binSizeFactor = 1.0;
+
+  ctx.cutoffOrder.resize(numberOfCutoffs);
+  for (int i = 0; i < numberOfCutoffs; i++) { ctx.cutoffOrder[i] = i; }
+  std::stable_sort(
+      ctx.cutoffOrder.begin(),
+      ctx.cutoffOrder.end(),
+      [cutoffs](int const a, int const b) { return cutoffs[a] < cutoffs[b]; });
+}
+
+
+// the cutoffs of the species pairs of nl, if any
+static int nbl_init_species(BuildContext & ctx,
+                            NeighList const * const nl,
+                            double const skin)
+{
+  ctx.pairCutsqs.clear();
+  if (nl->speciesCutoffs.empty()) { return 0; }
+
+  int const numberOfSpecies = nl->numberOfSpecies;
+  if (static_cast<int>(nl->speciesCutoffs.size())
+          != numberOfSpecies * numberOfSpecies
+      || static_cast<int>(nl->speciesCode.size()) < ctx.numberOfParticles)
+  {
+    MY_WARNING("The species cutoffs are not numberOfSpecies x numberOfSpecies, "
+               "or there are fewer species codes than particles.");
+    return 1;
+  }
+  for (int i = 0; i < ctx.numberOfParticles; i++)
+  {
+    if (nl->speciesCode[i] < 0 || nl->speciesCode[i] >= numberOfSpecies)
+    {
+      MY_WARNING("A species code is not in [0, numberOfSpecies).");
+      return 1;
+    }
+  }
+
+  ctx.numberOfSpecies = numberOfSpecies;
+  ctx.speciesCode = nl->speciesCode.data();
+  ctx.pairCutsqs.resize(nl->speciesCutoffs.size());
+  for (std::size_t p = 0; p < ctx.pairCutsqs.size(); p++)
+  {
+    double const cutoff = nl->speciesCutoffs[p] + skin;
+    ctx.pairCutsqs[p] = cutoff * cutoff;
+  }
+  return 0;
+}
+
+
+// the lists of the particles that do not need neighbors, after the lists
+// are set half or not
+static int nbl_init_hints(BuildContext & ctx, std::vector<int> const & hints)
+{
+  int const numberOfCutoffs = ctx.numberOfCutoffs;
+  ctx.otherCutsqs.assign(numberOfCutoffs, -1.0);
+  ctx.otherNeedNeighbors = 0;
+  if (hints.empty() || ctx.half) { return 0; }
+
+  if (static_cast<int>(hints.size()) != numberOfCutoffs)
+  {
+    MY_WARNING("The number of hints is not the number of cutoffs.");
+    return 1;
+  }
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    if (!hints[k])
+    {
+      ctx.otherCutsqs[k] = ctx.cutsqs[k];
+      ctx.otherNeedNeighbors = 1;
+    }
+  }
+  return 0;
+}
+
+
+// the stencil of the grid of ctx, whose size, min and max are set
+static void nbl_make_stencil(BuildContext & ctx)
+{
+  CellGrid & grid = ctx.grid;
+  std::vector<int> & stencil = grid.stencil;
+  stencil.clear();
+  int const * const size = grid.size;
+  // a single cell has no neighbors
+  if (ctx.binSizeFactor >= 1.0
+      || (size[0] == 1 && size[1] == 1 && size[2] == 1))
+  {
+    return;
+  }
+
+  // the offsets from a cell to the cells whose closest points are within the
+  // influence distance, where the gap between two cells along an axis is the
+  // width of the cells in between
+  double const influenceSq = ctx.influenceDistance * ctx.influenceDistance;
+  double width[3];
+  int reach[3];
+  for (int d = 0; d < 3; d++)
+  {
+    width[d] = (grid.max[d] - grid.min[d]) / size[d];
+    reach[d] = static_cast<int>(std::ceil(ctx.influenceDistance / width[d]));
+    reach[d] = std::max(1, std::min(reach[d], size[d] - 1));
+  }
+
+  for (int j = -reach[1]; j <= reach[1]; j++)
+  {
+    double const gy = std::max(0, std::abs(j) - 1) * width[1];
+    for (int k = -reach[2]; k <= reach[2]; k++)
+    {
+      double const gz = std::max(0, std::abs(k) - 1) * width[2];
+      double const gyzsq = gy * gy + gz * gz;
+      if (gyzsq >= influenceSq) { continue; }
+
+      int i = 1;
+      while (i < reach[0] && i * i * width[0] * width[0] + gyzsq < influenceSq)
+      {
+        i++;
+      }
+      stencil.push_back(j);
+      stencil.push_back(k);
+      stencil.push_back(-i);
+      stencil.push_back(i);
+    }
+  }
+}
+
+
+// bin the particles of ctx, or only ctx.binnedParticles if not empty, which
+// are then particle(p) for p in [0, numberOfParticles); without `gather`,
+// the particles are only sorted by cell, and neither their coordinates nor
+// cellOfParticle are kept (see NeighListTiles)
+static int nbl_bin_particles(BuildContext & ctx, int const gather = 1)
+{
+  std::vector<int> const & binned = ctx.binnedParticles;
+  int const numberOfParticles = binned.empty()
+                                    ? ctx.numberOfParticles
+                                    : static_cast<int>(binned.size());
+  auto const particle
+      = [&binned](int const p) { return binned.empty() ? p : binned[p]; };
+  double const * const coordinates = ctx.coordinates;
+  CellGrid & grid = ctx.grid;
+
+  // find max and min extend of coordinates
+  double * const min = grid.min;
+  double * const max = grid.max;
+
+  // init max and min of coordinates to that of the first atom, if any
+  double const origin[3] = {0.0, 0.0, 0.0};
+  double const * const first
+      = numberOfParticles > 0 ? &coordinates[3 * particle(0)] : origin;
+  min[0] = first[0];
+  min[1] = first[1];
+  min[2] = first[2];
+  // +1 to prevent max==min
+  max[0] = first[0] + 1.0;
+  max[1] = first[1] + 1.0;
+  max[2] = first[2] + 1.0;
+
+  for (int p = 0; p < numberOfParticles; p++)
+  {
+    int l = 3 * particle(p);
+    if (max[0] < coordinates[l]) { max[0] = coordinates[l]; }
+    if (min[0] > coordinates[l]) { min[0] = coordinates[l]; }
+    ++l;
+    if (max[1] < coordinates[l]) { max[1] = coordinates[l]; }
+    if (min[1] > coordinates[l]) { min[1] = coordinates[l]; }
+    ++l;
+    if (max[2] < coordinates[l]) { max[2] = coordinates[l]; }
+    if (min[2] > coordinates[l]) { min[2] = coordinates[l]; }
+  }
+
+  // make the cell box; all the pairs of a few particles are checked faster
+  // than the cells are set up, so they are put in a single cell
+  int * const size = grid.size;
+  int const brute = ctx.engine == NBL_ENGINE_BRUTE
+                    || (ctx.engine == NBL_ENGINE_AUTO
+                        && numberOfParticles <= BRUTE_MAX_SIZE);
+  double const binSize
+      = brute ? HUGE_VAL : ctx.binSizeFactor * ctx.influenceDistance;
+  double size_total = 1.0;
+  for (int d = 0; d < 3; d++)
+  {
+    double const n = std::floor((max[d] - min[d]) / binSize);
+    if (n >= SPARSE_MAX_SIZE)
+    {
+      MY_WARNING("Cell size too large. Check if you have partilces fly away.");
+      return 1;
+    }
+    size[d] = n < 1.0 ? 1 : static_cast<int>(n);
+    size_total *= size[d];
+  }
+
+  // most cells of a dilute system (e.g. a gas, or a slab with vacuum) are
+  // empty, so only the occupied ones are stored; the occupancy is that of
+  // cells of the influence distance, whatever the bin size
+  double const binVolume
+      = ctx.binSizeFactor * ctx.binSizeFactor * ctx.binSizeFactor;
+  grid.sparse = ctx.engine == NBL_ENGINE_SPARSE
+                || (ctx.engine == NBL_ENGINE_AUTO && !brute
+                    && size_total * binVolume
+                           > SPARSE_RATIO * (numberOfParticles + 1.0));
+  if (!grid.sparse && size_total > 1000000000)
+  {
+    MY_WARNING("Cell size too large. Check if you have partilces fly away.");
+    return 1;
+  }
+
+  nbl_make_stencil(ctx);
+
+  // assign atoms into cells
+  std::vector<int> & cellBegin = grid.cellBegin;
+  std::vector<int> & cellOfParticle = grid.cellOfParticle;
+  cellOfParticle.resize(gather ? numberOfParticles : 0);
+
+  int numberOfCells;
+  if (grid.sparse)
+  {
+    // number the occupied cells in the order they first appear
+    std::unordered_map<long long, int> & occupied = grid.occupiedCells;
+    occupied.clear();
+    cellBegin.clear();
+    for (int p = 0; p < numberOfParticles; p++)
+    {
+      int index[3];
+
+      coords_to_index(&coordinates[3 * particle(p)], size, max, min, index);
+
+      auto const inserted = occupied.insert(
+          std::make_pair(CellGrid::pack(index[0], index[1], index[2]),
+                         static_cast<int>(cellBegin.size())));
+      if (inserted.second) { cellBegin.push_back(0); }
+
+      if (gather) { cellOfParticle[p] = inserted.first->second; }
+      cellBegin[inserted.first->second]++;
+    }
+    numberOfCells = static_cast<int>(cellBegin.size());
+    cellBegin.push_back(0);
+  }
+  else
+  {
+    numberOfCells = static_cast<int>(size_total);
+    cellBegin.assign(numberOfCells + 1, 0);
+    for (int p = 0; p < numberOfParticles; p++)
+    {
+      int index[3];
+
+      coords_to_index(&coordinates[3 * particle(p)], size, max, min, index);
+
+      int const idx = grid.find(index[0], index[1], index[2]);
+
+      if (gather) { cellOfParticle[p] = idx; }
+      cellBegin[idx]++;
+    }
+  }
+
+  // after the prefix sum, cellBegin[c] is the end of cell c; filling the
+  // cells backwards moves it to the beginning, and keeps the particles of a
+  // cell in increasing order
+  for (int c = 1; c <= numberOfCells; c++) { cellBegin[c] += cellBegin[c - 1]; }
+
+  grid.cellParticles.resize(numberOfParticles);
+  if (!gather)
+  {
+    grid.cellCoordinates.clear();
+    for (int p = numberOfParticles - 1; p >= 0; p--)
+    {
+      int index[3];
+      coords_to_index(&coordinates[3 * particle(p)], size, max, min, index);
+      int const m = --cellBegin[grid.find(index[0], index[1], index[2])];
+      grid.cellParticles[m] = particle(p);
+    }
+    return 0;
+  }
+
+  grid.cellCoordinates.resize(3 * numberOfParticles);
+  double * const x = grid.cellCoordinates.data();
+  double * const y = x + numberOfParticles;
+  double * const z = y + numberOfParticles;
+  for (int p = numberOfParticles - 1; p >= 0; p--)
+  {
+    int const m = --cellBegin[cellOfParticle[p]];
+    int const i = particle(p);
+    grid.cellParticles[m] = i;
+    x[m] = coordinates[3 * i];
+    y[m] = coordinates[3 * i + 1];
+    z[m] = coordinates[3 * i + 2];
+  }
+
+  return 0;
+}
+
+
+// Select the particles [begin, end) of a grid whose squared distance to the
+// point q is below cutsq: their positions in the grid are written to
+// `selected`, and their squared distances to `rsqs`, which have room for
+// end - begin entries. Returns the number of selected particles.
+//
+// The distances are computed in one pass over the coordinates, which the
+// compiler vectorizes, and the particles are selected without branches.
+NBL_TARGET_CLONES
+static int nbl_select_within(CellGrid const & grid,
+                             int const begin,
+                             int const end,
+                             double const * q,
+                             double const cutsq,
+                             double * const rsqs,
+                             int * const selected)
+{
+  double const * const x = grid.x() + begin;
+  double const * const y = grid.y() + begin;
+  double const * const z = grid.z() + begin;
+  double const qx = q[0];
+  double const qy = q[1];
+  double const qz = q[2];
+  int const n = end - begin;
+
+  for (int m = 0; m < n; m++)
+  {
+    double const dx = x[m] - qx;
+    double const dy = y[m] - qy;
+    double const dz = z[m] - qz;
+    rsqs[m] = dx * dx + dy * dy + dz * dz;
+  }
+
+  int count = 0;
+  for (int m = 0; m < n; m++)
+  {
+    double const rsq = rsqs[m];
+    selected[count] = begin + m;
+    rsqs[count] = rsq;
+    count += rsq < cutsq;
+  }
+  return count;
+}
+
+
+// the squared cutoffs of the species pairs of particle i, indexed by the
+// species of the other particle, or nullptr if there are none
+static inline double const * nbl_pair_cutsqs(BuildContext const & ctx,
+                                             int const i)
+{
+  if (ctx.pairCutsqs.empty()) { return nullptr; }
+  return ctx.pairCutsqs.data() + ctx.numberOfSpecies * ctx.speciesCode[i];
+}
+
+
+static void nbl_report_collision(int const i, int const n, double const rsq)
+{
+  std::ostringstream stringStream;
+  stringStream << "Collision of atoms " << i + 1 << " and " << n + 1 << ". ";
+  stringStream << "Their distance is " << std::sqrt(rsq) << "." << std::endl;
+  std::string my_str = stringStream.str();
+  MY_WARNING(my_str);
+}
+
+
+// find the neighbors of the particles of rows [begin, end), i.e. particles
+// [begin, end) or subset[begin : end], and append them to `neigh` (and the
+// pair data to `pairs`, see NeighborCollector)
+// the beginIndex of each row is set relative to the start of `neigh`
+static int nbl_build_range(NeighList * const nl,
+                           BuildContext const & ctx,
+                           int const begin,
+                           int const end,
+                           std::vector<std::vector<int> > & neigh,
+                           std::vector<std::vector<double> > & pairs)
+{
+  double const * const coordinates = ctx.coordinates;
+  int const * const needNeighbors = ctx.needNeighbors;
+  CellGrid const & grid = ctx.grid;
+  int const * const size = grid.size;
+  int const * const cellBegin = grid.cellBegin.data();
+  int const * const cellParticles = grid.cellParticles.data();
+  double const * const x = grid.x();
+  double const * const y = grid.y();
+  double const * const z = grid.z();
+  std::vector<int> const & stencil = grid.stencil;
+
+  NeighborCollector<int> collector(ctx, neigh, pairs);
+  // the candidates of nbl_select_within
+  std::vector<double> rsqs;
+  std::vector<int> selected;
+
+  for (int row = begin; row < end; row++)
+  {
+    int const i = ctx.subset ? ctx.subset[row] : ctx.firstParticle + row;
+    int const need = ctx.subset ? 1 : needNeighbors[i];
+    if (need || ctx.otherNeedNeighbors)
+    {
+      collector.start(need);
+      // collisions are found among the candidates within the cutoffs
+      double const cutsq = std::max(collector.maxCutsq, TOL);
+      double const * const pairCutsqs = nbl_pair_cutsqs(ctx, i);
+
+      double const * const coordinates_i = &coordinates[3 * i];
+
+      int index[3];
+      coords_to_index(coordinates_i, size, grid.max, grid.min, index);
+
+      // add the neighbors among the particles [mBegin, mEnd) of the cells
+      auto const visit = [&](int const mBegin, int const mEnd) {
+        if (static_cast<int>(rsqs.size()) < mEnd - mBegin)
+        {
+          rsqs.resize(mEnd - mBegin);
+          selected.resize(mEnd - mBegin);
+        }
+        int const count = nbl_select_within(grid,
+                                            mBegin,
+                                            mEnd,
+                                            coordinates_i,
+                                            cutsq,
+                                            rsqs.data(),
+                                            selected.data());
+
+        for (int c = 0; c < count; c++)
+        {
+          int const m = selected[c];
+          int const n = cellParticles[m];
+          if (ctx.half && n < i && needNeighbors[n]) { continue; }
+          if (n != i)
+          {
+            double const rsq = rsqs[c];
+            if (rsq < TOL)
+            {
+              nbl_report_collision(i, n, rsq);
+              return 1;
+            }
+            if (pairCutsqs && rsq >= pairCutsqs[ctx.speciesCode[n]])
+            {
+              continue;
+            }
+            collector.add(n,
+                          x[m] - coordinates_i[0],
+                          y[m] - coordinates_i[1],
+                          z[m] - coordinates_i[2],
+                          rsq);
+          }
+        }
+        return 0;
+      };
+
+      if (stencil.empty())
+      {
+        // loop over neighborling cells and the cell atom i resides
+        for (int ii = std::max(0, index[0] - 1);
+             ii <= std::min(index[0] + 1, size[0] - 1);
+             ii++)
+        {
+          for (int jj = std::max(0, index[1] - 1);
+               jj <= std::min(index[1] + 1, size[1] - 1);
+               jj++)
+          {
+            for (int kk = std::max(0, index[2] - 1);
+                 kk <= std::min(index[2] + 1, size[2] - 1);
+                 kk++)
+            {
+              int const idx = grid.find(ii, jj, kk);
+              if (idx < 0) { continue; }
+              if (visit(cellBegin[idx], cellBegin[idx + 1])) { return 1; }
+            }
+          }
+        }
+      }
+
+      // loop over the rows of cells of the stencil; the cells of a row of a
+      // dense grid are consecutive, so their particles are contiguous
+      for (std::size_t r = 0; r < stencil.size(); r += 4)
+      {
+        int const jj = index[1] + stencil[r];
+        int const kk = index[2] + stencil[r + 1];
+        if (jj < 0 || jj >= size[1] || kk < 0 || kk >= size[2]) { continue; }
+        int const lo = std::max(0, index[0] + stencil[r + 2]);
+        int const hi = std::min(index[0] + stencil[r + 3], size[0] - 1);
+
+        if (grid.sparse)
+        {
+          for (int ii = lo; ii <= hi; ii++)
+          {
+            int const idx = grid.find(ii, jj, kk);
+            if (idx < 0) { continue; }
+            if (visit(cellBegin[idx], cellBegin[idx + 1])) { return 1; }
+          }
+        }
+        else
+        {
+          int const idx = grid.find(lo, jj, kk);
+          if (visit(cellBegin[idx], cellBegin[idx + hi - lo + 1])) { return 1; }
+        }
+      }
+    }
+
+    collector.finish(nl, row);
+  }
+
+  return 0;
+}
+
+
+// distance from x to cell c (of width `width`, starting at `min`) along an axis
+static inline double nbl_gap_to_cell(double const x,
+                                     double const min,
+                                     double const width,
+                                     int const c)
+{
+  double const lo = min + c * width;
+  if (x < lo) { return lo - x; }
+  double const hi = lo + width;
+  return x > hi ? x - hi : 0.0;
+}
+
+
+// Gather the images of a periodic build per cell of the grid, see
+// PeriodicContext::images. The shifts of a cell are those needed by any of
+// its particles, and the cells of a shift are those whose gap to the cell
+// is below the influence distance, in the order nbl_build_periodic_range
+// visits them for a single particle. Nothing is gathered if there are more
+// than maxImages images.
+static void nbl_plan_cell_images(BuildContext const & ctx,
+                                 PeriodicContext & pctx,
+                                 long long const maxImages)
+{
+  CellGrid const & grid = ctx.grid;
+  int const * const size = grid.size;
+  double const influenceSq = ctx.influenceDistance * ctx.influenceDistance;
+  int const numberOfCells = static_cast<int>(grid.cellBegin.size()) - 1;
+
+  double width[3];
+  for (int d = 0; d < 3; d++)
+  {
+    width[d] = (grid.max[d] - grid.min[d]) / size[d];
+  }
+
+  pctx.images.cellBegin.clear();
+  pctx.visitBegin.assign(numberOfCells + 1, 0);
+  pctx.visits.clear();
+  long long numberOfImages = 0;
+  for (int c = 0; c < numberOfCells; c++)
+  {
+    pctx.visitBegin[c] = static_cast<int>(pctx.visits.size());
+    int const mBegin = grid.cellBegin[c];
+    int const mEnd = grid.cellBegin[c + 1];
+    if (mBegin == mEnd) { continue; }
+
+    // the box of the cell, and the shifts of its particles
+    int index[3];
+    coords_to_index(&ctx.coordinates[3 * grid.cellParticles[mBegin]],
+                    size,
+                    grid.max,
+                    grid.min,
+                    index);
+    int lo[3];
+    int hi[3];
+    for (int d = 0; d < 3; d++)
+    {
+      lo[d] = 0;
+      hi[d] = 0;
+      if (!pctx.PBC[d]) { continue; }
+      double fmin = 1e10;
+      double fmax = -1e10;
+      for (int m = mBegin; m < mEnd; m++)
+      {
+        double const f = pctx.fracCoordinates[3 * grid.cellParticles[m] + d];
+        fmin = std::min(fmin, f);
+        fmax = std::max(fmax, f);
+      }
+      lo[d]
+          = static_cast<int>(std::ceil(fmin - pctx.ratio[d] - pctx.fracMax[d]));
+      hi[d] = static_cast<int>(
+          std::floor(fmax + pctx.ratio[d] - pctx.fracMin[d]));
+    }
+
+    int s[3];
+    for (s[0] = lo[0]; s[0] <= hi[0]; s[0]++)
+    {
+      for (s[1] = lo[1]; s[1] <= hi[1]; s[1]++)
+      {
+        for (s[2] = lo[2]; s[2] <= hi[2]; s[2]++)
+        {
+          int const shift_id = pctx.shifts.id(s);
+
+          // the cell shifted by -s, and the cells overlapping it enlarged by
+          // the influence distance
+          double boxLo[3];
+          double boxHi[3];
+          int lower[3];
+          int upper[3];
+          bool outside = false;
+          for (int d = 0; d < 3; d++)
+          {
+            double const t = pctx.shiftVectors[3 * shift_id + d];
+            boxLo[d] = grid.min[d] + index[d] * width[d] - t;
+            boxHi[d] = boxLo[d] + width[d];
+            double const lo_x
+                = (boxLo[d] - ctx.influenceDistance - grid.min[d]) / width[d];
+            double const hi_x
+                = (boxHi[d] + ctx.influenceDistance - grid.min[d]) / width[d];
+            if (hi_x < 0.0 || lo_x >= size[d])
+            {
+              outside = true;
+              break;
+            }
+            lower[d] = static_cast<int>(std::max(0.0, std::floor(lo_x)));
+            upper[d] = static_cast<int>(std::min(size[d] - 1.0, hi_x));
+          }
+          if (outside) { continue; }
+
+          for (int ii = lower[0]; ii <= upper[0]; ii++)
+          {
+            for (int jj = lower[1]; jj <= upper[1]; jj++)
+            {
+              for (int kk = lower[2]; kk <= upper[2]; kk++)
+              {
+                int const cell[3] = {ii, jj, kk};
+                double gapSq = 0.0;
+                for (int d = 0; d < 3; d++)
+                {
+                  double const cellLo = grid.min[d] + cell[d] * width[d];
+                  double const gap = std::max(cellLo - boxHi[d],
+                                              boxLo[d] - (cellLo + width[d]));
+                  if (gap > 0.0) { gapSq += gap * gap; }
+                }
+                if (gapSq >= influenceSq) { continue; }
+
+                int const idx = grid.find(ii, jj, kk);
+                if (idx < 0) { continue; }
+                int const count = grid.cellBegin[idx + 1] - grid.cellBegin[idx];
+                if (count == 0) { continue; }
+
+                numberOfImages += count;
+                if (numberOfImages > maxImages) { return; }
+                pctx.visits.push_back(std::make_pair(shift_id, idx));
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+  pctx.visitBegin[numberOfCells] = static_cast<int>(pctx.visits.size());
+
+  // the images of each cell, with their coordinates in the same layout as
+  // those of the grid, see nbl_select_within
+  CellGrid & images = pctx.images;
+  std::size_t const total = static_cast<std::size_t>(numberOfImages);
+  images.cellBegin.resize(numberOfCells + 1);
+  images.cellParticles.resize(total);
+  images.cellCoordinates.resize(3 * total);
+  pctx.imageShift.resize(total);
+  double * const x = images.cellCoordinates.data();
+  double * const y = x + total;
+  double * const z = y + total;
+  double const * const gx = grid.x();
+  double const * const gy = grid.y();
+  double const * const gz = grid.z();
+  std::size_t m = 0;
+  for (int c = 0; c < numberOfCells; c++)
+  {
+    images.cellBegin[c] = static_cast<int>(m);
+    for (int v = pctx.visitBegin[c]; v < pctx.visitBegin[c + 1]; v++)
+    {
+      int const shift_id = pctx.visits[v].first;
+      int const idx = pctx.visits[v].second;
+      double const * const t = &pctx.shiftVectors[3 * shift_id];
+      for (int n = grid.cellBegin[idx]; n < grid.cellBegin[idx + 1]; n++, m++)
+      {
+        images.cellParticles[m] = grid.cellParticles[n];
+        pctx.imageShift[m] = shift_id;
+        x[m] = gx[n] + t[0];
+        y[m] = gy[n] + t[1];
+        z[m] = gz[n] + t[2];
+      }
+    }
+  }
+  images.cellBegin[numberOfCells] = static_cast<int>(m);
+}
+
+
+// find the neighbors (including periodic images) of particles in
+// [begin, end). A particle is appended to `neigh` as itself, and an image as
+// numberOfParticles + g, where g is its ghost in `ghosts`
+static int nbl_build_periodic_range(NeighList * const nl,
+                                    BuildContext const & ctx,
+                                    PeriodicContext const & pctx,
+                                    int const begin,
+                                    int const end,
+                                    std::vector<std::vector<int> > & neigh,
+                                    std::vector<std::vector<double> > & pairs,
+                                    GhostTable & ghosts)
+{
+  double const * const coordinates = ctx.coordinates;
+  double const influenceDistance = ctx.influenceDistance;
+  double const influenceSq = influenceDistance * influenceDistance;
+  CellGrid const & grid = ctx.grid;
+  int const * const size = grid.size;
+  int const * const cellBegin = grid.cellBegin.data();
+  int const zero_shift = pctx.shifts.number() / 2;
+
+  NeighborCollector<int> collector(ctx, neigh, pairs);
+  // the candidates of nbl_select_within
+  std::vector<double> rsqs;
+  std::vector<int> selected;
+
+  // add the candidates [mBegin, mEnd) of `cells` that are neighbors of
+  // particle i, which is at q: the particles of the grid shifted by
+  // shift_id, or the images of PeriodicContext::images; returns 1 on a
+  // collision
+  auto const visit = [&](int const i,
+                         double const * q,
+                         CellGrid const & cells,
+                         int const mBegin,
+                         int const mEnd,
+                         int const * imageShift,
+                         int const shift_id,
+                         double const cutsq,
+                         double const * pairCutsqs) {
+    if (static_cast<int>(rsqs.size()) < mEnd - mBegin)
+    {
+      rsqs.resize(mEnd - mBegin);
+      selected.resize(mEnd - mBegin);
+    }
+    int const count = nbl_select_within(
+        cells, mBegin, mEnd, q, cutsq, rsqs.data(), selected.data());
+    double const * const cx = cells.x();
+    double const * const cy = cells.y();
+    double const * const cz = cells.z();
+
+    for (int c = 0; c < count; c++)
+    {
+      int const m = selected[c];
+      int const n = cells.cellParticles[m];
+      int const shift = imageShift ? imageShift[m] : shift_id;
+      if (n == i && shift == zero_shift) { continue; }
+      if (ctx.half && ctx.needNeighbors[n]
+          && (n < i || (n == i && shift < zero_shift)))
+      {
+        continue;
+      }
+
+      double const rsq = rsqs[c];
+      if (rsq < TOL)
+      {
+        nbl_report_collision(i, n, rsq);
+        return 1;
+      }
+      if (pairCutsqs && rsq >= pairCutsqs[ctx.speciesCode[n]]) { continue; }
+      int const neighbor
+          = shift == zero_shift
+                ? n
+                : ctx.numberOfParticles
+                      + ghosts.find_or_insert(static_cast<long long>(shift)
+                                                  * ctx.numberOfParticles
+                                              + n);
+      collector.add(neighbor, cx[m] - q[0], cy[m] - q[1], cz[m] - q[2], rsq);
+    }
+    return 0;
+  };
+
+  for (int i = begin; i < end; i++)
+  {
+    if (!ctx.needNeighbors[i] && !ctx.otherNeedNeighbors)
+    {
+      collector.finish(nl, i);
+      continue;
+    }
+
+    collector.start(ctx.needNeighbors[i]);
+    // collisions are found among the candidates within the cutoffs
+    double const cutsq = std::max(collector.maxCutsq, TOL);
+    double const * const pairCutsqs = nbl_pair_cutsqs(ctx, i);
+
+    // the images gathered for the cell of the particle
+    CellGrid const & images = pctx.images;
+    if (!images.cellBegin.empty())
+    {
+      int const a = grid.cellOfParticle[i];
+      if (visit(i,
+                &coordinates[3 * i],
+                images,
+                images.cellBegin[a],
+                images.cellBegin[a + 1],
+                pctx.imageShift.data(),
+                zero_shift,
+                cutsq,
+                pairCutsqs))
+      {
+        return 1;
+      }
+      collector.finish(nl, i);
+      continue;
+    }
+
+    // the images that can be within the influence distance of particle i
+    int lo[3];
+    int hi[3];
+    for (int d = 0; d < 3; d++)
+    {
+      lo[d] = 0;
+      hi[d] = 0;
+      if (pctx.PBC[d])
+      {
+        double const f = pctx.fracCoordinates[3 * i + d];
+        lo[d]
+            = static_cast<int>(std::ceil(f - pctx.ratio[d] - pctx.fracMax[d]));
+        hi[d]
+            = static_cast<int>(std::floor(f + pctx.ratio[d] - pctx.fracMin[d]));
+      }
+    }
+
+    int s[3];
+    for (s[0] = lo[0]; s[0] <= hi[0]; s[0]++)
+    {
+      for (s[1] = lo[1]; s[1] <= hi[1]; s[1]++)
+      {
+        for (s[2] = lo[2]; s[2] <= hi[2]; s[2]++)
+        {
+          // atom n shifted by s is a neighbor of i, if n is a neighbor of
+          // the query point, i.e. i shifted by -s
+          int const shift_id = pctx.shifts.id(s);
+          double const * const t = &pctx.shiftVectors[3 * shift_id];
+          double const q[3] = {coordinates[3 * i] - t[0],
+                               coordinates[3 * i + 1] - t[1],
+                               coordinates[3 * i + 2] - t[2]};
+
+          // the cells overlapping the box [q - influenceDistance,
+          // q + influenceDistance]; q may be outside of the grid
+          int lower[3];
+          int upper[3];
+          double width[3];
+          bool outside = false;
+          for (int d = 0; d < 3; d++)
+          {
+            width[d] = (grid.max[d] - grid.min[d]) / size[d];
+            double const w = width[d];
+            double const lo_x = (q[d] - influenceDistance - grid.min[d]) / w;
+            double const hi_x = (q[d] + influenceDistance - grid.min[d]) / w;
+            if (hi_x < 0.0 || lo_x >= size[d])
+            {
+              outside = true;
+              break;
+            }
+            lower[d] = static_cast<int>(std::max(0.0, std::floor(lo_x)));
+            upper[d] = static_cast<int>(std::min(size[d] - 1.0, hi_x));
+          }
+          if (outside) { continue; }
+
+          // skip the corner cells of the box that are farther than the
+          // influence distance, which are many for small bins
+          for (int ii = lower[0]; ii <= upper[0]; ii++)
+          {
+            double const gx = nbl_gap_to_cell(q[0], grid.min[0], width[0], ii);
+            for (int jj = lower[1]; jj <= upper[1]; jj++)
+            {
+              double const gy
+                  = nbl_gap_to_cell(q[1], grid.min[1], width[1], jj);
+              for (int kk = lower[2]; kk <= upper[2]; kk++)
+              {
+                double const gz
+                    = nbl_gap_to_cell(q[2], grid.min[2], width[2], kk);
+                if (gx * gx + gy * gy + gz * gz >= influenceSq) { continue; }
+
+                int const idx = grid.find(ii, jj, kk);
+                if (idx < 0) { continue; }
+
+                if (visit(i,
+                          q,
+                          grid,
+                          cellBegin[idx],
+                          cellBegin[idx + 1],
+                          nullptr,
+                          shift_id,
+                          cutsq,
+                          pairCutsqs))
+                {
+                  return 1;
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+
+    collector.finish(nl, i);
+  }
+
+  return 0;
+}
+
+
+// find the neighbors of the numberOfRows rows of ws->ctx, whose particles are
+// binned, and merge them into the lists of nl (see nbl_build_range), which
+// have room for the rows
+static int nbl_build_rows(NeighList * const nl,
+                          NeighListWorkspace * const ws,
+                          int const numberOfRows,
+                          double const * cutoffs,
+                          int const numberOfThreads)
+{
+  BuildContext const & ctx = ws->ctx;
+  int const numberOfCutoffs = ctx.numberOfCutoffs;
+
+  ChunkedNeighbors<int> & chunks = ws->chunks;
+  chunks.reset(
+      numberOfRows, numberOfThreads, ctx.sharedStorage ? 1 : numberOfCutoffs);
+
+  std::vector<int> chunk_error(chunks.numberOfChunks, 0);
+  chunks.run([&](int const c) {
+    chunk_error[c] = nbl_build_range(nl,
+                                     ctx,
+                                     chunks.begin(c),
+                                     chunks.begin(c + 1),
+                                     chunks.neigh[c],
+                                     chunks.pairs[c]);
+  });
+  for (int c = 0; c < chunks.numberOfChunks; c++)
+  {
+    if (chunk_error[c]) { return 1; }
+  }
+
+  chunks.compute_offsets();
+
+  if (nbl_reserve_storage(nl, ctx, chunks.total)) { return 1; }
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    nl->lists[k].numberOfParticles = numberOfRows;
+    nl->lists[k].cutoff = cutoffs[k] + ctx.skin;
+  }
+
+  // merge the chunks, which keeps the same layout as a serial build
+  chunks.shift_begin_index(nl);
+  chunks.run([&](int const c) {
+    for (int k = 0; k < static_cast<int>(chunks.total.size()); k++)
+    {
+      NeighListOne * const cnl = nbl_storage_of(nl, ctx, k);
+      std::vector<int> const & src = chunks.neigh[c][k];
+      std::memcpy(cnl->neighborList + chunks.offset[c][k],
+                  src.data(),
+                  sizeof(int) * src.size());
+      if (ctx.storeDistances)
+      {
+        nbl_copy_pair_data(cnl, chunks.pairs[c][k], chunks.offset[c][k]);
+      }
+    }
+  });
+
+  return 0;
+}
+
+
+// set up ctx for nbl_build with the settings of nl and the given skin
+static int nbl_init_build(NeighList const * const nl,
+                          BuildContext & ctx,
+                          int const numberOfParticles,
+                          double const * coordinates,
+                          double const influenceDistance,
+                          int const numberOfCutoffs,
+                          double const * cutoffs,
+                          int const * needNeighbors,
+                          double const skin)
+{
+  nbl_init_context(ctx,
+                   numberOfParticles,
+                   coordinates,
+                   influenceDistance,
+                   numberOfCutoffs,
+                   cutoffs,
+                   skin,
+                   needNeighbors);
+  ctx.half = nl->half;
+  ctx.sharedStorage = nl->sharedStorage;
+  ctx.storeDistances = nl->storeDistances;
+  ctx.engine = nl->engine;
+  ctx.binSizeFactor = nl->binSizeFactor;
+
+  int const error = nbl_init_hints(ctx, nl->hints);
+  if (error) { return error; }
+
+  return nbl_init_species(ctx, nl, skin);
+}
+
+
+// keep the inputs of nbl_build for nbl_update
+static void nbl_keep_inputs(NeighList * const nl,
+                            int const numberOfParticles,
+                            double const * coordinates,
+                            double const influenceDistance,
+                            int const numberOfCutoffs,
+                            double const * cutoffs,
+                            int const * needNeighbors,
+                            int const numberOfThreads,
+                            double const skin)
+{
+  nl->influenceDistance = influenceDistance;
+  nl->numberOfThreads = numberOfThreads;
+  nl->cutoffs.assign(cutoffs, cutoffs + numberOfCutoffs);
+  nl->needNeighbors.assign(needNeighbors, needNeighbors + numberOfParticles);
+  nl->builtSkin = skin;
+  if (skin > 0.0)
+  {
+    nl->referenceCoordinates.assign(coordinates,
+                                    coordinates + 3 * numberOfParticles);
+  }
+}
+
+
+// nbl_build with the temporary containers of ws
+static int nbl_build_with(NeighList * const nl,
+                          NeighListWorkspace * const ws,
+                          int const numberOfParticles,
+                          double const * coordinates,
+                          double const influenceDistance,
+                          int const numberOfCutoffs,
+                          double const * cutoffs,
+                          int const * needNeighbors,
+                          int const numberOfThreads,
+                          double const skin)
+{
+  BuildContext & ctx = ws->ctx;
+  int error = nbl_init_build(nl,
+                             ctx,
+                             numberOfParticles,
+                             coordinates,
+                             influenceDistance,
+                             numberOfCutoffs,
+                             cutoffs,
+                             needNeighbors,
+                             skin);
+  if (error) { return error; }
+
+  error = nbl_bin_particles(ctx);
+  if (error) { return error; }
+
+  // create neighbors, reusing the memory of the previous build
+  nbl_allocate_memory(nl, numberOfCutoffs, numberOfParticles);
+
+  error = nbl_build_rows(nl, ws, numberOfParticles, cutoffs, numberOfThreads);
+  if (error) { return error; }
+
+  nbl_keep_inputs(nl,
+                  numberOfParticles,
+                  coordinates,
+                  influenceDistance,
+                  numberOfCutoffs,
+                  cutoffs,
+                  needNeighbors,
+                  numberOfThreads,
+                  skin);
+  return 0;
+}
+
+
+// Bin the particles around tile [first, first + numberOfRows) into ctx.grid,
+// a sparse grid with the cells of `index`: the cells of the tile and those
+// visited from them by nbl_build_range. The tile then gets the same
+// neighbors, in the same order, as from a full build.
+static void nbl_bin_tile(BuildContext & ctx,
+                         CellGrid const & index,
+                         int const first,
+                         int const numberOfRows)
+{
+  double const * const coordinates = ctx.coordinates;
+  int const * const size = index.size;
+
+  // the cells visited from a cell are at most reach[d] cells away along d
+  int reach[3] = {1, 1, 1};
+  std::vector<int> const & stencil = index.stencil;
+  for (std::size_t r = 0; r < stencil.size(); r += 4)
+  {
+    reach[1] = std::max(reach[1], std::abs(stencil[r]));
+    reach[2] = std::max(reach[2], std::abs(stencil[r + 1]));
+    reach[0] = std::max(reach[0], std::max(-stencil[r + 2], stencil[r + 3]));
+  }
+
+  int lo[3] = {size[0], size[1], size[2]};
+  int hi[3] = {-1, -1, -1};
+  for (int i = first; i < first + numberOfRows; i++)
+  {
+    int cell[3];
+    coords_to_index(&coordinates[3 * i], size, index.max, index.min, cell);
+    for (int d = 0; d < 3; d++)
+    {
+      cell[d] = std::max(0, std::min(cell[d], size[d] - 1));
+      lo[d] = std::min(lo[d], cell[d]);
+      hi[d] = std::max(hi[d], cell[d]);
+    }
+  }
+  for (int d = 0; d < 3; d++)
+  {
+    lo[d] = std::max(0, lo[d] - reach[d]);
+    hi[d] = std::min(size[d] - 1, hi[d] + reach[d]);
+  }
+
+  // the occupied cells of the range, with their packed indices; the range is
+  // scanned if it is smaller than the index, e.g. for a compact tile, and
+  // otherwise the cells of the index are
+  std::vector<std::pair<long long, int> > cells;
+  auto const add = [&](int const i, int const j, int const k, int const c) {
+    if (c < 0 || index.cellBegin[c] == index.cellBegin[c + 1]) { return; }
+    if (i < lo[0] || i > hi[0] || j < lo[1] || j > hi[1] || k < lo[2]
+        || k > hi[2])
+    {
+      return;
+    }
+    cells.push_back(std::make_pair(CellGrid::pack(i, j, k), c));
+  };
+  double const volume
+      = (hi[0] - lo[0] + 1.0) * (hi[1] - lo[1] + 1.0) * (hi[2] - lo[2] + 1.0);
+  std::size_t const numberOfCells = index.cellBegin.size() - 1;
+  if (volume <= numberOfCells)
+  {
+    for (int k = lo[2]; k <= hi[2]; k++)
+    {
+      for (int j = lo[1]; j <= hi[1]; j++)
+      {
+        for (int i = lo[0]; i <= hi[0]; i++)
+        {
+          add(i, j, k, index.find(i, j, k));
+        }
+      }
+    }
+  }
+  else if (index.sparse)
+  {
+    long long const mask = (1LL << 21) - 1;
+    for (auto const & cell : index.occupiedCells)
+    {
+      add(static_cast<int>(cell.first & mask),
+          static_cast<int>((cell.first >> 21) & mask),
+          static_cast<int>(cell.first >> 42),
+          cell.second);
+    }
+  }
+  else
+  {
+    for (std::size_t c = 0; c < numberOfCells; c++)
+    {
+      int const i = static_cast<int>(c % size[0]);
+      int const j = static_cast<int>(c / size[0] % size[1]);
+      int const k = static_cast<int>(c / size[0] / size[1]);
+      add(i, j, k, static_cast<int>(c));
+    }
+  }
+
+  CellGrid & grid = ctx.grid;
+  for (int d = 0; d < 3; d++)
+  {
+    grid.size[d] = index.size[d];
+    grid.min[d] = index.min[d];
+    grid.max[d] = index.max[d];
+  }
+  grid.sparse = 1;
+  grid.stencil = index.stencil;
+  grid.occupiedCells.clear();
+  grid.cellBegin.resize(cells.size() + 1);
+  grid.cellBegin[0] = 0;
+  for (std::size_t n = 0; n < cells.size(); n++)
+  {
+    int const c = cells[n].second;
+    grid.occupiedCells[cells[n].first] = static_cast<int>(n);
+    grid.cellBegin[n + 1]
+        = grid.cellBegin[n] + index.cellBegin[c + 1] - index.cellBegin[c];
+  }
+
+  int const numberOfParticles = grid.cellBegin[cells.size()];
+  grid.cellOfParticle.clear();
+  grid.cellParticles.resize(numberOfParticles);
+  grid.cellCoordinates.resize(3 * numberOfParticles);
+  double * const x = grid.cellCoordinates.data();
+  double * const y = x + numberOfParticles;
+  double * const z = y + numberOfParticles;
+  for (std::size_t n = 0; n < cells.size(); n++)
+  {
+    int const c = cells[n].second;
+    int m = grid.cellBegin[n];
+    for (int q = index.cellBegin[c]; q < index.cellBegin[c + 1]; q++, m++)
+    {
+      int const i = index.cellParticles[q];
+      grid.cellParticles[m] = i;
+      x[m] = coordinates[3 * i];
+      y[m] = coordinates[3 * i + 1];
+      z[m] = coordinates[3 * i + 2];
+    }
+  }
+}
+
+
+// copy the lists of nl, which are those of tile `tile`, into a new buffer of
+// `tiles`, and make them the lists of the tile
+static int
+nbl_store_tile(NeighList * const nl, NeighListTiles & tiles, int const tile)
+{
+  int const numberOfCutoffs = nl->numberOfNeighborLists;
+  int const storeDistances = tiles.ws.ctx.storeDistances;
+
+  // the arrays of each list, 8-byte aligned, where those of the lists that
+  // share a neighborList are left to its owner
+  std::size_t bytes = 0;
+  auto const reserve = [&bytes](std::size_t const size) {
+    std::size_t const offset = bytes;
+    bytes += (size + 7) / 8 * 8;
+    return offset;
+  };
+  std::vector<std::size_t> offsets(5 * numberOfCutoffs, 0);
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    NeighListOne const * const cnl = &(nl->lists[k]);
+    std::size_t const rows = cnl->numberOfParticles;
+    std::size_t const size = cnl->neighborListSize;
+    offsets[5 * k] = reserve(sizeof(int) * rows);
+    offsets[5 * k + 1] = reserve(sizeof(long long) * rows);
+    if (cnl->sharesNeighborList) { continue; }
+    offsets[5 * k + 2] = reserve(sizeof(int) * size);
+    if (storeDistances)
+    {
+      offsets[5 * k + 3] = reserve(3 * sizeof(double) * size);
+      offsets[5 * k + 4] = reserve(sizeof(double) * size);
+    }
+  }
+
+  char * const buffer = tiles.allocate(bytes);
+  if (!buffer)
+  {
+    MY_WARNING("Cannot allocate the lists of a tile.");
+    return 1;
+  }
+
+  std::vector<NeighListOne> & lists = tiles.lists[tile];
+  lists.assign(numberOfCutoffs, NeighListOne());
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    NeighListOne const * const cnl = &(nl->lists[k]);
+    NeighListOne & one = lists[k];
+    int const rows = cnl->numberOfParticles;
+    long long const size = cnl->neighborListSize;
+    one.numberOfParticles = rows;
+    one.cutoff = cnl->cutoff;
+    one.neighborListSize = size;
+    one.particleCapacity = rows;
+    one.sharesNeighborList = cnl->sharesNeighborList;
+    one.Nneighbors = reinterpret_cast<int *>(buffer + offsets[5 * k]);
+    one.beginIndex = reinterpret_cast<long long *>(buffer + offsets[5 * k + 1]);
+    std::memcpy(one.Nneighbors, cnl->Nneighbors, sizeof(int) * rows);
+    std::memcpy(one.beginIndex, cnl->beginIndex, sizeof(long long) * rows);
+    if (cnl->sharesNeighborList) { continue; }
+
+    one.neighborListCapacity = size;
+    one.neighborList = reinterpret_cast<int *>(buffer + offsets[5 * k + 2]);
+    std::memcpy(one.neighborList, cnl->neighborList, sizeof(int) * size);
+    if (storeDistances)
+    {
+      one.pairDataCapacity = size;
+      one.neighborDisplacements
+          = reinterpret_cast<double *>(buffer + offsets[5 * k + 3]);
+      one.neighborDistances
+          = reinterpret_cast<double *>(buffer + offsets[5 * k + 4]);
+      std::memcpy(one.neighborDisplacements,
+                  cnl->neighborDisplacements,
+                  3 * sizeof(double) * size);
+      std::memcpy(
+          one.neighborDistances, cnl->neighborDistances, sizeof(double) * size);
+    }
+  }
+
+  // the lists sharing a neighborList follow its owner
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    if (!lists[k].sharesNeighborList) { continue; }
+    for (int j = 0; j < numberOfCutoffs; j++)
+    {
+      if (!lists[j].sharesNeighborList)
+      {
+        lists[k].neighborList = lists[j].neighborList;
+        lists[k].neighborDisplacements = lists[j].neighborDisplacements;
+        lists[k].neighborDistances = lists[j].neighborDistances;
+      }
+    }
+  }
+  return 0;
+}
+
+
+// build the lists of tile `tile` in those of nl, which are only a buffer for
+// the lists of the tiles, and store them in `tiles`
+static int nbl_build_tile_lists(NeighList * const nl,
+                                NeighListTiles & tiles,
+                                int const tile)
+{
+  BuildContext & ctx = tiles.ws.ctx;
+  int const first
+      = static_cast<int>(static_cast<long long>(nl->builtTileSize) * tile);
+  int const numberOfRows
+      = std::min(nl->builtTileSize, ctx.numberOfParticles - first);
+
+  nbl_bin_tile(ctx, tiles.index, first, numberOfRows);
+  ctx.firstParticle = first;
+
+  nbl_reset_lists(nl);
+  nbl_detach_views(nl, 0);
+  for (int k = 0; k < nl->numberOfNeighborLists; k++)
+  {
+    nbl_reserve_particles(&(nl->lists[k]), numberOfRows, 0);
+  }
+
+  int const error = nbl_build_rows(
+      nl, &tiles.ws, numberOfRows, nl->cutoffs.data(), nl->numberOfThreads);
+  if (error) { return error; }
+
+  return nbl_store_tile(nl, tiles, tile);
+}
+
+
+// nbl_build of a tiled neighbor list: the particles are sorted by cell, and
+// the lists of the first tile are built. The tiles are built from the
+// coordinates passed here, which have to stay valid until the next build.
+static int nbl_build_tiled(NeighList * const nl,
+                           int const numberOfParticles,
+                           double const * coordinates,
+                           double const influenceDistance,
+                           int const numberOfCutoffs,
+                           double const * cutoffs,
+                           int const * needNeighbors,
+                           int const numberOfThreads,
+                           double const skin)
+{
+  // the tiles of the last build are reused, unless the Python binding still
+  // holds them
+  std::shared_ptr<NeighListTiles> tiles;
+  tiles.swap(nl->tiles);
+  if (!tiles || tiles.use_count() > 1)
+  {
+    tiles = std::make_shared<NeighListTiles>();
+  }
+
+  BuildContext & ctx = tiles->ws.ctx;
+  int error = nbl_init_build(nl,
+                             ctx,
+                             numberOfParticles,
+                             coordinates,
+                             influenceDistance,
+                             numberOfCutoffs,
+                             cutoffs,
+                             needNeighbors,
+                             skin);
+  if (error) { return error; }
+
+  if (numberOfParticles > 0)
+  {
+    error = nbl_bin_particles(ctx, 0);
+    if (error) { return error; }
+  }
+  std::swap(tiles->index, ctx.grid);
+
+  int const numberOfTiles = static_cast<int>(
+      (numberOfParticles + static_cast<long long>(nl->tileSize) - 1)
+      / nl->tileSize);
+  error = tiles->reset(numberOfTiles, nl->tileDirectory);
+  if (error) { return error; }
+
+  // the lists have room for the rows of one tile
+  nbl_allocate_memory(
+      nl, numberOfCutoffs, std::min(nl->tileSize, numberOfParticles));
+
+  nbl_keep_inputs(nl,
+                  numberOfParticles,
+                  coordinates,
+                  influenceDistance,
+                  numberOfCutoffs,
+                  cutoffs,
+                  needNeighbors,
+                  numberOfThreads,
+                  skin);
+  ctx.needNeighbors = nl->needNeighbors.data();
+  if (!ctx.pairCutsqs.empty())
+  {
+    tiles->speciesCode.assign(nl->speciesCode.begin(),
+                              nl->speciesCode.begin() + numberOfParticles);
+    ctx.speciesCode = tiles->speciesCode.data();
+  }
+
+  nl->tiles = tiles;
+  nl->numberOfTiles = numberOfTiles;
+  nl->builtTileSize = nl->tileSize;
+  return numberOfTiles > 0 ? nbl_build_tile(nl, 0) : 0;
+}
+
+
+NeighListOne const * nbl_get_tile(NeighList * const nl, int const tile)
+{
+  NeighListTiles * const tiles = nl->tiles.get();
+  if (!tiles || tile < 0 || tile >= tiles->numberOfTiles)
+  {
+    MY_WARNING("The neighbor list is not tiled, or the tile does not exist.");
+    return nullptr;
+  }
+
+  if (!tiles->built[tile].load(std::memory_order_acquire))
+  {
+    std::lock_guard<std::mutex> lock(tiles->mutex);
+    if (!tiles->built[tile].load(std::memory_order_relaxed))
+    {
+      if (nbl_build_tile_lists(nl, *tiles, tile)) { return nullptr; }
+      tiles->built[tile].store(1, std::memory_order_release);
+    }
+  }
+  return tiles->lists[tile].data();
+}
+
+
+int nbl_build_tile(NeighList * const nl, int const tile)
+{
+  if (!nbl_get_tile(nl, tile)) { return 1; }
+  nl->currentTile = tile;
+  return 0;
+}
+
+
+// nbl_build with the given skin instead of that of nl
+static int nbl_build_with_skin(NeighList * const nl,
+                               int const numberOfParticles,
+                               double const * coordinates,
+                               double const influenceDistance,
+                               int const numberOfCutoffs,
+                               double const * cutoffs,
+                               int const * needNeighbors,
+                               int const numberOfThreads,
+                               double const skin)
+{
+  if (nl->tileSize > 0)
+  {
+    return nbl_build_tiled(nl,
+                           numberOfParticles,
+                           coordinates,
+                           influenceDistance,
+                           numberOfCutoffs,
+                           cutoffs,
+                           needNeighbors,
+                           numberOfThreads,
+                           skin);
+  }
+
+  return nbl_build_with(nl,
+                        nbl_get_workspace(nl),
+                        numberOfParticles,
+                        coordinates,
+                        influenceDistance,
+                        numberOfCutoffs,
+                        cutoffs,
+                        needNeighbors,
+                        numberOfThreads,
+                        skin);
+}
+
+
+int nbl_build(NeighList * const nl,
+              int const numberOfParticles,
+              double const * coordinates,
+              double const influenceDistance,
+              int const numberOfCutoffs,
+              double const * cutoffs,
+              int const * needNeighbors,
+              int const numberOfThreads)
+{
+  return nbl_build_with_skin(nl,
+                             numberOfParticles,
+                             coordinates,
+                             influenceDistance,
+                             numberOfCutoffs,
+                             cutoffs,
+                             needNeighbors,
+                             numberOfThreads,
+                             nl->skin);
+}
+
+
+// nbl_build_subset with the given skin instead of that of nl
+static int nbl_build_subset_with_skin(NeighList * const nl,
+                                      int const numberOfParticles,
+                                      double const * coordinates,
+                                      double const influenceDistance,
+                                      int const numberOfCutoffs,
+                                      double const * cutoffs,
+                                      int const numberOfSubset,
+                                      int const * subset,
+                                      int const numberOfThreads,
+                                      double const skin)
+{
+  if (nl->half)
+  {
+    MY_WARNING("A half neighbor list cannot be built for a subset of the "
+               "particles.");
+    return 1;
+  }
+  for (int r = 0; r < numberOfSubset; r++)
+  {
+    if (subset[r] < 0 || subset[r] >= numberOfParticles
+        || (r > 0 && subset[r] <= subset[r - 1]))
+    {
+      MY_WARNING("The subset is not made of increasing particle indices.");
+      return 1;
+    }
+  }
+
+  NeighListWorkspace * const ws = nbl_get_workspace(nl);
+  BuildContext & ctx = ws->ctx;
+  nbl_init_context(ctx,
+                   numberOfParticles,
+                   coordinates,
+                   influenceDistance,
+                   numberOfCutoffs,
+                   cutoffs,
+                   skin,
+                   nullptr);
+  ctx.subset = subset;
+  ctx.sharedStorage = nl->sharedStorage;
+  ctx.storeDistances = nl->storeDistances;
+  ctx.engine = nl->engine;
+  ctx.binSizeFactor = nl->binSizeFactor;
+
+  // only the lists of the subset are built
+  int error = nbl_init_hints(ctx, std::vector<int>());
+  if (error) { return error; }
+
+  error = nbl_init_species(ctx, nl, skin);
+  if (error) { return error; }
+
+  if (numberOfSubset > 0)
+  {
+    // the neighbors are within the influence distance of the bounding box of
+    // the subset, so only the particles there are binned
+    double lower[3];
+    double upper[3];
+    for (int d = 0; d < 3; d++)
+    {
+      lower[d] = coordinates[3 * subset[0] + d];
+      upper[d] = lower[d];
+    }
+    for (int r = 1; r < numberOfSubset; r++)
+    {
+      double const * const x = &coordinates[3 * subset[r]];
+      for (int d = 0; d < 3; d++)
+      {
+        lower[d] = std::min(lower[d], x[d]);
+        upper[d] = std::max(upper[d], x[d]);
+      }
+    }
+    for (int d = 0; d < 3; d++)
+    {
+      lower[d] -= ctx.influenceDistance;
+      upper[d] += ctx.influenceDistance;
+    }
+
+    std::vector<int> & binned = ctx.binnedParticles;
+    for (int i = 0; i < numberOfParticles; i++)
+    {
+      double const * const x = &coordinates[3 * i];
+      if (x[0] >= lower[0] && x[0] <= upper[0] && x[1] >= lower[1]
+          && x[1] <= upper[1] && x[2] >= lower[2] && x[2] <= upper[2])
+      {
+        binned.push_back(i);
+      }
+    }
+
+    error = nbl_bin_particles(ctx);
+    if (error) { return error; }
+  }
+
+  nbl_allocate_memory(nl, numberOfCutoffs, numberOfSubset);
+
+  error = nbl_build_rows(nl, ws, numberOfSubset, cutoffs, numberOfThreads);
+  if (error) { return error; }
+
+  nl->hasSubset = 1;
+  nl->numberOfAllParticles = numberOfParticles;
+  nl->subset.assign(subset, subset + numberOfSubset);
+
+  // keep the inputs for nbl_update
+  nl->influenceDistance = influenceDistance;
+  nl->numberOfThreads = numberOfThreads;
+  nl->cutoffs.assign(cutoffs, cutoffs + numberOfCutoffs);
+  nl->builtSkin = skin;
+  if (skin > 0.0)
+  {
+    nl->referenceCoordinates.assign(coordinates,
+                                    coordinates + 3 * numberOfParticles);
+  }
+
+  return 0;
+}
+
+
+int nbl_build_subset(NeighList * const nl,
+                     int const numberOfParticles,
+                     double const * coordinates,
+                     double const influenceDistance,
+                     int const numberOfCutoffs,
+                     double const * cutoffs,
+                     int const numberOfSubset,
+                     int const * subset,
+                     int const numberOfThreads)
+{
+  return nbl_build_subset_with_skin(nl,
+                                    numberOfParticles,
+                                    coordinates,
+                                    influenceDistance,
+                                    numberOfCutoffs,
+                                    cutoffs,
+                                    numberOfSubset,
+                                    subset,
+                                    numberOfThreads,
+                                    nl->skin);
+}
+
+
+int nbl_check_displacement(int const numberOfParticles,
+                           double const * coordinates,
+                           double const * referenceCoordinates,
+                           double const skin)
+{
+  double const trigger = 0.25 * skin * skin;
+
+  for (int i = 0; i < 3 * numberOfParticles; i += 3)
+  {
+    double const dx = coordinates[i] - referenceCoordinates[i];
+    double const dy = coordinates[i + 1] - referenceCoordinates[i + 1];
+    double const dz = coordinates[i + 2] - referenceCoordinates[i + 2];
+    if (dx * dx + dy * dy + dz * dz > trigger) { return 1; }
+  }
+
+  return 0;
+}
+
+
+int nbl_update(NeighList * const nl,
+               int const numberOfParticles,
+               double const * coordinates,
+               int * const rebuilt)
+{
+  *rebuilt = 0;
+
+  int const numberOfBuiltParticles
+      = nl->hasSubset ? nl->numberOfAllParticles
+                      : static_cast<int>(nl->needNeighbors.size());
+  if ((nl->lists == nullptr) || (numberOfBuiltParticles != numberOfParticles))
+  {
+    MY_WARNING("Neighbor list to update is not built by nbl_build with the "
+               "same number of particles.");
+    return 1;
+  }
+
+  // the lists stay valid as long as no particle has moved more than skin/2
+  // for the skin they were built with
+  if (nl->builtSkin > 0.0
+      && !nbl_check_displacement(numberOfParticles,
+                                 coordinates,
+                                 nl->referenceCoordinates.data(),
+                                 nl->builtSkin))
+  {
+    return 0;
+  }
+
+  // nbl_build resets the stored inputs, so make a copy
+  double const skin = nl->builtSkin;
+  std::vector<double> const cutoffs(nl->cutoffs);
+  std::vector<int> const needNeighbors(nl->needNeighbors);
+
+  *rebuilt = 1;
+  if (nl->hasSubset)
+  {
+    std::vector<int> const subset(nl->subset);
+    return nbl_build_subset_with_skin(nl,
+                                      numberOfParticles,
+                                      coordinates,
+                                      nl->influenceDistance,
+                                      static_cast<int>(cutoffs.size()),
+                                      cutoffs.data(),
+                                      static_cast<int>(subset.size()),
+                                      subset.data(),
+                                      nl->numberOfThreads,
+                                      skin);
+  }
+  return nbl_build_with_skin(nl,
+                             numberOfParticles,
+                             coordinates,
+                             nl->influenceDistance,
+                             static_cast<int>(cutoffs.size()),
+                             cutoffs.data(),
+                             needNeighbors.data(),
+                             nl->numberOfThreads,
+                             skin);
+}
+
+
+static int nbl_init_periodic_context(PeriodicContext & pctx,
+                                     int const numberOfParticles,
+                                     double const * coordinates,
+                                     double const * cell,
+                                     int const * PBC,
+                                     double const influenceDistance)
+{
+  pctx.cell = cell;
+  pctx.PBC = PBC;
+
+  // transform coordinates into fractional coordinates
+  double tcell[9];
+  double fcell[9];
+
+  transpose(cell, tcell);
+
+  int error = inverse(tcell, fcell);
+  if (error) { return error; }
+
+  pctx.fracCoordinates.resize(3 * numberOfParticles);
+  for (int d = 0; d < 3; d++)
+  {
+    pctx.fracMin[d] = 1e10;
+    pctx.fracMax[d] = -1e10;
+  }
+
+  for (int i = 0; i < numberOfParticles; i++)
+  {
+    for (int d = 0; d < 3; d++)
+    {
+      double const f = dot(fcell + 3 * d, coordinates + 3 * i);
+      pctx.fracCoordinates[3 * i + d] = f;
+      pctx.fracMin[d] = std::min(pctx.fracMin[d], f);
+      pctx.fracMax[d] = std::max(pctx.fracMax[d], f);
+    }
+  }
+
+  // volume of cell
+  double xprod[3];
+
+  cross(cell + 3, cell + 6, xprod);
+
+  double volume = std::abs(dot(cell, xprod));
+
+  // distance between parallelpiped cell faces is volume / norm(xprod)
+  cross(cell + 3, cell + 6, xprod);
+  pctx.ratio[0] = influenceDistance * norm(xprod) / volume;
+
+  cross(cell + 6, cell + 0, xprod);
+  pctx.ratio[1] = influenceDistance * norm(xprod) / volume;
+
+  cross(cell, cell + 3, xprod);
+  pctx.ratio[2] = influenceDistance * norm(xprod) / volume;
+
+  // the largest shift that may be needed in each direction
+  for (int d = 0; d < 3; d++)
+  {
+    pctx.shifts.range[d] = 0;
+    if (PBC[d])
+    {
+      pctx.shifts.range[d] = static_cast<int>(
+          std::ceil(pctx.ratio[d] + pctx.fracMax[d] - pctx.fracMin[d]));
+    }
+  }
+
+  int const numberOfShifts = pctx.shifts.number();
+  pctx.shiftOfId.resize(3 * static_cast<std::size_t>(numberOfShifts));
+  pctx.shiftVectors.resize(3 * static_cast<std::size_t>(numberOfShifts));
+  for (int id = 0; id < numberOfShifts; id++)
+  {
+    int * const s = &pctx.shiftOfId[3 * id];
+    pctx.shifts.shift(id, s);
+    for (int d = 0; d < 3; d++)
+    {
+      pctx.shiftVectors[3 * id + d]
+          = s[0] * cell[d] + s[1] * cell[3 + d] + s[2] * cell[6 + d];
+    }
+  }
+
+  return 0;
+}
+
+
+// number the ghosts of all the chunks in the order they are first found,
+// i.e. as in a serial build, and write the lists with ghost g stored as
+// particle numberOfParticles + g; returns 1 if they do not fit
+static int nbl_merge_periodic_chunks(NeighList * const nl,
+                                     NeighListWorkspace * const ws)
+{
+  BuildContext const & ctx = ws->ctx;
+  PeriodicContext const & pctx = ws->pctx;
+  ChunkedNeighbors<int> const & chunks = ws->chunks;
+  int const numberOfParticles = ctx.numberOfParticles;
+
+  // Only the ghosts of the chunks are visited serially, not the neighbors.
+  // The ghosts of a single chunk are already numbered like all of them.
+  bool const single = chunks.numberOfChunks == 1;
+  GhostTable & ghost_table = ws->ghostTable;
+  if (!single)
+  {
+    ghost_table.clear(pctx.numberOfDirectImages);
+    for (int c = 0; c < chunks.numberOfChunks; c++)
+    {
+      std::vector<long long> const & images = ws->chunkGhosts[c].images;
+      std::vector<int> & ghost_of = ws->ghostOfChunkGhost[c];
+      ghost_of.resize(images.size());
+      for (std::size_t g = 0; g < images.size(); g++)
+      {
+        ghost_of[g] = ghost_table.find_or_insert(images[g]);
+      }
+    }
+  }
+
+  std::vector<long long> const & images
+      = single ? ws->chunkGhosts[0].images : ghost_table.images;
+  int const numberOfGhosts = static_cast<int>(images.size());
+  nl->numberOfGhosts = numberOfGhosts;
+  nl->ghostMaster.resize(numberOfGhosts);
+  nl->ghostShift.resize(3 * static_cast<std::size_t>(numberOfGhosts));
+  for (int g = 0; g < numberOfGhosts; g++)
+  {
+    long long const shift_id = images[g] / numberOfParticles;
+    nl->ghostMaster[g]
+        = static_cast<int>(images[g] - shift_id * numberOfParticles);
+    std::copy(&pctx.shiftOfId[3 * shift_id],
+              &pctx.shiftOfId[3 * shift_id + 3],
+              &nl->ghostShift[3 * static_cast<std::size_t>(g)]);
+  }
+
+  if (nbl_reserve_storage(nl, ctx, chunks.total)) { return 1; }
+
+  chunks.run([&](int const c) {
+    std::vector<int> const & ghost_of = ws->ghostOfChunkGhost[c];
+    for (int k = 0; k < static_cast<int>(chunks.total.size()); k++)
+    {
+      NeighListOne * const cnl = nbl_storage_of(nl, ctx, k);
+      if (ctx.storeDistances)
+      {
+        nbl_copy_pair_data(cnl, chunks.pairs[c][k], chunks.offset[c][k]);
+      }
+
+      int * const dest = cnl->neighborList + chunks.offset[c][k];
+      std::vector<int> const & src = chunks.neigh[c][k];
+      if (single)
+      {
+        std::memcpy(dest, src.data(), sizeof(int) * src.size());
+        continue;
+      }
+      for (std::size_t m = 0; m < src.size(); m++)
+      {
+        int const n = src[m];
+        dest[m] = n < numberOfParticles
+                      ? n
+                      : numberOfParticles + ghost_of[n - numberOfParticles];
+      }
+    }
+  });
+  return 0;
+}
+
+
+// nbl_build_periodic with the temporary containers of ws
+static int nbl_build_periodic_with(NeighList * const nl,
+                                   NeighListWorkspace * const ws,
+                                   int const numberOfParticles,
+                                   double const * coordinates,
+                                   double const * cell,
+                                   int const * PBC,
+                                   double const influenceDistance,
+                                   int const numberOfCutoffs,
+                                   double const * cutoffs,
+                                   int const * needNeighbors,
+                                   int const numberOfThreads)
+{
+  BuildContext & ctx = ws->ctx;
+  nbl_init_context(ctx,
+                   numberOfParticles,
+                   coordinates,
+                   influenceDistance,
+                   numberOfCutoffs,
+                   cutoffs,
+                   0.0,
+                   needNeighbors);
+  ctx.half = nl->half;
+  ctx.sharedStorage = nl->sharedStorage;
+  ctx.storeDistances = nl->storeDistances;
+  ctx.engine = nl->engine;
+  ctx.binSizeFactor = nl->binSizeFactor;
+
+  int error = nbl_init_hints(ctx, nl->hints);
+  if (error) { return error; }
+
+  error = nbl_init_species(ctx, nl, 0.0);
+  if (error) { return error; }
+
+  PeriodicContext & pctx = ws->pctx;
+  error = nbl_init_periodic_context(
+      pctx, numberOfParticles, coordinates, cell, PBC, influenceDistance);
+  if (error) { return error; }
+
+  // bin the particles of the cell only; images are never materialized
+  error = nbl_bin_particles(ctx);
+  if (error) { return error; }
+
+  // With a cell smaller than the influence distance, each particle has
+  // neighbors in more than the 27 nearest images. They are gathered once per
+  // cell of the grid instead of found for each particle, unless they take
+  // much more memory than the particles.
+  double imagesPerParticle = 1.0;
+  for (int d = 0; d < 3; d++)
+  {
+    if (PBC[d]) { imagesPerParticle *= 2.0 * pctx.ratio[d] + 1.0; }
+  }
+  pctx.images.cellBegin.clear();
+  if (imagesPerParticle > 27.0)
+  {
+    nbl_plan_cell_images(
+        ctx, pctx, 8LL * numberOfParticles + MAX_PLANNED_IMAGES);
+  }
+
+  nbl_allocate_memory(nl, numberOfCutoffs, numberOfParticles);
+
+  ChunkedNeighbors<int> & chunks = ws->chunks;
+  chunks.reset(numberOfParticles,
+               numberOfThreads,
+               ctx.sharedStorage ? 1 : numberOfCutoffs);
+  if (static_cast<int>(ws->chunkGhosts.size()) < chunks.numberOfChunks)
+  {
+    ws->chunkGhosts.resize(chunks.numberOfChunks);
+    ws->ghostOfChunkGhost.resize(chunks.numberOfChunks);
+  }
+
+  // the ghosts of the few possible images of a small cell are found
+  // without hashing
+  long long const numberOfImages
+      = static_cast<long long>(pctx.shifts.number()) * numberOfParticles;
+  pctx.numberOfDirectImages
+      = !pctx.images.cellBegin.empty()
+                && numberOfImages * chunks.numberOfChunks <= MAX_DIRECT_IMAGES
+            ? static_cast<std::size_t>(numberOfImages)
+            : 0;
+
+  std::vector<int> chunk_error(chunks.numberOfChunks, 0);
+  chunks.run([&](int const c) {
+    ws->chunkGhosts[c].clear(pctx.numberOfDirectImages);
+    chunk_error[c] = nbl_build_periodic_range(nl,
+                                              ctx,
+                                              pctx,
+                                              chunks.begin(c),
+                                              chunks.begin(c + 1),
+                                              chunks.neigh[c],
+                                              chunks.pairs[c],
+                                              ws->chunkGhosts[c]);
+  });
+  for (int c = 0; c < chunks.numberOfChunks; c++)
+  {
+    if (chunk_error[c]) { return 1; }
+  }
+
+  chunks.compute_offsets();
+  if (nbl_merge_periodic_chunks(nl, ws)) { return 1; }
+
+  // ghost coordinates
+  int const numberOfGhosts = nl->numberOfGhosts;
+  nl->ghostCoordinates.resize(3 * numberOfGhosts);
+  for (int g = 0; g < numberOfGhosts; g++)
+  {
+    int const * s = &nl->ghostShift[3 * g];
+    int const master = nl->ghostMaster[g];
+    for (int d = 0; d < 3; d++)
+    {
+      nl->ghostCoordinates[3 * g + d] = coordinates[3 * master + d]
+                                        + s[0] * cell[d] + s[1] * cell[3 + d]
+                                        + s[2] * cell[6 + d];
+    }
+  }
+
+  // ghosts are appended to the particles, and they do not have neighbors
+  int const numberOfAllParticles = numberOfParticles + numberOfGhosts;
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    NeighListOne * cnl = &(nl->lists[k]);
+    nbl_reserve_particles(cnl, numberOfAllParticles, numberOfParticles);
+
+    for (int i = numberOfParticles; i < numberOfAllParticles; i++)
+    {
+      cnl->Nneighbors[i] = 0;
+      cnl->beginIndex[i] = chunks.total[ctx.sharedStorage ? 0 : k];
+    }
+
+    cnl->numberOfParticles = numberOfAllParticles;
+    cnl->cutoff = cutoffs[k];
+  }
+  chunks.shift_begin_index(nl);
+
+  return 0;
+}
+
+
+int nbl_build_periodic(NeighList * const nl,
+                       int const numberOfParticles,
+                       double const * coordinates,
+                       double const * cell,
+                       int const * PBC,
+                       double const influenceDistance,
+                       int const numberOfCutoffs,
+                       double const * cutoffs,
+                       int const * needNeighbors,
+                       int const numberOfThreads)
+{
+  return nbl_build_periodic_with(nl,
+                                 nbl_get_workspace(nl),
+                                 numberOfParticles,
+                                 coordinates,
+                                 cell,
+                                 PBC,
+                                 influenceDistance,
+                                 numberOfCutoffs,
+                                 cutoffs,
+                                 needNeighbors,
+                                 numberOfThreads);
+}
+
+
+int nbl_build_batch(NeighList * const * nl,
+                    int const numberOfConfigurations,
+                    int const * offsets,
+                    double const * coordinates,
+                    double const * cells,
+                    int const * PBCs,
+                    double const influenceDistance,
+                    int const numberOfCutoffs,
+                    double const * cutoffs,
+                    int const * needNeighbors,
+                    int * const errors,
+                    int const numberOfThreads)
+{
+  // The configurations are small, so they are handed out one at a time. The
+  // temporary containers are those of the thread rather than of each list,
+  // so they stay warm in the cache, and the lists do not keep them.
+  std::atomic<int> next_configuration(0);
+  int const threads
+      = get_number_of_threads(numberOfThreads, numberOfConfigurations);
+  std::vector<NeighListWorkspace> workspaces(threads);
+  parallel_run(threads, [&](int const t) {
+    NeighListWorkspace * const ws = &workspaces[t];
+    for (int c = next_configuration++; c < numberOfConfigurations;
+         c = next_configuration++)
+    {
+      int const first = offsets[c];
+      int const numberOfParticles = offsets[c + 1] - first;
+      double const * const coords
+          = coordinates + 3 * static_cast<std::size_t>(first);
+      int const * const need = needNeighbors + first;
+      if (cells)
+      {
+        errors[c]
+            = nbl_build_periodic_with(nl[c],
+                                      ws,
+                                      numberOfParticles,
+                                      coords,
+                                      cells + 9 * static_cast<std::size_t>(c),
+                                      PBCs + 3 * static_cast<std::size_t>(c),
+                                      influenceDistance,
+                                      numberOfCutoffs,
+                                      cutoffs,
+                                      need,
+                                      1);
+      }
+      else
+      {
+        errors[c] = nbl_build_with(nl[c],
+                                   ws,
+                                   numberOfParticles,
+                                   coords,
+                                   influenceDistance,
+                                   numberOfCutoffs,
+                                   cutoffs,
+                                   need,
+                                   1,
+                                   nl[c]->skin);
+      }
+    }
+  });
+
+  for (int c = 0; c < numberOfConfigurations; c++)
+  {
+    if (errors[c]) { return 1; }
+  }
+  return 0;
+}
+
+
+int nbl_get_neigh(void const * const dataObject,
+                  int const numberOfCutoffs,
+                  double const * const cutoffs,
+                  int const neighborListIndex,
+                  int const particleNumber,
+                  int * const numberOfNeighbors,
+                  int const ** const neighborsOfParticle)
+{
+  NeighList * nl = (NeighList *) dataObject;
+
+  if (neighborListIndex >= nl->numberOfNeighborLists) { return 1; }
+
+  // KIM models expect full neighbor lists
+  if (nl->half)
+  {
+    MY_WARNING("A half neighbor list cannot be used in nbl_get_neigh");
+    return 1;
+  }
+
+  NeighListOne const * cnl = &(nl->lists[neighborListIndex]);
+
+  // invalid id
+  int numberOfParticles = cnl->numberOfParticles;
+  if (nl->hasSubset) { numberOfParticles = nl->numberOfAllParticles; }
+  if (nl->numberOfTiles)
+  {
+    numberOfParticles = static_cast<int>(nl->needNeighbors.size());
+  }
+
+  if ((particleNumber >= numberOfParticles) || (particleNumber < 0))
+  {
+    MY_WARNING("Invalid part ID in nbl_get_neigh");
+    return 1;
+  }
+
+  // the lists of a tiled build are those of the tile of the particle, which
+  // is built if it is not yet; the current tile is left as is
+  if (nl->numberOfTiles)
+  {
+    int const tile = particleNumber / nl->builtTileSize;
+    NeighListOne const * const lists = nbl_get_tile(nl, tile);
+    if (!lists) { return 1; }
+    cnl = &lists[neighborListIndex];
+  }
+
+  if (cutoffs[neighborListIndex] > cnl->cutoff + TOL) { return 1; }
+
+  // the row of the particle; a particle outside of the subset has no
+  // neighbors
+  int row = particleNumber;
+  if (nl->hasSubset)
+  {
+    std::vector<int> const & subset = nl->subset;
+    auto const it
+        = std::lower_bound(subset.begin(), subset.end(), particleNumber);
+    if (it == subset.end() || *it != particleNumber)
+    {
+      *numberOfNeighbors = 0;
+      *neighborsOfParticle = cnl->neighborList;
+      return 0;
+    }
+    row = static_cast<int>(it - subset.begin());
+  }
+
+  if (nl->numberOfTiles) { row = particleNumber % nl->builtTileSize; }
+
+  // number of neighbors
+  *numberOfNeighbors = cnl->Nneighbors[row];
+
+  // neighbor list starting point
+  long long idx = cnl->beginIndex[row];
+
+  *neighborsOfParticle = cnl->neighborList + idx;
+
+  return 0;
+}
+
+
+int nbl_plan_paddings(PaddingPlan & plan,
+                      int const numberOfParticles,
+                      double const cutoff,
+                      double const * cell,
+                      int const * PBC,
+                      double const * coordinates)
+{
+  // transform coordinates into fractional coordinates
+  double * const tcell = plan.tcell;
+  double fcell[9];
+
+  transpose(cell, tcell);
+
+  int error = inverse(tcell, fcell);
+  if (error) { return error; }
+
+  std::vector<double> & frac_coords = plan.fracCoordinates;
+  frac_coords.resize(3 * numberOfParticles);
+
+  double min[3] = {1e10, 1e10, 1e10};
+  double max[3] = {-1e10, -1e10, -1e10};
+
+  for (int i = 0; i < numberOfParticles; i++)
+  {
+    const double * atom_coords = coordinates + (3 * i);
+
+    for (int d = 0; d < 3; d++)
+    {
+      double const f = dot(fcell + 3 * d, atom_coords);
+      frac_coords[3 * i + d] = f;
+      if (f < min[d]) { min[d] = f; }
+      if (f > max[d]) { max[d] = f; }
+    }
+  }
+
+  // add some extra value to deal with edge case
+  for (int d = 0; d < 3; d++)
+  {
+    min[d] -= TOL;
+    max[d] += TOL;
+  }
+
+  // volume of cell
+  double xprod[3];
+
+  cross(cell + 3, cell + 6, xprod);
+
+  double volume = std::abs(dot(cell, xprod));
+
+  // distance between parallelpiped cell faces
+  double dist[3];
+
+  cross(cell + 3, cell + 6, xprod);
+  dist[0] = volume / norm(xprod);
+
+  cross(cell + 6, cell + 0, xprod);
+  dist[1] = volume / norm(xprod);
+
+  cross(cell, cell + 3, xprod);
+  dist[2] = volume / norm(xprod);
+
+  // number of cells in each direction
+  double ratio[3];
+  int size[3];
+  double size_ratio_diff[3];
+  for (int d = 0; d < 3; d++)
+  {
+    ratio[d] = cutoff / dist[d];
+    size[d] = static_cast<int>(std::ceil(ratio[d]));
+    size_ratio_diff[d] = static_cast<double>(size[d]) - ratio[d];
+  }
+
+  // Only the particles close enough to the faces of the box are repeated in
+  // the most outside images. Whether a particle is repeated in an image
+  // depends, in each direction d, only on whether the image is the lowest
+  // (class bit 2 * d) and/or the highest (class bit 2 * d + 1) one, so the
+  // particles of the (at most 64) classes of images are listed once.
+  // the follwing few lines can be easily understood when assuming size=1
+  plan.shifts.clear();
+  plan.shiftClass.clear();
+  for (int i = -size[0]; i <= size[0]; i++)
+  {
+    for (int j = -size[1]; j <= size[1]; j++)
+    {
+      for (int k = -size[2]; k <= size[2]; k++)
+      {
+        // skip contributing atoms
+        if (i == 0 && j == 0 && k == 0) { continue; }
+
+        // apply BC
+        if (PBC[0] == 0 && i != 0) { continue; }
+        if (PBC[1] == 0 && j != 0) { continue; }
+        if (PBC[2] == 0 && k != 0) { continue; }
+
+        int const shift[3] = {i, j, k};
+        int image_class = 0;
+        for (int d = 0; d < 3; d++)
+        {
+          if (shift[d] == -size[d]) { image_class |= 1 << (2 * d); }
+          if (shift[d] == size[d]) { image_class |= 1 << (2 * d + 1); }
+        }
+        plan.shifts.insert(plan.shifts.end(), shift, shift + 3);
+        plan.shiftClass.push_back(image_class);
+      }
+    }
+  }
+
+  // whether a particle is repeated in the lowest (bit 2 * d) and the highest
+  // (bit 2 * d + 1) images in direction d
+  std::vector<unsigned char> flags(numberOfParticles, 0);
+  std::vector<int> near_face[6];
+  for (int at = 0; at < numberOfParticles; at++)
+  {
+    for (int d = 0; d < 3; d++)
+    {
+      double const x = frac_coords[3 * at + d];
+      if (!(x - min[d] < size_ratio_diff[d]))
+      {
+        flags[at] |= 1 << (2 * d);
+        near_face[2 * d].push_back(at);
+      }
+      if (!(max[d] - x < size_ratio_diff[d]))
+      {
+        flags[at] |= 1 << (2 * d + 1);
+        near_face[2 * d + 1].push_back(at);
+      }
+    }
+  }
+
+  // The images of class 0 repeat all the particles. For the others, the
+  // particles are selected from the shortest list of particles near a face
+  // that the class requires. The class bits are the same as the flag bits.
+  plan.particlesOfClass.resize(64);
+  std::vector<char> done(64, 0);
+  for (std::size_t s = 0; s < plan.shiftClass.size(); s++)
+  {
+    int const c = plan.shiftClass[s];
+    if (done[c]) { continue; }
+    done[c] = 1;
+
+    std::vector<int> & particles = plan.particlesOfClass[c];
+    particles.clear();
+    if (c == 0) { continue; }
+
+    int shortest = -1;
+    for (int f = 0; f < 6; f++)
+    {
+      if ((c & (1 << f))
+          && (shortest < 0 || near_face[f].size() < near_face[shortest].size()))
+      {
+        shortest = f;
+      }
+    }
+    for (std::size_t m = 0; m < near_face[shortest].size(); m++)
+    {
+      int const at = near_face[shortest][m];
+      if ((flags[at] & c) == c) { particles.push_back(at); }
+    }
+  }
+
+  // counting pass, the paddings of image s start at plan.offsets[s]
+  std::size_t const numberOfShifts = plan.shiftClass.size();
+  plan.offsets.resize(numberOfShifts + 1);
+  plan.offsets[0] = 0;
+  for (std::size_t s = 0; s < numberOfShifts; s++)
+  {
+    int const c = plan.shiftClass[s];
+    plan.offsets[s + 1]
+        = plan.offsets[s]
+          + (c == 0 ? numberOfParticles : plan.particlesOfClass[c].size());
+  }
+
+  if (plan.offsets[numberOfShifts] > 2147483647)
+  {
+    MY_WARNING("Too many paddings.");
+    return 1;
+  }
+  plan.numberOfPaddings = static_cast<int>(plan.offsets[numberOfShifts]);
+
+  return 0;
+}
+
+
+void nbl_fill_paddings(PaddingPlan const & plan,
+                       int const * speciesCode,
+                       double * const coordinatesOfPaddings,
+                       int * const speciesCodeOfPaddings,
+                       int * const masterOfPaddings,
+                       int * const shiftOfPaddings,
+                       int const numberOfThreads)
+{
+  double const * const tcell = plan.tcell;
+  double const * const frac_coords = plan.fracCoordinates.data();
+  int const numberOfShifts = static_cast<int>(plan.shiftClass.size());
+
+  // the images are filled independently
+  std::atomic<int> next_shift(0);
+  int const threads = get_number_of_threads(numberOfThreads, numberOfShifts);
+  parallel_run(threads, [&](int const) {
+    for (int s = next_shift++; s < numberOfShifts; s = next_shift++)
+    {
+      int const * const shift = &plan.shifts[3 * s];
+      int const c = plan.shiftClass[s];
+      std::vector<int> const & particles = plan.particlesOfClass[c];
+      std::size_t const offset = plan.offsets[s];
+      std::size_t const number = plan.offsets[s + 1] - offset;
+
+      for (std::size_t m = 0; m < number; m++)
+      {
+        int const at = c == 0 ? static_cast<int>(m) : particles[m];
+        std::size_t const p = offset + m;
+
+        // fractional coordinates of padding atom at
+        double atom_coords[3] = {shift[0] + frac_coords[3 * at + 0],
+                                 shift[1] + frac_coords[3 * at + 1],
+                                 shift[2] + frac_coords[3 * at + 2]};
+
+        // absolute coordinates of padding atoms
+        coordinatesOfPaddings[3 * p] = dot(tcell, atom_coords);
+        coordinatesOfPaddings[3 * p + 1] = dot(tcell + 3, atom_coords);
+        coordinatesOfPaddings[3 * p + 2] = dot(tcell + 6, atom_coords);
+
+        // padding speciesCode code and image
+        speciesCodeOfPaddings[p] = speciesCode[at];
+        masterOfPaddings[p] = at;
+        if (shiftOfPaddings)
+        {
+          shiftOfPaddings[3 * p] = shift[0];
+          shiftOfPaddings[3 * p + 1] = shift[1];
+          shiftOfPaddings[3 * p + 2] = shift[2];
+        }
+      }
+    }
+  });
+}
+
+
+int nbl_create_paddings(int const numberOfParticles,
+                        double const cutoff,
+                        double const * cell,
+                        int const * PBC,
+                        double const * coordinates,
+                        int const * speciesCode,
+                        int & numberOfPaddings,
+                        std::vector<double> & coordinatesOfPaddings,
+                        std::vector<int> & speciesCodeOfPaddings,
+                        std::vector<int> & masterOfPaddings)
+{
+  PaddingPlan plan;
+  int error = nbl_plan_paddings(
+      plan, numberOfParticles, cutoff, cell, PBC, coordinates);
+  if (error) { return error; }
+
+  numberOfPaddings = plan.numberOfPaddings;
+  coordinatesOfPaddings.resize(3 * numberOfPaddings);
+  speciesCodeOfPaddings.resize(numberOfPaddings);
+  masterOfPaddings.resize(numberOfPaddings);
+
+  nbl_fill_paddings(plan,
+                    speciesCode,
+                    coordinatesOfPaddings.data(),
+                    speciesCodeOfPaddings.data(),
+                    masterOfPaddings.data(),
+                    nullptr,
+                    1);
+
+  return 0;
+}
+
+
+int nbl_build_padded(NeighList * const nl,
+                     int const numberOfParticles,
+                     double const * coordinates,
+                     int const * speciesCode,
+                     double const * cell,
+                     int const * PBC,
+                     double const influenceDistance,
+                     int const numberOfCutoffs,
+                     double const * cutoffs,
+                     int const numberOfThreads)
+{
+  NeighListWorkspace * const ws = nbl_get_workspace(nl);
+  PaddingPlan & plan = ws->paddingPlan;
+  int error = nbl_plan_paddings(
+      plan, numberOfParticles, influenceDistance, cell, PBC, coordinates);
+  if (error) { return error; }
+
+  int const numberOfPaddings = plan.numberOfPaddings;
+  if (static_cast<long long>(numberOfParticles) + numberOfPaddings > 2147483647)
+  {
+    MY_WARNING("Too many paddings.");
+    return 1;
+  }
+  std::size_t const total
+      = static_cast<std::size_t>(numberOfParticles) + numberOfPaddings;
+
+  // The buffers may be viewed by arrays returned from an earlier build, so
+  // they are only reallocated if nothing else refers to them. All of them
+  // have room for the same number of particles and paddings.
+  if (!nl->padded) { nl->padded = std::make_shared<PaddedConfiguration>(); }
+  if (total > nl->padded->speciesCode.capacity())
   {
-    nl->lists = new NeighListOne[numberOfCutoffs];
-    nl->numberOfNeighborLists = numberOfCutoffs;
-    for (int i = 0; i < numberOfCutoffs; i++)
+    if (nl->padded.use_count() > 1)
     {
-      NeighListOne * cnl = &(nl->lists[i]);
-      cnl->Nneighbors = new int[numberOfParticles];
-      cnl->beginIndex = new int[numberOfParticles];
+      nl->padded = std::make_shared<PaddedConfiguration>();
     }
+    std::size_t const capacity = static_cast<std::size_t>(GROWTH * total);
+    nl->padded->coordinates.reserve(3 * capacity);
+    nl->padded->speciesCode.reserve(capacity);
+    nl->padded->needNeighbors.reserve(capacity);
+    nl->padded->masterOfPaddings.reserve(capacity);
+    nl->padded->shiftOfPaddings.reserve(3 * capacity);
   }
-}
-
+  PaddedConfiguration & padded = *nl->padded;
+  padded.numberOfParticles = numberOfParticles;
+  padded.numberOfPaddings = numberOfPaddings;
+  padded.coordinates.resize(3 * total);
+  padded.speciesCode.resize(total);
+  padded.needNeighbors.resize(total);
+  padded.masterOfPaddings.resize(numberOfPaddings);
+  padded.shiftOfPaddings.resize(3 * static_cast<std::size_t>(numberOfPaddings));
 
-void nbl_initialize(NeighList ** const nl) { *nl = new NeighList; }
+  std::memcpy(padded.coordinates.data(),
+              coordinates,
+              sizeof(double) * 3 * numberOfParticles);
+  std::memcpy(
+      padded.speciesCode.data(), speciesCode, sizeof(int) * numberOfParticles);
+  std::fill(padded.needNeighbors.begin(),
+            padded.needNeighbors.begin() + numberOfParticles,
+            1);
+  std::fill(padded.needNeighbors.begin() + numberOfParticles,
+            padded.needNeighbors.end(),
+            0);
 
+  nbl_fill_paddings(plan,
+                    speciesCode,
+                    padded.coordinates.data() + 3 * numberOfParticles,
+                    padded.speciesCode.data() + numberOfParticles,
+                    padded.masterOfPaddings.data(),
+                    padded.shiftOfPaddings.data(),
+                    numberOfThreads);
 
-void nbl_clean(NeighList ** const nl)
-{
-  if (*nl)
+  if (!nl->speciesCutoffs.empty())
   {
-    nbl_clean_content(*nl);
-
-    delete (*nl);
+    nl->speciesCode.assign(padded.speciesCode.begin(),
+                           padded.speciesCode.end());
   }
 
-  // nullify pointer
-  (*nl) = nullptr;
+  // the paddings only cover influenceDistance, so the lists are built
+  // without the skin of nl
+  return nbl_build_with_skin(nl,
+                             static_cast<int>(total),
+                             padded.coordinates.data(),
+                             influenceDistance,
+                             numberOfCutoffs,
+                             cutoffs,
+                             padded.needNeighbors.data(),
+                             numberOfThreads,
+                             0.0);
 }
 
 
-int nbl_build(NeighList * const nl,
-              int const numberOfParticles,
-              double const * coordinates,
-              double const influenceDistance,
-              int const numberOfCutoffs,
-              double const * cutoffs,
-              int const * needNeighbors)
+// spread the lowest 21 bits of x such that there are two 0 bits between them
+static unsigned long long spread_bits(unsigned long long x)
 {
-  // find max and min extend of coordinates
+  x &= 0x1fffffULL;
+  x = (x | x << 32) & 0x1f00000000ffffULL;
+  x = (x | x << 16) & 0x1f0000ff0000ffULL;
+  x = (x | x << 8) & 0x100f00f00f00f00fULL;
+  x = (x | x << 4) & 0x10c30c30c30c30c3ULL;
+  x = (x | x << 2) & 0x1249249249249249ULL;
+  return x;
+}
+
+
+void nbl_get_spatial_order(int const numberOfParticles,
+                           double const * coordinates,
+                           int * const order)
+{
+  if (numberOfParticles <= 0) { return; }
+
   double min[3];
   double max[3];
+  for (int d = 0; d < 3; d++)
+  {
+    min[d] = coordinates[d];
+    max[d] = coordinates[d];
+  }
+  for (int i = 0; i < numberOfParticles; i++)
+  {
+    for (int d = 0; d < 3; d++)
+    {
+      min[d] = std::min(min[d], coordinates[3 * i + d]);
+      max[d] = std::max(max[d], coordinates[3 * i + d]);
+    }
+  }
 
-  // init max and min of coordinates to that of the first atom
-  min[0] = coordinates[0];
-  min[1] = coordinates[1];
-  min[2] = coordinates[2];
-  // +1 to prevent max==min
-  max[0] = coordinates[0] + 1.0;
-  max[1] = coordinates[1] + 1.0;
-  max[2] = coordinates[2] + 1.0;
+  // the same (21 bits) resolution in all directions
+  double extent = std::max(max[0] - min[0], max[1] - min[1]);
+  extent = std::max(extent, max[2] - min[2]);
+  double const scale = extent > 0.0 ? 2097151.0 / extent : 0.0;
 
-  for (int i = 0, l = 0; i < numberOfParticles; i++)
+  std::vector<std::pair<unsigned long long, int> > keys(numberOfParticles);
+  for (int i = 0; i < numberOfParticles; i++)
   {
-    if (max[0] < coordinates[l]) { max[0] = coordinates[l]; }
-    if (min[0] > coordinates[l]) { min[0] = coordinates[l]; }
-    ++l;
-    if (max[1] < coordinates[l]) { max[1] = coordinates[l]; }
-    if (min[1] > coordinates[l]) { min[1] = coordinates[l]; }
-    ++l;
-    if (max[2] < coordinates[l]) { max[2] = coordinates[l]; }
-    if (min[2] > coordinates[l]) { min[2] = coordinates[l]; }
-    ++l;
+    unsigned long long key = 0;
+    for (int d = 0; d < 3; d++)
+    {
+      unsigned long long const q = static_cast<unsigned long long>(
+          (coordinates[3 * i + d] - min[d]) * scale);
+      key |= spread_bits(q) << d;
+    }
+    keys[i] = std::make_pair(key, i);
   }
 
-  // make the cell box
-  int size[3];
+  // ties are broken by the particle index
+  std::sort(keys.begin(), keys.end());
 
-  size[0] = static_cast<int>((max[0] - min[0]) / influenceDistance);
-  size[1] = static_cast<int>((max[1] - min[1]) / influenceDistance);
-  size[2] = static_cast<int>((max[2] - min[2]) / influenceDistance);
+  for (int j = 0; j < numberOfParticles; j++) { order[j] = keys[j].second; }
+}
 
-  if (size[0] <= 0) size[0] = 1;
-  if (size[1] <= 0) size[1] = 1;
-  if (size[2] <= 0) size[2] = 1;
 
-  int size_total = size[0] * size[1] * size[2];
-  if (size_total > 1000000000)
+int nbl_permute(int const numberOfRows,
+                std::size_t const rowSize,
+                int const * order,
+                int const inverse,
+                void * const data)
+{
+  // check that order is a permutation
+  std::vector<char> visited(numberOfRows, 0);
+  for (int j = 0; j < numberOfRows; j++)
   {
-    MY_WARNING("Cell size too large. Check if you have partilces fly away.");
-    return 1;
+    if (order[j] < 0 || order[j] >= numberOfRows || visited[order[j]])
+    {
+      MY_WARNING("\"order\" is not a permutation.");
+      return 1;
+    }
+    visited[order[j]] = 1;
   }
 
-  // assign atoms into cells
-  std::vector<std::vector<int> > cells(size_total);
-  for (int i = 0; i < numberOfParticles; i++)
+  // follow the cycles of the permutation, so only one row is copied aside
+  char * const rows = static_cast<char *>(data);
+  std::vector<char> tmp(rowSize);
+  std::fill(visited.begin(), visited.end(), 0);
+  for (int start = 0; start < numberOfRows; start++)
   {
-    int index[3];
+    if (visited[start]) { continue; }
+
+    std::memcpy(tmp.data(), rows + start * rowSize, rowSize);
+    int j = start;
+    if (inverse)
+    {
+      // move the old row j to row order[j]
+      do
+      {
+        int const k = order[j];
+        std::swap_ranges(tmp.begin(), tmp.end(), rows + k * rowSize);
+        visited[k] = 1;
+        j = k;
+      } while (j != start);
+    }
+    else
+    {
+      // move the old row order[j] to row j
+      while (true)
+      {
+        visited[j] = 1;
+        int const k = order[j];
+        if (k == start) { break; }
+        std::memcpy(rows + j * rowSize, rows + k * rowSize, rowSize);
+        j = k;
+      }
+      std::memcpy(rows + j * rowSize, tmp.data(), rowSize);
+    }
+  }
 
-    coords_to_index(&coordinates[3 * i], size, max, min, index);
+  return 0;
+}
 
-    int const idx
-        = index[0] + index[1] * size[0] + index[2] * size[0] * size[1];
 
-    cells[idx].push_back(i);
-  }
+void nbl_refresh_paddings(int const numberOfPaddings,
+                          double const * cell,
+                          double const * coordinates,
+                          int const * masterOfPaddings,
+                          int const * shiftOfPaddings,
+                          double * const coordinatesOfPaddings,
+                          int const numberOfThreads)
+{
+  int const threads = get_number_of_threads(numberOfThreads, numberOfPaddings);
+  parallel_run(threads, [&](int const t) {
+    int const begin = static_cast<int>(static_cast<long long>(numberOfPaddings)
+                                       * t / threads);
+    int const end = static_cast<int>(static_cast<long long>(numberOfPaddings)
+                                     * (t + 1) / threads);
+    for (int p = begin; p < end; p++)
+    {
+      double const * const x = coordinates + 3 * masterOfPaddings[p];
+      int const * const s = shiftOfPaddings + 3 * p;
+      for (int d = 0; d < 3; d++)
+      {
+        coordinatesOfPaddings[3 * p + d]
+            = x[d] + s[0] * cell[d] + s[1] * cell[3 + d] + s[2] * cell[6 + d];
+      }
+    }
+  });
+}
 
-  // create neighbors
 
-  // free previous neigh content and then create new
-  nbl_clean_content(nl);
-  nbl_allocate_memory(nl, numberOfCutoffs, numberOfParticles);
+void nbl_fold_paddings(int const numberOfParticles,
+                       int const numberOfPaddings,
+                       int const * masterOfPaddings,
+                       int const numberOfArrays,
+                       double * const * arrays,
+                       int const * numberOfColumns,
+                       int const numberOfThreads)
+{
+  // add the values of padding p to those of particle i
+  auto fold = [&](int const i, int const p) {
+    for (int a = 0; a < numberOfArrays; a++)
+    {
+      int const columns = numberOfColumns[a];
+      double * const target = arrays[a] + static_cast<std::size_t>(columns) * i;
+      double const * const source
+          = arrays[a]
+            + static_cast<std::size_t>(columns) * (numberOfParticles + p);
+      for (int d = 0; d < columns; d++) { target[d] += source[d]; }
+    }
+  };
 
-  std::vector<double> cutsqs(numberOfCutoffs);
-  for (int i = 0; i < numberOfCutoffs; i++)
+  int const threads = get_number_of_threads(numberOfThreads, numberOfParticles);
+  if (threads == 1)
   {
-    cutsqs[i] = cutoffs[i] * cutoffs[i];
+    for (int p = 0; p < numberOfPaddings; p++) { fold(masterOfPaddings[p], p); }
+    return;
   }
 
-  // temporary neigh container
-  std::vector<std::vector<int> > tmp_neigh(numberOfCutoffs);
-  std::vector<int> total(numberOfCutoffs, 0);
-  std::vector<int> num_neigh(numberOfCutoffs);
-
+  // The paddings of particle i are paddingsOf[paddingsBegin[i] :
+  // paddingsBegin[i + 1]], in increasing order, so the particles can be split
+  // across the threads without two threads writing to the same particle.
+  std::vector<int> paddingsBegin(numberOfParticles + 1, 0);
+  for (int p = 0; p < numberOfPaddings; p++)
+  {
+    paddingsBegin[masterOfPaddings[p] + 1]++;
+  }
   for (int i = 0; i < numberOfParticles; i++)
   {
-    for (int k = 0; k < numberOfCutoffs; k++) { num_neigh[k] = 0; }
+    paddingsBegin[i + 1] += paddingsBegin[i];
+  }
+  std::vector<int> paddingsOf(numberOfPaddings);
+  std::vector<int> next(paddingsBegin.begin(), paddingsBegin.end() - 1);
+  for (int p = 0; p < numberOfPaddings; p++)
+  {
+    paddingsOf[next[masterOfPaddings[p]]++] = p;
+  }
 
-    if (needNeighbors[i])
+  parallel_run(threads, [&](int const t) {
+    int const begin = static_cast<int>(static_cast<long long>(numberOfParticles)
+                                       * t / threads);
+    int const end = static_cast<int>(static_cast<long long>(numberOfParticles)
+                                     * (t + 1) / threads);
+    for (int i = begin; i < end; i++)
     {
-      double const coordinates_i_x = coordinates[3 * i];
-      double const coordinates_i_y = coordinates[3 * i + 1];
-      double const coordinates_i_z = coordinates[3 * i + 2];
-
-      int index[3];
-      coords_to_index(&coordinates[3 * i], size, max, min, index);
-
-      // loop over neighborling cells and the cell atom i resides
-      for (int ii = std::max(0, index[0] - 1);
-           ii <= std::min(index[0] + 1, size[0] - 1);
-           ii++)
+      for (int m = paddingsBegin[i]; m < paddingsBegin[i + 1]; m++)
       {
-        for (int jj = std::max(0, index[1] - 1);
-             jj <= std::min(index[1] + 1, size[1] - 1);
-             jj++)
-        {
-          for (int kk = std::max(0, index[2] - 1);
-               kk <= std::min(index[2] + 1, size[2] - 1);
-               kk++)
-          {
-            int const idx = ii + jj * size[0] + kk * size[0] * size[1];
-
-            for (std::size_t m = 0; m < cells[idx].size(); m++)
-            {
-              int n = cells[idx][m];
-              if (n != i)
-              {
-                double const dx = coordinates[3 * n] - coordinates_i_x;
-                double const dy = coordinates[3 * n + 1] - coordinates_i_y;
-                double const dz = coordinates[3 * n + 2] - coordinates_i_z;
-                double const rsq = dx * dx + dy * dy + dz * dz;
-
-                if (rsq < TOL)
-                {
-                  std::ostringstream stringStream;
-                  stringStream << "Collision of atoms " << i + 1 << " and "
-                               << n + 1 << ". ";
-                  stringStream << "Their distance is " << std::sqrt(rsq) << "."
-                               << std::endl;
-                  std::string my_str = stringStream.str();
-                  MY_WARNING(my_str);
-                  return 1;
-                }
-                for (int k = 0; k < numberOfCutoffs; k++)
-                {
-                  if (rsq < cutsqs[k])
-                  {
-                    tmp_neigh[k].push_back(n);
-                    num_neigh[k]++;
-                  }
-                }
-              }
-            }
-          }
-        }
+        fold(i, paddingsOf[m]);
       }
     }
+  });
+}
 
-    for (int k = 0; k < numberOfCutoffs; k++)
+
+// the indices of the cell of edge cellSize at `position`; returns 1 if they
+// cannot be packed by CellGrid::pack
+static int nbl_cell_of_position(double const * position,
+                                double const cellSize,
+                                int * const index)
+{
+  for (int d = 0; d < 3; d++)
+  {
+    double const c = std::floor(position[d] / cellSize);
+    if (!(std::abs(c) < SPARSE_MAX_SIZE / 2))
     {
-      nl->lists[k].Nneighbors[i] = num_neigh[k];
-      nl->lists[k].beginIndex[i] = total[k];
-      total[k] += num_neigh[k];
+      MY_WARNING("Cell size too large. Check if you have partilces fly away.");
+      return 1;
     }
+    index[d] = static_cast<int>(c) + SPARSE_MAX_SIZE / 2;
   }
+  return 0;
+}
 
-  for (int k = 0; k < numberOfCutoffs; k++)
+
+// call func(j) for the particles j in the 27 cells around cell `index`, or
+// only in those not around cell `skip` if it is not nullptr
+template<typename Function>
+static void nbl_for_particles_near(NeighListMoves const & moves,
+                                   int const * index,
+                                   int const * skip,
+                                   Function const & func)
+{
+  for (int i = index[0] - 1; i <= index[0] + 1; i++)
   {
-    nl->lists[k].numberOfParticles = numberOfParticles;
-    nl->lists[k].cutoff = cutoffs[k];
-    nl->lists[k].neighborList = new int[total[k]];
-    std::memcpy(
-        nl->lists[k].neighborList, tmp_neigh[k].data(), sizeof(int) * total[k]);
-  }
+    for (int j = index[1] - 1; j <= index[1] + 1; j++)
+    {
+      for (int k = index[2] - 1; k <= index[2] + 1; k++)
+      {
+        if (skip && std::abs(i - skip[0]) <= 1 && std::abs(j - skip[1]) <= 1
+            && std::abs(k - skip[2]) <= 1)
+        {
+          continue;
+        }
 
-  return 0;
+        auto const it = moves.cells.find(CellGrid::pack(i, j, k));
+        if (it == moves.cells.end()) { continue; }
+        for (int const particle : it->second) { func(particle); }
+      }
+    }
+  }
 }
 
 
-int nbl_get_neigh(void const * const dataObject,
-                  int const numberOfCutoffs,
-                  double const * const cutoffs,
-                  int const neighborListIndex,
-                  int const particleNumber,
-                  int * const numberOfNeighbors,
-                  int const ** const neighborsOfParticle)
+// move particle p from the cell at `from` to the cell at `to`
+static void nbl_move_between_cells(NeighListMoves & moves,
+                                   int const p,
+                                   int const * from,
+                                   int const * to)
 {
-  NeighList * nl = (NeighList *) dataObject;
+  if (from[0] == to[0] && from[1] == to[1] && from[2] == to[2]) { return; }
 
-  if (neighborListIndex >= nl->numberOfNeighborLists) { return 1; }
+  auto const it = moves.cells.find(CellGrid::pack(from[0], from[1], from[2]));
+  std::vector<int> & particles = it->second;
+  *std::find(particles.begin(), particles.end(), p) = particles.back();
+  particles.pop_back();
+  if (particles.empty()) { moves.cells.erase(it); }
 
-  NeighListOne * cnl = &(nl->lists[neighborListIndex]);
+  moves.cells[CellGrid::pack(to[0], to[1], to[2])].push_back(p);
+}
 
-  if (cutoffs[neighborListIndex] > cnl->cutoff + TOL) { return 1; }
 
-  // invalid id
-  int numberOfParticles = cnl->numberOfParticles;
+// whether list k is built for particle i
+static int nbl_has_list(NeighList const * const nl, int const i, int const k)
+{ return nl->needNeighbors[i] || (!nl->hints.empty() && !nl->hints[k]); }
 
-  if ((particleNumber >= numberOfParticles) || (particleNumber < 0))
+
+// bin the particles and lay out the lists with room for more neighbors
+static int nbl_activate_moves(NeighList * const nl,
+                              int const numberOfParticles,
+                              double const * coordinates)
+{
+  if (nl->half || nl->sharedStorage || nl->storeDistances || nl->numberOfTiles)
   {
-    MY_WARNING("Invalid part ID in nbl_get_neigh");
+    MY_WARNING("Particles cannot be moved in half neighbor lists, or in "
+               "lists with shared storage, stored distances or tiles.");
     return 1;
   }
 
-  // number of neighbors
-  *numberOfNeighbors = cnl->Nneighbors[particleNumber];
+  if (!nl->moves) { nl->moves = new NeighListMoves; }
+  NeighListMoves & moves = *nl->moves;
 
-  // neighbor list starting point
-  int idx = cnl->beginIndex[particleNumber];
+  moves.cellSize = 0.0;
+  for (int k = 0; k < nl->numberOfNeighborLists; k++)
+  {
+    moves.cellSize = std::max(moves.cellSize, nl->lists[k].cutoff);
+  }
+  if (!(moves.cellSize > 0.0)) { moves.cellSize = 1.0; }
 
-  *neighborsOfParticle = cnl->neighborList + idx;
+  moves.cells.clear();
+  for (int i = 0; i < numberOfParticles; i++)
+  {
+    int index[3];
+    if (nbl_cell_of_position(coordinates + 3 * i, moves.cellSize, index))
+    {
+      return 1;
+    }
+    moves.cells[CellGrid::pack(index[0], index[1], index[2])].push_back(i);
+  }
+
+  moves.capacity.resize(nl->numberOfNeighborLists);
+  for (int k = 0; k < nl->numberOfNeighborLists; k++)
+  {
+    NeighListOne * const cnl = &(nl->lists[k]);
+    std::vector<int> & capacity = moves.capacity[k];
+    capacity.resize(numberOfParticles);
+
+    long long size = 0;
+    for (int i = 0; i < numberOfParticles; i++)
+    {
+      capacity[i] = cnl->Nneighbors[i] + cnl->Nneighbors[i] / 4 + 2;
+      size += capacity[i];
+    }
+    long long const list_capacity = size;
+    std::shared_ptr<int> owner;
+    int * const neighborList = nbl_new_array(owner, list_capacity);
+    long long begin = 0;
+    for (int i = 0; i < numberOfParticles; i++)
+    {
+      std::memcpy(neighborList + begin,
+                  cnl->neighborList + cnl->beginIndex[i],
+                  sizeof(int) * cnl->Nneighbors[i]);
+      cnl->beginIndex[i] = begin;
+      begin += capacity[i];
+    }
+    cnl->neighborListOwner = owner;
+    cnl->neighborList = neighborList;
+    cnl->neighborListCapacity = list_capacity;
+    cnl->neighborListSize = list_capacity;
+  }
 
+  moves.lastParticle = -1;
+  moves.active = 1;
   return 0;
 }
 
 
-int nbl_create_paddings(int const numberOfParticles,
-                        double const cutoff,
-                        double const * cell,
-                        int const * PBC,
-                        double const * coordinates,
-                        int const * speciesCode,
-                        int & numberOfPaddings,
-                        std::vector<double> & coordinatesOfPaddings,
-                        std::vector<int> & speciesCodeOfPaddings,
-                        std::vector<int> & masterOfPaddings)
+// save list k of particle i, which is about to be changed by a move
+static void nbl_save_list(NeighList * const nl, int const k, int const i)
 {
-  // transform coordinates into fractional coordinates
-  double tcell[9];
-  double fcell[9];
-
-  transpose(cell, tcell);
-
-  int error = inverse(tcell, fcell);
-  if (error) { return error; }
+  NeighListMoves & moves = *nl->moves;
+  NeighListOne const * const cnl = &(nl->lists[k]);
+  int const * const neighbors = cnl->neighborList + cnl->beginIndex[i];
 
-  double frac_coords[3 * numberOfParticles];
+  NeighListMoves::SavedList saved;
+  saved.list = k;
+  saved.particle = i;
+  saved.beginIndex = cnl->beginIndex[i];
+  saved.numberOfNeighbors = cnl->Nneighbors[i];
+  saved.capacity = moves.capacity[k][i];
+  saved.offset = moves.savedNeighbors.size();
+  moves.savedLists.push_back(saved);
+  moves.savedNeighbors.insert(
+      moves.savedNeighbors.end(), neighbors, neighbors + cnl->Nneighbors[i]);
+}
 
-  double min[3] = {1e10, 1e10, 1e10};
-  double max[3] = {-1e10, -1e10, -1e10};
 
-  for (int i = 0; i < numberOfParticles; i++)
-  {
-    const double * atom_coords = coordinates + (3 * i);
+// make room for `number` neighbors of particle i in list k, moving them to
+// the end of neighborList if needed
+static void nbl_reserve_moved_list(NeighList * const nl,
+                                   int const k,
+                                   int const i,
+                                   int const number)
+{
+  NeighListOne * const cnl = &(nl->lists[k]);
+  int & capacity = nl->moves->capacity[k][i];
+  if (number <= capacity) { return; }
 
-    double x = dot(fcell, atom_coords);
-    double y = dot(fcell + 3, atom_coords);
-    double z = dot(fcell + 6, atom_coords);
+  capacity = number + number / 4 + 2;
+  long long const begin = cnl->neighborListSize;
+  nbl_reserve(cnl->neighborList,
+              cnl->neighborListOwner,
+              cnl->neighborListCapacity,
+              begin + capacity,
+              begin,
+              GROWTH);
+  std::memcpy(cnl->neighborList + begin,
+              cnl->neighborList + cnl->beginIndex[i],
+              sizeof(int) * cnl->Nneighbors[i]);
+  cnl->beginIndex[i] = begin;
+  cnl->neighborListSize = begin + capacity;
+}
 
-    frac_coords[3 * i + 0] = x;
-    frac_coords[3 * i + 1] = y;
-    frac_coords[3 * i + 2] = z;
 
-    if (x < min[0]) { min[0] = x; }
-    if (y < min[1]) { min[1] = y; }
-    if (z < min[2]) { min[2] = z; }
-    if (x > max[0]) { max[0] = x; }
-    if (y > max[1]) { max[1] = y; }
-    if (z > max[2]) { max[2] = z; }
+int nbl_move_particle(NeighList * const nl,
+                      int const numberOfParticles,
+                      double * const coordinates,
+                      int const particle,
+                      double const * position)
+{
+  if ((nl->lists == nullptr)
+      || (static_cast<int>(nl->needNeighbors.size()) != numberOfParticles)
+      || (particle < 0) || (particle >= numberOfParticles))
+  {
+    MY_WARNING("Neighbor list to update is not built by nbl_build with the "
+               "same number of particles, or the particle is invalid.");
+    return 1;
   }
 
-  // add some extra value to deal with edge case
-  min[0] -= TOL;
-  min[1] -= TOL;
-  min[2] -= TOL;
-  max[0] += TOL;
-  max[1] += TOL;
-  max[2] += TOL;
-
-  // volume of cell
-  double xprod[3];
+  // the moves change the lists in place
+  nbl_detach_views(nl, 1);
 
-  cross(cell + 3, cell + 6, xprod);
+  if (!nl->moves || !nl->moves->active)
+  {
+    int const error = nbl_activate_moves(nl, numberOfParticles, coordinates);
+    if (error) { return error; }
+  }
+  NeighListMoves & moves = *nl->moves;
+  int const numberOfCutoffs = nl->numberOfNeighborLists;
+  double * const x = coordinates + 3 * particle;
 
-  double volume = std::abs(dot(cell, xprod));
+  int from[3];
+  int to[3];
+  if (nbl_cell_of_position(x, moves.cellSize, from)
+      || nbl_cell_of_position(position, moves.cellSize, to))
+  {
+    return 1;
+  }
 
-  // distance between parallelpiped cell faces
-  double dist[3];
+  // the squared distance rsq between the particle and j as seen by the
+  // lists, i.e. infinite beyond the cutoff of their species pair
+  auto const pair_rsq = [&](int const j, double const rsq) {
+    if (nl->speciesCutoffs.empty()) { return rsq; }
+    double const cutoff
+        = nl->speciesCutoffs[nl->numberOfSpecies * nl->speciesCode[particle]
+                             + nl->speciesCode[j]]
+          + nl->builtSkin;
+    return rsq < cutoff * cutoff ? rsq : HUGE_VAL;
+  };
 
-  cross(cell + 3, cell + 6, xprod);
-  dist[0] = volume / norm(xprod);
+  // the particles near the new position, checked for collisions before
+  // anything is changed
+  moves.candidates.clear();
+  moves.candidateRsqs.clear();
+  int collision = -1;
+  nbl_for_particles_near(moves, to, nullptr, [&](int const j) {
+    if (j == particle) { return; }
+    double const * const y = coordinates + 3 * j;
+    double const dx = y[0] - position[0];
+    double const dy = y[1] - position[1];
+    double const dz = y[2] - position[2];
+    double const rsq = dx * dx + dy * dy + dz * dz;
+    if (rsq < TOL) { collision = j; }
+    moves.candidates.push_back(j);
+    moves.candidateRsqs.push_back(pair_rsq(j, rsq));
+  });
+  if (collision >= 0)
+  {
+    double const * const y = coordinates + 3 * collision;
+    double const dx = y[0] - position[0];
+    double const dy = y[1] - position[1];
+    double const dz = y[2] - position[2];
+    nbl_report_collision(particle, collision, dx * dx + dy * dy + dz * dz);
+    return 1;
+  }
 
-  cross(cell + 6, cell + 0, xprod);
-  dist[1] = volume / norm(xprod);
+  moves.lastParticle = particle;
+  std::copy(x, x + 3, moves.lastPosition);
+  moves.savedLists.clear();
+  moves.savedNeighbors.clear();
+  moves.savedListSize.resize(numberOfCutoffs);
+  for (int k = 0; k < numberOfCutoffs; k++)
+  {
+    moves.savedListSize[k] = nl->lists[k].neighborListSize;
+  }
 
-  cross(cell, cell + 3, xprod);
-  dist[2] = volume / norm(xprod);
+  // p is removed from or added to the list of j, if it leaves or enters it
+  auto update_list_of = [&](int const j, double const new_rsq) {
+    double const * const y = coordinates + 3 * j;
+    double const dx = y[0] - x[0];
+    double const dy = y[1] - x[1];
+    double const dz = y[2] - x[2];
+    double const old_rsq = pair_rsq(j, dx * dx + dy * dy + dz * dz);
 
-  // number of cells in each direction
-  double const ratio[3]
-      = {cutoff / dist[0], cutoff / dist[1], cutoff / dist[2]};
+    for (int k = 0; k < numberOfCutoffs; k++)
+    {
+      if (!nbl_has_list(nl, j, k)) { continue; }
 
-  int const size[3] = {static_cast<int>(std::ceil(ratio[0])),
-                       static_cast<int>(std::ceil(ratio[1])),
-                       static_cast<int>(std::ceil(ratio[2]))};
+      NeighListOne * const cnl = &(nl->lists[k]);
+      double const cutsq = cnl->cutoff * cnl->cutoff;
+      bool const was_neighbor = old_rsq < cutsq;
+      bool const is_neighbor = new_rsq < cutsq;
+      if (was_neighbor == is_neighbor) { continue; }
 
-  double const size_ratio_diff_x = static_cast<double>(size[0]) - ratio[0];
-  double const size_ratio_diff_y = static_cast<double>(size[1]) - ratio[1];
-  double const size_ratio_diff_z = static_cast<double>(size[2]) - ratio[2];
+      nbl_save_list(nl, k, j);
+      if (is_neighbor)
+      {
+        nbl_reserve_moved_list(nl, k, j, cnl->Nneighbors[j] + 1);
+        cnl->neighborList[cnl->beginIndex[j] + cnl->Nneighbors[j]] = particle;
+        cnl->Nneighbors[j]++;
+      }
+      else
+      {
+        int * const neighbors = cnl->neighborList + cnl->beginIndex[j];
+        int const last = --cnl->Nneighbors[j];
+        *std::find(neighbors, neighbors + last, particle) = neighbors[last];
+      }
+    }
+  };
 
+  for (std::size_t m = 0; m < moves.candidates.size(); m++)
+  {
+    update_list_of(moves.candidates[m], moves.candidateRsqs[m]);
+  }
+  // the particles near the old position only, which are not neighbors any
+  // more
+  nbl_for_particles_near(moves, from, to, [&](int const j) {
+    if (j != particle) { update_list_of(j, moves.cellSize * moves.cellSize); }
+  });
 
-  // creating padding atoms
-  for (int i = -size[0]; i <= size[0]; i++)
+  // the lists of the particle itself
+  for (int k = 0; k < numberOfCutoffs; k++)
   {
-    for (int j = -size[1]; j <= size[1]; j++)
+    if (nbl_has_list(nl, particle, k))
     {
-      for (int k = -size[2]; k <= size[2]; k++)
-      {
-        // skip contributing atoms
-        if (i == 0 && j == 0 && k == 0) { continue; }
+      NeighListOne * const cnl = &(nl->lists[k]);
+      double const cutsq = cnl->cutoff * cnl->cutoff;
 
-        // apply BC
-        if (PBC[0] == 0 && i != 0) { continue; }
-        if (PBC[1] == 0 && j != 0) { continue; }
-        if (PBC[2] == 0 && k != 0) { continue; }
+      int number = 0;
+      for (std::size_t m = 0; m < moves.candidateRsqs.size(); m++)
+      {
+        if (moves.candidateRsqs[m] < cutsq) { number++; }
+      }
 
-        for (int at = 0; at < numberOfParticles; at++)
+      nbl_save_list(nl, k, particle);
+      nbl_reserve_moved_list(nl, k, particle, number);
+      int * const neighbors = cnl->neighborList + cnl->beginIndex[particle];
+      number = 0;
+      for (std::size_t m = 0; m < moves.candidates.size(); m++)
+      {
+        if (moves.candidateRsqs[m] < cutsq)
         {
-          double const x = frac_coords[3 * at + 0];
-          double const y = frac_coords[3 * at + 1];
-          double const z = frac_coords[3 * at + 2];
-
-          // select the necessary atoms to repeate for the most outside bins
-          // the follwing few lines can be easily understood when assuming
-          // size=1
-          if (i == -size[0] && x - min[0] < size_ratio_diff_x) { continue; }
-          if (i == size[0] && max[0] - x < size_ratio_diff_x) { continue; }
-          if (j == -size[1] && y - min[1] < size_ratio_diff_y) { continue; }
-          if (j == size[1] && max[1] - y < size_ratio_diff_y) { continue; }
-          if (k == -size[2] && z - min[2] < size_ratio_diff_z) { continue; }
-          if (k == size[2] && max[2] - z < size_ratio_diff_z) { continue; }
-
-          // fractional coordinates of padding atom at
-          double atom_coords[3] = {i + x, j + y, k + z};
-
-          // absolute coordinates of padding atoms
-          coordinatesOfPaddings.push_back(dot(tcell, atom_coords));
-          coordinatesOfPaddings.push_back(dot(tcell + 3, atom_coords));
-          coordinatesOfPaddings.push_back(dot(tcell + 6, atom_coords));
-
-          // padding speciesCode code and image
-          speciesCodeOfPaddings.push_back(speciesCode[at]);
-          masterOfPaddings.push_back(at);
+          neighbors[number++] = moves.candidates[m];
         }
       }
+      cnl->Nneighbors[particle] = number;
     }
   }
 
-  numberOfPaddings = static_cast<int>(masterOfPaddings.size());
+  nbl_move_between_cells(moves, particle, from, to);
+  std::copy(position, position + 3, x);
+  if (nl->builtSkin > 0.0)
+  {
+    std::copy(position, position + 3, &nl->referenceCoordinates[3 * particle]);
+  }
+
+  return 0;
+}
+
+
+int nbl_undo_move(NeighList * const nl,
+                  int const numberOfParticles,
+                  double * const coordinates)
+{
+  if (!nl->moves || !nl->moves->active || nl->moves->lastParticle < 0
+      || static_cast<int>(nl->needNeighbors.size()) != numberOfParticles)
+  {
+    MY_WARNING("There is no move to undo.");
+    return 1;
+  }
+  nbl_detach_views(nl, 1);
+  NeighListMoves & moves = *nl->moves;
+  int const particle = moves.lastParticle;
+  double * const x = coordinates + 3 * particle;
+
+  // restore the lists in reverse order of saving
+  for (std::size_t s = moves.savedLists.size(); s-- > 0;)
+  {
+    NeighListMoves::SavedList const & saved = moves.savedLists[s];
+    NeighListOne * const cnl = &(nl->lists[saved.list]);
+    cnl->beginIndex[saved.particle] = saved.beginIndex;
+    cnl->Nneighbors[saved.particle] = saved.numberOfNeighbors;
+    moves.capacity[saved.list][saved.particle] = saved.capacity;
+    std::memcpy(cnl->neighborList + saved.beginIndex,
+                moves.savedNeighbors.data() + saved.offset,
+                sizeof(int) * saved.numberOfNeighbors);
+  }
+  for (int k = 0; k < nl->numberOfNeighborLists; k++)
+  {
+    nl->lists[k].neighborListSize = moves.savedListSize[k];
+  }
+
+  int from[3];
+  int to[3];
+  nbl_cell_of_position(x, moves.cellSize, from);
+  nbl_cell_of_position(moves.lastPosition, moves.cellSize, to);
+  nbl_move_between_cells(moves, particle, from, to);
+  std::copy(moves.lastPosition, moves.lastPosition + 3, x);
+  if (nl->builtSkin > 0.0)
+  {
+    std::copy(x, x + 3, &nl->referenceCoordinates[3 * particle]);
+  }
 
+  moves.lastParticle = -1;
   return 0;
 }
@@ -3,15 +3,84 @@
 #ifndef NEIGHBOR_LIST_H_
 #define NEIGHBOR_LIST_H_
 
+#include <cstddef>
+#include <memory>
+#include <string>
 #include <vector>
 
+// The neighbors of particle i are neighborList[beginIndex[i] : beginIndex[i]
+// + Nneighbors[i]]. The particle indices are 32-bit, while the offsets into
+// neighborList (and its size) are 64-bit, so a list can hold more than 2^31
+// entries, e.g. for large cutoffs of millions of particles.
 struct NeighListOne
 {
   int numberOfParticles = 0;
   double cutoff = 0.0;
   int * Nneighbors = nullptr;
   int * neighborList = nullptr;
-  int * beginIndex = nullptr;
+  long long * beginIndex = nullptr;
+  // number of entries in neighborList
+  long long neighborListSize = 0;
+  // allocated length of Nneighbors and beginIndex, and of neighborList
+  int particleCapacity = 0;
+  long long neighborListCapacity = 0;
+  // nonzero if neighborList is owned by another list (see sharedStorage)
+  int sharesNeighborList = 0;
+  // if NeighList::storeDistances, the displacement (3 per entry) from the
+  // particle to the neighbor, and the distance between them, of each entry
+  // of neighborList; allocated length is pairDataCapacity entries
+  double * neighborDisplacements = nullptr;
+  double * neighborDistances = nullptr;
+  long long pairDataCapacity = 0;
+  // The owners of the arrays above, which are shared with the NumPy views of
+  // the Python binding: the arrays still used by a view when the list is
+  // rebuilt or moved are left to it, and the list writes into new ones. Null
+  // for the arrays owned by another list (see sharesNeighborList).
+  std::shared_ptr<int> NneighborsOwner;
+  std::shared_ptr<int> neighborListOwner;
+  std::shared_ptr<long long> beginIndexOwner;
+  std::shared_ptr<double> neighborDisplacementsOwner;
+  std::shared_ptr<double> neighborDistancesOwner;
+};
+
+// temporary containers kept between builds, defined in neighbor_list.cpp
+struct NeighListWorkspace;
+
+// state of the single-particle moves of nbl_move_particle, defined in
+// neighbor_list.cpp
+struct NeighListMoves;
+
+// the lists of the tiles of a tiled build, defined in neighbor_list.cpp
+struct NeighListTiles;
+
+// the particles of a periodic configuration followed by their paddings, as
+// created by nbl_build_padded: the first numberOfParticles entries of each
+// array are the particles, and the rest are the paddings
+struct PaddedConfiguration
+{
+  int numberOfParticles = 0;
+  int numberOfPaddings = 0;
+  std::vector<double> coordinates;
+  std::vector<int> speciesCode;
+  // 1 for the particles and 0 for the paddings
+  std::vector<int> needNeighbors;
+  // master particle and shift (3 per padding) of each padding
+  std::vector<int> masterOfPaddings;
+  std::vector<int> shiftOfPaddings;
+};
+
+// how the particles are binned into cells of the influence distance
+enum NeighListEngine {
+  // NBL_ENGINE_BRUTE for a few particles (at most 256), otherwise
+  // NBL_ENGINE_SPARSE if most cells of the bounding box would be empty, and
+  // otherwise NBL_ENGINE_DENSE
+  NBL_ENGINE_AUTO = 0,
+  // all the cells of the bounding box of the particles
+  NBL_ENGINE_DENSE = 1,
+  // only the occupied cells, found through a hash map
+  NBL_ENGINE_SPARSE = 2,
+  // no cells: all the pairs of particles are checked
+  NBL_ENGINE_BRUTE = 3
 };
 
 // neighbor list structure
@@ -19,10 +88,188 @@ struct NeighList
 {
   int numberOfNeighborLists = 0;
   NeighListOne * lists = nullptr;
+
+  // periodic images referenced by a list from nbl_build_periodic. Ghost g is
+  // particle `numberOfParticles + g` in the neighbor list, and it is the
+  // image of particle ghostMaster[g] shifted by ghostShift[3*g : 3*g+3] cell
+  // vectors. The ghosts are numbered in the order they are first found by a
+  // serial build, whatever the number of threads.
+  int numberOfGhosts = 0;
+  std::vector<int> ghostMaster;
+  std::vector<int> ghostShift;
+  std::vector<double> ghostCoordinates;
+
+  // If nonzero, nbl_build and nbl_build_periodic create half neighbor lists,
+  // where a pair of particles is stored only once. Such lists are not
+  // served by nbl_get_neigh, since KIM models expect full lists.
+  int half = 0;
+
+  // If nonzero, the lists of all cutoffs share one neighborList. The
+  // neighbors of a particle are ordered by distance shells, such that its
+  // neighbors within a cutoff are a prefix of its neighbors within any
+  // larger cutoff; the lists only differ in Nneighbors. The storage is owned
+  // by the list of the largest cutoff.
+  int sharedStorage = 0;
+
+  // If nonzero, nbl_build and nbl_build_periodic also store the displacement
+  // and distance of each neighbor pair (see NeighListOne). They are those of
+  // the last build, so they are not updated if nbl_update does not rebuild.
+  int storeDistances = 0;
+
+  // If positive, the largest number of neighbors a build may store in one
+  // neighborList; a build that needs more fails instead of allocating them.
+  // A build also fails if its neighbors do not fit in the address space.
+  long long maxListSize = 0;
+
+  // If not empty, the neighbor list hint of each cutoff from the model
+  // ("model will not request neighbors of noncontributing particles"). List k
+  // is built only for the particles that need neighbors if hints[k] is
+  // nonzero, and for all the particles otherwise. If empty, all the lists are
+  // built only for the particles that need neighbors. Not used by half lists.
+  std::vector<int> hints;
+
+  // If not empty, the cutoff of each pair of species, where speciesCutoffs
+  // [a * numberOfSpecies + b] (symmetric) is that of species a and b, and
+  // speciesCode[i] (in [0, numberOfSpecies)) is the species of particle i. A
+  // pair of particles is then only in list k if it is within both cutoffs[k]
+  // and the cutoff of its species (each plus the skin). nbl_build_padded sets
+  // speciesCode to the species of the particles and paddings.
+  int numberOfSpecies = 0;
+  std::vector<double> speciesCutoffs;
+  std::vector<int> speciesCode;
+
+  // the NeighListEngine of nbl_build and nbl_build_periodic
+  int engine = NBL_ENGINE_AUTO;
+
+  // Edge length of the cells of nbl_build and nbl_build_periodic, in units of
+  // the influence distance, in (0, 1]. Smaller cells cover the sphere of the
+  // influence distance more closely, so fewer pairs are checked, but more
+  // cells are visited; e.g. 0.5 pays off for dense systems with many
+  // neighbors per particle.
+  double binSizeFactor = 1.0;
+
+  // Verlet skin. nbl_build creates the lists with `cutoffs + skin`, and
+  // nbl_update only rebuilds them once a particle has moved more than
+  // `skin / 2` from its position at the last build. nbl_build_padded does not
+  // use it, as the paddings only cover the influence distance.
+  double skin = 0.0;
+
+  // If nonzero, the lists of the last build (by nbl_build_subset) are only
+  // those of the particles subset[0] < subset[1] < ... out of
+  // numberOfAllParticles particles, and row r of each list (its Nneighbors
+  // and beginIndex) holds particle subset[r]. Otherwise, row i holds
+  // particle i.
+  int hasSubset = 0;
+  int numberOfAllParticles = 0;
+  std::vector<int> subset;
+
+  // If positive, nbl_build only bins the particles, and the lists are built
+  // per tile of tileSize consecutive particles: tile t is particles
+  // [t * tileSize, (t + 1) * tileSize), and row r of its lists holds particle
+  // t * tileSize + r. A tile is built the first time nbl_get_tile (or
+  // nbl_get_neigh for one of its particles) needs it, into a buffer of its
+  // own, so its neighbors stay valid until the next build. The coordinates
+  // passed to nbl_build have to stay valid until then as well. The tiles are
+  // compact in space if the particles are sorted along a space-filling
+  // curve, see nbl_get_spatial_order. numberOfTiles is 0 if the last build
+  // is not tiled, and currentTile is the tile of the last nbl_build_tile.
+  int tileSize = 0;
+  int numberOfTiles = 0;
+  int currentTile = -1;
+  // if not empty, the buffers of the tiles are mapped from a temporary file
+  // in this directory instead of being allocated in memory
+  std::string tileDirectory;
+  // the tileSize of the last build
+  int builtTileSize = 0;
+  std::shared_ptr<NeighListTiles> tiles;
+  // kept alive with the tiles, e.g. by the caller for the coordinates of the
+  // last tiled build; not used by the neighbor list
+  std::shared_ptr<void> tileInputs;
+
+  // the inputs of the last nbl_build, used by nbl_update to rebuild
+  double influenceDistance = 0.0;
+  int numberOfThreads = 1;
+  std::vector<double> cutoffs;
+  std::vector<int> needNeighbors;
+  std::vector<double> referenceCoordinates;
+  // the skin the lists of the last build were created with
+  double builtSkin = 0.0;
+
+  // The configuration of the last nbl_build_padded. Its arrays are reused by
+  // the next nbl_build_padded, unless they have to grow while the
+  // configuration is also referenced elsewhere, in which case a new one is
+  // created and the old one is left to the other owners.
+  std::shared_ptr<PaddedConfiguration> padded;
+
+  NeighListWorkspace * workspace = nullptr;
+  NeighListMoves * moves = nullptr;
 };
 
 void nbl_initialize(NeighList ** const nl);
 
+// The padding (image) particles of a periodic box within `cutoff` of the
+// box, computed by nbl_plan_paddings and written by nbl_fill_paddings. The
+// image with shift shifts[3*s : 3*s+3] (in units of the cell vectors) holds
+// paddings [offsets[s], offsets[s + 1]), which are the images of
+// particlesOfClass[shiftClass[s]], or of all the particles if the class is 0.
+struct PaddingPlan
+{
+  int numberOfPaddings = 0;
+  double tcell[9];
+  std::vector<double> fracCoordinates;
+  std::vector<int> shifts;
+  std::vector<int> shiftClass;
+  std::vector<std::vector<int> > particlesOfClass;
+  std::vector<std::size_t> offsets;
+};
+
+int nbl_plan_paddings(PaddingPlan & plan,
+                      int const numberOfParticles,
+                      double const cutoff,
+                      double const * cell,
+                      int const * PBC,
+                      double const * coordinates);
+
+// the output arrays have room for plan.numberOfPaddings paddings; the shifts
+// of the paddings (3 per padding) are only written if shiftOfPaddings is not
+// nullptr
+void nbl_fill_paddings(PaddingPlan const & plan,
+                       int const * speciesCode,
+                       double * const coordinatesOfPaddings,
+                       int * const speciesCodeOfPaddings,
+                       int * const masterOfPaddings,
+                       int * const shiftOfPaddings = nullptr,
+                       int const numberOfThreads = 1);
+
+// recompute the coordinates of existing paddings, which are their master
+// particles shifted by cell vectors, for new coordinates (and cell)
+void nbl_refresh_paddings(int const numberOfPaddings,
+                          double const * cell,
+                          double const * coordinates,
+                          int const * masterOfPaddings,
+                          int const * shiftOfPaddings,
+                          double * const coordinatesOfPaddings,
+                          int const numberOfThreads = 1);
+
+// add the values of the paddings to those of their master particles, e.g.
+// forces, particle energies and virials. Each of the numberOfArrays arrays
+// holds numberOfColumns[a] values for each of the particles, followed by
+// each of the paddings. The values of a particle are summed in the order of
+// the paddings, so the result does not depend on numberOfThreads.
+void nbl_fold_paddings(int const numberOfParticles,
+                       int const numberOfPaddings,
+                       int const * masterOfPaddings,
+                       int const numberOfArrays,
+                       double * const * arrays,
+                       int const * numberOfColumns,
+                       int const numberOfThreads = 1);
+
+// 1 if a particle has moved more than skin / 2 from its reference position
+int nbl_check_displacement(int const numberOfParticles,
+                           double const * coordinates,
+                           double const * referenceCoordinates,
+                           double const skin);
+
 int nbl_create_paddings(int const numberOfParticles,
                         double const cutoff,
                         double const * cell,
@@ -40,7 +287,100 @@ int nbl_build(NeighList * const nl,
               double const influenceDistance,
               int const numberOfCutoffs,
               double const * cutoffs,
-              int const * needNeighbors);
+              int const * needNeighbors,
+              int const numberOfThreads = 1);
+
+// build the lists of tile `tile` of a tiled neighbor list (see
+// NeighList::tileSize) if they are not yet, and make it the current tile
+int nbl_build_tile(NeighList * const nl, int const tile);
+
+// the lists of tile `tile` (one per cutoff, with the rows of the tile), which
+// are built if they are not yet, or nullptr on error
+NeighListOne const * nbl_get_tile(NeighList * const nl, int const tile);
+
+// Build the lists of the particles subset[0] < subset[1] < ... only, in time
+// proportional to their number and that of the particles near them (plus a
+// pass over the coordinates): the particles outside of the bounding box of
+// the subset, enlarged by the influence distance, are not binned. The other
+// particles are only neighbors, and have no storage (see NeighList::subset).
+// Not available for half lists, and NeighList::hints are not used.
+int nbl_build_subset(NeighList * const nl,
+                     int const numberOfParticles,
+                     double const * coordinates,
+                     double const influenceDistance,
+                     int const numberOfCutoffs,
+                     double const * cutoffs,
+                     int const numberOfSubset,
+                     int const * subset,
+                     int const numberOfThreads = 1);
+
+int nbl_build_periodic(NeighList * const nl,
+                       int const numberOfParticles,
+                       double const * coordinates,
+                       double const * cell,
+                       int const * PBC,
+                       double const influenceDistance,
+                       int const numberOfCutoffs,
+                       double const * cutoffs,
+                       int const * needNeighbors,
+                       int const numberOfThreads = 1);
+
+// create the paddings of a periodic configuration (within influenceDistance
+// of the box) in nl->padded, and build the neighbor list of the particles
+// and paddings, where only the particles need neighbors
+int nbl_build_padded(NeighList * const nl,
+                     int const numberOfParticles,
+                     double const * coordinates,
+                     int const * speciesCode,
+                     double const * cell,
+                     int const * PBC,
+                     double const influenceDistance,
+                     int const numberOfCutoffs,
+                     double const * cutoffs,
+                     int const numberOfThreads = 1);
+
+// Build the neighbor lists of independent configurations, nl[c] for
+// configuration c, which is made of particles [offsets[c], offsets[c + 1]) of
+// coordinates and needNeighbors. If cells is not nullptr, configuration c is
+// periodic with cell cells[9*c : 9*c+9] and PBC PBCs[3*c : 3*c+3], and it is
+// built by nbl_build_periodic, otherwise by nbl_build. The configurations are
+// split across the threads, each of them built serially, and errors[c] is
+// the return value of the build of configuration c. Returns 1 if any build
+// failed.
+int nbl_build_batch(NeighList * const * nl,
+                    int const numberOfConfigurations,
+                    int const * offsets,
+                    double const * coordinates,
+                    double const * cells,
+                    int const * PBCs,
+                    double const influenceDistance,
+                    int const numberOfCutoffs,
+                    double const * cutoffs,
+                    int const * needNeighbors,
+                    int * const errors,
+                    int const numberOfThreads = 1);
+
+int nbl_update(NeighList * const nl,
+               int const numberOfParticles,
+               double const * coordinates,
+               int * const rebuilt);
+
+// Move particle `particle` to `position` and update the neighbor lists of
+// the last nbl_build accordingly: those of the particle, and those of its old
+// and new neighbors, in time proportional to its number of neighbors. The
+// position is also written to `coordinates`, which are the coordinates of
+// the last nbl_build as changed by the moves since. The first move after a
+// build lays out the lists with room for more neighbors of each particle.
+int nbl_move_particle(NeighList * const nl,
+                      int const numberOfParticles,
+                      double * const coordinates,
+                      int const particle,
+                      double const * position);
+
+// undo the last nbl_move_particle, restoring the neighbor lists exactly
+int nbl_undo_move(NeighList * const nl,
+                  int const numberOfParticles,
+                  double * const coordinates);
 
 int nbl_get_neigh(void const * const nl,
                   int const numberOfCutoffs,
@@ -50,6 +390,29 @@ int nbl_get_neigh(void const * const nl,
                   int * const numberOfNeighbors,
                   int const ** const neighborsOfParticle);
 
+// release the memory that is not needed by the current neighbor lists
+void nbl_shrink(NeighList * const nl);
+
+// bytes of memory held by the neighbor list, and bytes of it actually used
+void nbl_get_memory_usage(NeighList const * const nl,
+                          std::size_t * const allocated,
+                          std::size_t * const used);
+
 void nbl_clean(NeighList ** const nl);
 
+// order of the particles along a Morton (Z-order) curve, i.e. particle
+// order[j] is the j-th particle along the curve
+void nbl_get_spatial_order(int const numberOfParticles,
+                           double const * coordinates,
+                           int * const order);
+
+// reorder in place the rows of `data` (numberOfRows rows of rowSize bytes) such
+// that row j becomes the old row order[j], or, if `inverse`, such that row
+// order[j] becomes the old row j
+int nbl_permute(int const numberOfRows,
+                std::size_t const rowSize,
+                int const * order,
+                int const inverse,
+                void * const data);
+
 #endif  // NEIGHBOR_LIST_H_
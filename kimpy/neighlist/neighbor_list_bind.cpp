@@ -1,9 +1,11 @@
 #include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 
+#include <algorithm>
 #include <cstdlib>
 #include <iostream>
 #include <memory>
+#include <string>
 #include <vector>
 
 #include "neighbor_list.h"
@@ -23,6 +25,232 @@ struct PyNeighListDestroy
 {
   void operator()(NeighList * neighList) const { nbl_clean(&neighList); }
 };
+
+// a read-only (C-contiguous) numpy array of an array of a NeighListOne, which
+// keeps the array alive through its owner, even if the list is rebuilt
+template<typename T>
+py::array_t<T> list_view(std::shared_ptr<void> const & owner,
+                         T const * data,
+                         std::vector<py::ssize_t> const & shape)
+{
+  py::capsule base(new std::shared_ptr<void>(owner), [](void * p) {
+    delete static_cast<std::shared_ptr<void> *>(p);
+  });
+  py::array_t<T> view(shape, data, base);
+  view.attr("setflags")(py::arg("write") = false);
+  return view;
+}
+
+// the lists of the current tile of a tiled NeighList, or its lists if it is
+// not tiled, and the owner of their arrays (see tile_owner)
+NeighListOne const * current_lists(NeighList & neigh,
+                                   std::shared_ptr<void> & owner)
+{
+  owner.reset();
+  if (!neigh.numberOfTiles) { return neigh.lists; }
+  owner = neigh.tiles;
+  return nbl_get_tile(&neigh, neigh.currentTile);
+}
+
+// the owner of an array of the lists of a tile, which are all kept by
+// `tiles`, or `array` itself if they are not those of a tile
+template<typename T>
+std::shared_ptr<void> tile_owner(std::shared_ptr<void> const & tiles,
+                                 std::shared_ptr<T> const & array)
+{
+  if (tiles) { return tiles; }
+  return array;
+}
+
+// the list that owns the neighborList of list `neighbor_list_index` of
+// `lists`, see NeighListOne::sharesNeighborList
+NeighListOne const & storage_of(NeighListOne const * lists,
+                                int const number_of_lists,
+                                int const neighbor_list_index)
+{
+  NeighListOne const & cnl = lists[neighbor_list_index];
+  if (!cnl.sharesNeighborList) { return cnl; }
+  for (int k = 0; k < number_of_lists; k++)
+  {
+    if (!lists[k].sharesNeighborList) { return lists[k]; }
+  }
+  return cnl;
+}
+
+// list `neighbor_list_index` of `lists` in CSR format, see
+// NeighList.get_csr
+py::tuple csr_views(NeighListOne const * lists,
+                    int const number_of_lists,
+                    int const neighbor_list_index,
+                    std::shared_ptr<void> const & tiles)
+{
+  NeighListOne const & cnl = lists[neighbor_list_index];
+  NeighListOne const & storage
+      = storage_of(lists, number_of_lists, neighbor_list_index);
+
+  py::tuple re(3);
+  re[0] = list_view(tile_owner(tiles, cnl.NneighborsOwner),
+                    cnl.Nneighbors,
+                    {cnl.numberOfParticles});
+  re[1] = list_view(tile_owner(tiles, cnl.beginIndexOwner),
+                    cnl.beginIndex,
+                    {cnl.numberOfParticles});
+  re[2] = list_view(tile_owner(tiles, storage.neighborListOwner),
+                    cnl.neighborList,
+                    {cnl.neighborListSize});
+  return re;
+}
+
+// keep the coordinates of a tiled build alive until the next build, since
+// its tiles are built from them later on
+void keep_tile_inputs(NeighList & neigh, py::object const & coords)
+{
+  if (!neigh.numberOfTiles)
+  {
+    neigh.tileInputs.reset();
+    return;
+  }
+  // the neighbor list may release it without the GIL, e.g. in a build
+  neigh.tileInputs.reset(new py::object(coords), [](void * p) {
+    py::gil_scoped_acquire acquire;
+    delete static_cast<py::object *>(p);
+  });
+}
+
+// the tiles of a tiled NeighList, see NeighList.iter_tiles; `tiles` are
+// those of the build the iteration started with
+struct PyTileIterator
+{
+  py::object neigh;
+  int neighborListIndex;
+  int tile;
+  std::shared_ptr<NeighListTiles> tiles;
+};
+
+// the NeighListEngine of a name
+int get_engine(std::string const & name)
+{
+  if (name == "auto") { return NBL_ENGINE_AUTO; }
+  if (name == "dense") { return NBL_ENGINE_DENSE; }
+  if (name == "sparse") { return NBL_ENGINE_SPARSE; }
+  if (name == "brute") { return NBL_ENGINE_BRUTE; }
+  throw std::runtime_error("engine = \"" + name
+                           + "\" is not one of \"auto\", \"dense\", "
+                             "\"sparse\" and \"brute\"!");
+}
+
+// a checked NeighList::binSizeFactor
+double get_bin_size_factor(double const factor)
+{
+  if (!(factor > 0.0 && factor <= 1.0))
+  {
+    throw std::runtime_error("bin_size_factor = " + std::to_string(factor)
+                             + " is not in (0, 1]!");
+  }
+  return factor;
+}
+
+// a new NeighList with a checked NeighList::maxListSize
+std::unique_ptr<NeighList, PyNeighListDestroy>
+create_neigh_list(long long const max_list_size)
+{
+  if (max_list_size < 0)
+  {
+    throw std::runtime_error("max_list_size = " + std::to_string(max_list_size)
+                             + " < 0!");
+  }
+
+  NeighList * neighList = new NeighList;
+  neighList->maxListSize = max_list_size;
+  return std::unique_ptr<NeighList, PyNeighListDestroy>(std::move(neighList));
+}
+
+// the hints of the cutoffs (see NeighList::hints), empty if `hints` is None
+std::vector<int> get_hints(py::object const & hints,
+                           int const number_of_cutoffs,
+                           bool const half)
+{
+  if (hints.is_none()) { return std::vector<int>(); }
+  if (half)
+  {
+    throw std::runtime_error("\"hints\" is not used by half neighbor lists!");
+  }
+
+  auto array = hints.cast<py::array_t<int> >();
+  if (array.size() != number_of_cutoffs)
+  {
+    throw std::runtime_error("\"hints\" size and \"cutoffs\" size do not "
+                             "match!");
+  }
+  return std::vector<int>(array.data(), array.data() + number_of_cutoffs);
+}
+
+// the cutoffs of the species pairs (see NeighList::speciesCutoffs), empty if
+// `species_cutoffs` is None
+std::vector<double> get_species_cutoffs(py::object const & species_cutoffs,
+                                        int & number_of_species)
+{
+  number_of_species = 0;
+  if (species_cutoffs.is_none()) { return std::vector<double>(); }
+
+  auto array = species_cutoffs.cast<
+      py::array_t<double, py::array::c_style | py::array::forcecast> >();
+  if (array.ndim() != 2 || array.shape(0) != array.shape(1))
+  {
+    throw std::runtime_error("\"species_cutoffs\" is not a square matrix!");
+  }
+  number_of_species = static_cast<int>(array.shape(0));
+  auto const cutoffs = array.unchecked<2>();
+  for (int a = 0; a < number_of_species; a++)
+  {
+    for (int b = 0; b < number_of_species; b++)
+    {
+      if (cutoffs(a, b) != cutoffs(b, a))
+      {
+        throw std::runtime_error("\"species_cutoffs\" is not symmetric!");
+      }
+    }
+  }
+  return std::vector<double>(array.data(), array.data() + array.size());
+}
+
+// the species codes of `natoms` particles for species cutoffs of
+// `number_of_species` species (none if 0), checked to be valid
+std::vector<int> get_species(py::object const & species,
+                             int const natoms,
+                             int const number_of_species)
+{
+  if (number_of_species == 0)
+  {
+    if (!species.is_none())
+    {
+      throw std::runtime_error("\"species\" is only used with "
+                               "\"species_cutoffs\"!");
+    }
+    return std::vector<int>();
+  }
+  if (species.is_none())
+  {
+    throw std::runtime_error("\"species_cutoffs\" needs \"species\"!");
+  }
+
+  auto array = species.cast<py::array_t<int> >();
+  if (array.size() != natoms)
+  {
+    throw std::runtime_error("\"coords\" size and \"species\" size do not "
+                             "match!");
+  }
+  int const * data = array.data();
+  for (int i = 0; i < natoms; i++)
+  {
+    if (data[i] < 0 || data[i] >= number_of_species)
+    {
+      throw std::runtime_error("species code " + std::to_string(data[i])
+                               + " is not a row of \"species_cutoffs\"!");
+    }
+  }
+  return std::vector<int>(data, data + natoms);
+}
 }  // namespace
 
 
@@ -32,16 +260,25 @@ PYBIND11_MODULE(neighlist, module)
 
   py::class_<NeighList, std::unique_ptr<NeighList, PyNeighListDestroy> >(
       module, "NeighList", py::module_local())
-      .def(py::init([]() {
-    NeighList * neighList = new NeighList;
-    return std::unique_ptr<NeighList, PyNeighListDestroy>(std::move(neighList));
-      }))
+      .def(py::init(&create_neigh_list), py::arg("max_list_size") = 0)
       .def("build",
            [](NeighList &self,
               py::array_t<double> coords,
               double const influence_distance,
               py::array_t<double> cutoffs,
-              py::array_t<int> need_neigh) {
+              py::array_t<int> need_neigh,
+              int const num_threads,
+              double const skin,
+              bool const half,
+              bool const shared_storage,
+              bool const store_distances,
+              std::string const & engine,
+              py::object const & hints,
+              double const bin_size_factor,
+              py::object const & species,
+              py::object const & species_cutoffs,
+              int const tile_size,
+              py::object const & tile_directory) {
     int const natoms_1 = static_cast<int>(coords.size() / 3);
     int const natoms_2 = static_cast<int>(need_neigh.size());
 
@@ -50,29 +287,434 @@ PYBIND11_MODULE(neighlist, module)
       MY_WARNING("\"coords\" size and \"need_neigh\" size do not match!");
     }
 
+    if (skin < 0.0)
+    {
+      throw std::runtime_error("skin = " + std::to_string(skin) + " < 0!");
+    }
+    if (tile_size < 0)
+    {
+      throw std::runtime_error("tile_size = " + std::to_string(tile_size)
+                               + " < 0!");
+    }
+
     int const natoms = natoms_1 <= natoms_2 ? natoms_1 : natoms_2;
     double const * coords_data = coords.data();
     int const number_of_cutoffs = static_cast<int>(cutoffs.size());
     double const * cutoffs_data = cutoffs.data();
     int const * need_neigh_data = need_neigh.data();
 
-    int error = nbl_build(&self,
-                          natoms,
-                          coords_data,
-                          influence_distance,
-                          number_of_cutoffs,
-                          cutoffs_data,
-                          need_neigh_data);
+    int const engine_id = get_engine(engine);
+    double const bin_factor = get_bin_size_factor(bin_size_factor);
+    std::vector<int> const model_hints
+        = get_hints(hints, number_of_cutoffs, half);
+    int number_of_species;
+    std::vector<double> const pair_cutoffs
+        = get_species_cutoffs(species_cutoffs, number_of_species);
+    std::vector<int> const species_code
+        = get_species(species, natoms, number_of_species);
+
+    self.skin = skin;
+    self.half = half ? 1 : 0;
+    self.sharedStorage = shared_storage ? 1 : 0;
+    self.storeDistances = store_distances ? 1 : 0;
+    self.engine = engine_id;
+    self.binSizeFactor = bin_factor;
+    self.tileSize = tile_size;
+    self.tileDirectory = tile_directory.is_none()
+                             ? std::string()
+                             : tile_directory.cast<std::string>();
+    self.hints = model_hints;
+    self.numberOfSpecies = number_of_species;
+    self.speciesCutoffs = pair_cutoffs;
+    self.speciesCode = species_code;
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build(&self,
+                        natoms,
+                        coords_data,
+                        influence_distance,
+                        number_of_cutoffs,
+                        cutoffs_data,
+                        need_neigh_data,
+                        num_threads);
+    }
     if (error == 1)
     {
       throw std::runtime_error("Cell size too large! (partilces fly away) or\n"
-                               "Collision of atoms happened!");
+                               "Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+    keep_tile_inputs(self, coords);
+      }, R"pbdoc(
+         Build the neighbor list.
+
+         The keyword arguments, shared with the other builds:
+             num_threads: number of threads, all the cores if ``<= 0``.
+             skin: added to the cutoffs, so that ``update`` keeps the lists.
+             half: store each pair once; only ``get_csr`` serves half lists.
+             shared_storage: one array of neighbors for all the cutoffs.
+             store_distances: also store the pairs, see ``get_distances``.
+             engine: ``"auto"``, ``"dense"``, ``"sparse"`` or ``"brute"``.
+             hints: the neighbor list hints of a KIM model, one per cutoff.
+             bin_size_factor: edge of the cells over ``influence_distance``.
+             species: the species code of each particle.
+             species_cutoffs: the cutoff of each pair of species codes.
+             tile_size: if positive, build the lists per tile when needed.
+             tile_directory: keep the lists of the tiles in files here.
+
+         A tiled build reads ``coords`` until the next build.
+         )pbdoc",
+         py::arg("coords").noconvert(),
+         py::arg("influence_distance"),
+         py::arg("cutoffs").noconvert(),
+         py::arg("need_neigh").noconvert(),
+         py::arg("num_threads") = 1,
+         py::arg("skin") = 0.0,
+         py::arg("half") = false,
+         py::arg("shared_storage") = false,
+         py::arg("store_distances") = false,
+         py::arg("engine") = "auto",
+         py::arg("hints") = py::none(),
+         py::arg("bin_size_factor") = 1.0,
+         py::arg("species") = py::none(),
+         py::arg("species_cutoffs") = py::none(),
+         py::arg("tile_size") = 0,
+         py::arg("tile_directory") = py::none())
+      .def("build_subset",
+           [](NeighList &self,
+              py::array_t<double> coords,
+              double const influence_distance,
+              py::array_t<double> cutoffs,
+              py::array_t<int> subset,
+              int const num_threads,
+              double const skin,
+              bool const shared_storage,
+              bool const store_distances,
+              std::string const & engine,
+              double const bin_size_factor,
+              py::object const & species,
+              py::object const & species_cutoffs) {
+    if (skin < 0.0)
+    {
+      throw std::runtime_error("skin = " + std::to_string(skin) + " < 0!");
+    }
+
+    int const natoms = static_cast<int>(coords.size() / 3);
+    double const * coords_data = coords.data();
+    int const number_of_cutoffs = static_cast<int>(cutoffs.size());
+    double const * cutoffs_data = cutoffs.data();
+    int const number_of_subset = static_cast<int>(subset.size());
+    int const * subset_data = subset.data();
+
+    int const engine_id = get_engine(engine);
+    double const bin_factor = get_bin_size_factor(bin_size_factor);
+    int number_of_species;
+    std::vector<double> const pair_cutoffs
+        = get_species_cutoffs(species_cutoffs, number_of_species);
+    std::vector<int> const species_code
+        = get_species(species, natoms, number_of_species);
+
+    self.skin = skin;
+    self.half = 0;
+    self.sharedStorage = shared_storage ? 1 : 0;
+    self.storeDistances = store_distances ? 1 : 0;
+    self.engine = engine_id;
+    self.binSizeFactor = bin_factor;
+    self.tileSize = 0;
+    self.hints.clear();
+    self.numberOfSpecies = number_of_species;
+    self.speciesCutoffs = pair_cutoffs;
+    self.speciesCode = species_code;
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build_subset(&self,
+                               natoms,
+                               coords_data,
+                               influence_distance,
+                               number_of_cutoffs,
+                               cutoffs_data,
+                               number_of_subset,
+                               subset_data,
+                               num_threads);
     }
-      }, "Build the neighbor list.",
+    if (error == 1)
+    {
+      throw std::runtime_error("\"subset\" is not made of increasing "
+                               "particle indices! or\n"
+                               "Cell size too large! (partilces fly away) or\n"
+                               "Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+      }, R"pbdoc(
+         Build the neighbor list of a subset of the particles.
+
+         Only the particles of ``subset``, in increasing order, get lists,
+         e.g. those of the active region of an embedded cluster, and the
+         others are only their neighbors. Only the particles in the bounding
+         box of the subset, enlarged by ``influence_distance``, are binned,
+         so the time depends on the size of the subset and not on
+         ``len(coords)``, apart from one pass over the coordinates.
+
+         The arrays of ``get_csr`` only have rows for the subset: row ``r``
+         holds particle ``subset[r]``. ``get_neigh`` finds the row of a
+         particle by binary search, and a particle outside of the subset has
+         no neighbors. ``update`` rebuilds the lists of the same subset.
+         Moves (``move_particle``) are not supported.
+         )pbdoc",
          py::arg("coords").noconvert(),
          py::arg("influence_distance"),
          py::arg("cutoffs").noconvert(),
-         py::arg("need_neigh").noconvert())
+         py::arg("subset").noconvert(),
+         py::arg("num_threads") = 1,
+         py::arg("skin") = 0.0,
+         py::arg("shared_storage") = false,
+         py::arg("store_distances") = false,
+         py::arg("engine") = "auto",
+         py::arg("bin_size_factor") = 1.0,
+         py::arg("species") = py::none(),
+         py::arg("species_cutoffs") = py::none())
+      .def("update",
+           [](NeighList &self, py::array_t<double> coords) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+    double const * coords_data = coords.data();
+
+    int rebuilt;
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_update(&self, natoms, coords_data, &rebuilt);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("The neighbor list is not created by \"build\" "
+                               "for the same number of particles! or\n"
+                               "Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+    if (rebuilt == 1) { keep_tile_inputs(self, coords); }
+
+    return rebuilt == 1;
+      }, R"pbdoc(
+         Update the neighbor list for new coordinates.
+
+         The list is rebuilt (with the same inputs as the last ``build``) only
+         if a particle has moved more than ``skin / 2`` since the last build.
+         Otherwise, the current lists (created with ``cutoffs + skin``) are
+         kept, and they still contain all the neighbors within ``cutoffs``.
+
+         Returns:
+             bool: rebuilt
+         )pbdoc",
+         py::arg("coords").noconvert())
+      .def("move_particle",
+           [](NeighList &self,
+              py::array_t<double, py::array::c_style> coords,
+              int const index,
+              py::array_t<double> new_position) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+
+    if (new_position.size() != 3)
+    {
+      throw std::runtime_error("\"new_position\" is not of size 3!");
+    }
+
+    double * coords_data = coords.mutable_data();
+    double const * new_position_data = new_position.data();
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_move_particle(
+          &self, natoms, coords_data, index, new_position_data);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("The neighbor list is not created by \"build\" "
+                               "for the same number of particles, or it is a "
+                               "half list or has shared storage or stored "
+                               "distances! or\nindex = "
+                               + std::to_string(index)
+                               + " is not a particle! or\nCollision of atoms "
+                                 "happened!");
+    }
+      }, R"pbdoc(
+         Move one particle and update the neighbor list accordingly.
+
+         ``coords[index]`` is set to ``new_position``, and the neighbors of
+         the particle, as well as its old and new neighbors, are updated in
+         time proportional to its number of neighbors, instead of rebuilding
+         the whole list, e.g. for Monte Carlo moves. ``coords`` are the
+         coordinates of the last ``build``, and they must only be changed by
+         ``move_particle`` and ``undo_move`` in between.
+
+         The first move after a build lays out the lists with room for more
+         neighbors of each particle, so the neighbors of a particle are
+         still ``neighbor_list[begin_index[i]:begin_index[i] +
+         number_of_neighbors[i]]`` (see ``get_csr``), but the neighbor list
+         has gaps, and the neighbors are no longer in the order of a build.
+
+         A move can be rolled back by ``undo_move``, e.g. if it is rejected.
+         Moves are not supported for half lists, or with
+         ``shared_storage=True`` or ``store_distances=True``.
+         )pbdoc",
+         py::arg("coords").noconvert(),
+         py::arg("index"),
+         py::arg("new_position").noconvert())
+      .def("undo_move",
+           [](NeighList &self,
+              py::array_t<double, py::array::c_style> coords) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+    double * coords_data = coords.mutable_data();
+
+    int const error = nbl_undo_move(&self, natoms, coords_data);
+    if (error == 1)
+    {
+      throw std::runtime_error("There is no move to undo!");
+    }
+      }, R"pbdoc(
+         Undo the last ``move_particle``.
+
+         The particle is moved back in ``coords``, and the neighbor list is
+         restored exactly, including the order of the neighbors. Only the
+         last move can be undone.
+         )pbdoc",
+         py::arg("coords").noconvert())
+      .def("build_periodic",
+           [](NeighList &self,
+              py::array_t<double> coords,
+              py::array_t<double> cell,
+              py::array_t<int> pbc,
+              double const influence_distance,
+              py::array_t<double> cutoffs,
+              py::array_t<int> need_neigh,
+              int const num_threads,
+              bool const half,
+              bool const shared_storage,
+              bool const store_distances,
+              std::string const & engine,
+              double const bin_size_factor,
+              py::object const & species,
+              py::object const & species_cutoffs) {
+    int const natoms_1 = static_cast<int>(coords.size() / 3);
+    int const natoms_2 = static_cast<int>(need_neigh.size());
+
+    if (natoms_1 != natoms_2)
+    {
+      MY_WARNING("\"coords\" size and \"need_neigh\" size do not match!");
+    }
+
+    int const natoms = natoms_1 <= natoms_2 ? natoms_1 : natoms_2;
+    double const * coords_data = coords.data();
+    double const * cell_data = cell.data();
+    int const * pbc_data = pbc.data();
+    int const number_of_cutoffs = static_cast<int>(cutoffs.size());
+    double const * cutoffs_data = cutoffs.data();
+    int const * need_neigh_data = need_neigh.data();
+
+    int const engine_id = get_engine(engine);
+    double const bin_factor = get_bin_size_factor(bin_size_factor);
+    int number_of_species;
+    std::vector<double> const pair_cutoffs
+        = get_species_cutoffs(species_cutoffs, number_of_species);
+    std::vector<int> const species_code
+        = get_species(species, natoms, number_of_species);
+
+    self.half = half ? 1 : 0;
+    self.sharedStorage = shared_storage ? 1 : 0;
+    self.storeDistances = store_distances ? 1 : 0;
+    self.engine = engine_id;
+    self.binSizeFactor = bin_factor;
+    self.tileSize = 0;
+    self.hints.clear();
+    self.numberOfSpecies = number_of_species;
+    self.speciesCutoffs = pair_cutoffs;
+    self.speciesCode = species_code;
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build_periodic(&self,
+                                 natoms,
+                                 coords_data,
+                                 cell_data,
+                                 pbc_data,
+                                 influence_distance,
+                                 number_of_cutoffs,
+                                 cutoffs_data,
+                                 need_neigh_data,
+                                 num_threads);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("In inverting the cell matrix, the determinant "
+                               "is 0! or\nCell size too large! (partilces fly "
+                               "away) or\nCollision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+
+    int const number_of_ghosts = self.numberOfGhosts;
+
+    py::array_t<double> coordinates_of_ghosts({number_of_ghosts, 3});
+    std::copy(self.ghostCoordinates.begin(),
+              self.ghostCoordinates.end(),
+              coordinates_of_ghosts.mutable_data());
+
+    py::array_t<int> master_particle_of_ghosts(number_of_ghosts);
+    std::copy(self.ghostMaster.begin(),
+              self.ghostMaster.end(),
+              master_particle_of_ghosts.mutable_data());
+
+    py::array_t<int> shifts_of_ghosts({number_of_ghosts, 3});
+    std::copy(self.ghostShift.begin(),
+              self.ghostShift.end(),
+              shifts_of_ghosts.mutable_data());
+
+    py::tuple re(3);
+    re[0] = coordinates_of_ghosts;
+    re[1] = master_particle_of_ghosts;
+    re[2] = shifts_of_ghosts;
+    return re;
+      }, R"pbdoc(
+         Build the neighbor list of a periodic configuration.
+
+         Unlike ``create_paddings`` followed by ``build``, no padding particles
+         are created up front. A neighbor that is a periodic image is stored as
+         a ghost particle, identified by its master particle and its shift in
+         units of the cell vectors. Only the ghosts that are actually
+         neighbors of some particle are created. Ghost ``g`` is particle
+         ``len(coords) + g`` in the neighbor list, and it has no neighbors.
+
+         The configuration passed to a model is then smaller than with
+         paddings, and the build is faster, also for a cell much smaller
+         than the influence distance.
+
+         With ``half=True``, a pair of particle ``i`` and the image of
+         particle ``j`` is stored under ``i`` if ``j > i`` (or ``j == i`` and
+         the shift is positive in lexicographic order), or if ``j`` does not
+         need neighbors.
+
+         Returns:
+             2darray, 1darray, 2darray: coordinates_of_ghosts,
+                 master_particle_of_ghosts, shifts_of_ghosts
+         )pbdoc",
+         py::arg("coords").noconvert(),
+         py::arg("cell").noconvert(),
+         py::arg("pbc").noconvert(),
+         py::arg("influence_distance"),
+         py::arg("cutoffs").noconvert(),
+         py::arg("need_neigh").noconvert(),
+         py::arg("num_threads") = 1,
+         py::arg("half") = false,
+         py::arg("shared_storage") = false,
+         py::arg("store_distances") = false,
+         py::arg("engine") = "auto",
+         py::arg("bin_size_factor") = 1.0,
+         py::arg("species") = py::none(),
+         py::arg("species_cutoffs") = py::none())
       .def("get_neigh",
            [](NeighList &self,
               py::array_t<double> cutoffs,
@@ -95,7 +737,12 @@ PYBIND11_MODULE(neighlist, module)
                               &neigh_of_atom);
     if (error == 1)
     {
-      if (neighbor_list_index >= self.numberOfNeighborLists)
+      if (self.half)
+      {
+        throw std::runtime_error("get_neigh does not serve half neighbor "
+                                 "lists! Use get_csr instead.");
+      }
+      else if (neighbor_list_index >= self.numberOfNeighborLists)
       {
         throw std::runtime_error("neighbor_list_index = "
                                  + std::to_string(neighbor_list_index)
@@ -111,6 +758,14 @@ PYBIND11_MODULE(neighlist, module)
             + " > self.lists[neighbor_list_index].cutoff = "
             + std::to_string(self.lists[neighbor_list_index].cutoff));
       }
+      else if (self.numberOfTiles && particle_number >= 0)
+      {
+        throw std::runtime_error("particle_number = "
+                                 + std::to_string(particle_number)
+                                 + " is not a particle! or\n"
+                                   "Collision of atoms happened! or\n"
+                                   "The neighbor list is too large!");
+      }
       else
       {
         throw std::runtime_error(
@@ -141,17 +796,248 @@ PYBIND11_MODULE(neighlist, module)
      )pbdoc",
      py::arg("cutoffs").noconvert(),
      py::arg("neighbor_list_index"),
-     py::arg("particle_number"));
+     py::arg("particle_number"))
+      .def("get_csr",
+           [](NeighList &self, int const neighbor_list_index) {
+    if ((neighbor_list_index < 0)
+        || (neighbor_list_index >= self.numberOfNeighborLists))
+    {
+      throw std::runtime_error("neighbor_list_index = "
+                               + std::to_string(neighbor_list_index)
+                               + " is not in [0, self.numberOfNeighborLists = "
+                               + std::to_string(self.numberOfNeighborLists)
+                               + ")");
+    }
+
+    std::shared_ptr<void> tiles;
+    NeighListOne const * lists = current_lists(self, tiles);
+    if (lists == nullptr)
+    {
+      throw std::runtime_error("Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+    return csr_views(
+        lists, self.numberOfNeighborLists, neighbor_list_index, tiles);
+  }, R"pbdoc(
+     Get the whole neighbor list in compressed sparse row (CSR) format.
+
+     The neighbors of particle ``i`` are
+     ``neighbor_list[begin_index[i]:begin_index[i] + number_of_neighbors[i]]``.
+     After ``build_subset``, there are only the rows of the subset, and
+     after a tiled ``build``, only those of the current tile. The neighbors
+     are 32-bit integers (``np.intc``), while ``begin_index`` is 64-bit
+     (``np.int64``), so the list can hold more than 2^31 entries.
+     The returned arrays are read-only views of the internal storage, so
+     no data is copied. They share its memory with the neighbor list: a
+     later build, move or ``shrink`` leaves the memory still used by views
+     to them and writes the new lists elsewhere, so the views keep the lists
+     of the time they were taken.
+
+     Returns:
+         1darray, 1darray, 1darray: number_of_neighbors, begin_index,
+             neighbor_list
+     )pbdoc",
+     py::arg("neighbor_list_index"))
+      .def("build_tile",
+           [](NeighList &self, int const tile) {
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build_tile(&self, tile);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("tile = " + std::to_string(tile)
+                               + " is not a tile of the neighbor list! or\n"
+                                 "Collision of atoms happened! or\n"
+                                 "The neighbor list is too large!");
+    }
+  }, R"pbdoc(
+     Build the lists of a tile of a tiled neighbor list (see ``build``).
+
+     Tile ``t`` holds the particles ``t * tile_size`` to
+     ``(t + 1) * tile_size - 1``. It becomes the current tile, whose rows
+     ``get_csr`` returns; the lists of the other tiles stay valid.
+     )pbdoc",
+     py::arg("tile"))
+      .def("iter_tiles",
+           [](py::object self_object, int const neighbor_list_index) {
+    NeighList &self = self_object.cast<NeighList &>();
+
+    if (self.numberOfTiles == 0)
+    {
+      throw std::runtime_error("The neighbor list is not built with "
+                               "\"tile_size\" > 0!");
+    }
+    if ((neighbor_list_index < 0)
+        || (neighbor_list_index >= self.numberOfNeighborLists))
+    {
+      throw std::runtime_error("neighbor_list_index = "
+                               + std::to_string(neighbor_list_index)
+                               + " is not in [0, self.numberOfNeighborLists = "
+                               + std::to_string(self.numberOfNeighborLists)
+                               + ")");
+    }
+
+    return PyTileIterator{self_object, neighbor_list_index, 0, self.tiles};
+  }, R"pbdoc(
+     Iterate over the tiles of a tiled neighbor list (see ``build``).
+
+     Each tile is built in turn, and the iterator yields the range of its
+     particles and its list in CSR format (see ``get_csr``), where row ``r``
+     holds particle ``begin + r``. Like those of ``get_csr``, the arrays
+     are read-only views, which stay valid after the next tile is built.
+     The current tile is not changed. Rebuilding the neighbor list during
+     the iteration raises a RuntimeError at the next step.
+
+     Returns:
+         iterator: of (int, int, (1darray, 1darray, 1darray)): begin, end,
+             (number_of_neighbors, begin_index, neighbor_list)
+     )pbdoc",
+     py::arg("neighbor_list_index"))
+      .def("get_distances",
+           [](NeighList &self, int const neighbor_list_index) {
+    if ((neighbor_list_index < 0)
+        || (neighbor_list_index >= self.numberOfNeighborLists))
+    {
+      throw std::runtime_error("neighbor_list_index = "
+                               + std::to_string(neighbor_list_index)
+                               + " is not in [0, self.numberOfNeighborLists = "
+                               + std::to_string(self.numberOfNeighborLists)
+                               + ")");
+    }
+    if (!self.storeDistances)
+    {
+      throw std::runtime_error("The neighbor list is not built with "
+                               "\"store_distances=True\"!");
+    }
+
+    std::shared_ptr<void> tiles;
+    NeighListOne const * lists = current_lists(self, tiles);
+    if (lists == nullptr)
+    {
+      throw std::runtime_error("Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+    NeighListOne const &cnl = lists[neighbor_list_index];
+    NeighListOne const &storage
+        = storage_of(lists, self.numberOfNeighborLists, neighbor_list_index);
+
+    py::tuple re(2);
+    py::ssize_t const number_of_pairs = cnl.neighborListSize;
+    re[0] = list_view(tile_owner(tiles, storage.neighborDisplacementsOwner),
+                      cnl.neighborDisplacements,
+                      {number_of_pairs, 3});
+    re[1] = list_view(tile_owner(tiles, storage.neighborDistancesOwner),
+                      cnl.neighborDistances,
+                      {number_of_pairs});
+    return re;
+  }, R"pbdoc(
+     Get the displacements and distances of the neighbor pairs.
+
+     They are aligned with ``neighbor_list`` of ``get_csr``: entry ``m`` is
+     the displacement (neighbor minus particle, including the periodic
+     shift for a ghost) and the distance between particle ``i`` and its
+     neighbor ``neighbor_list[m]``. Like those of ``get_csr``, the arrays
+     are read-only views of the internal storage, without a copy.
+
+     Returns:
+         2darray, 1darray: displacements, distances
+     )pbdoc",
+     py::arg("neighbor_list_index"))
+      .def("get_ghosts",
+           [](NeighList &self) {
+    py::ssize_t const number_of_ghosts = self.numberOfGhosts;
 
-  module.def("create", []() {
-    NeighList * neighList = new NeighList;
-    return std::unique_ptr<NeighList, PyNeighListDestroy>(std::move(neighList));
+    py::tuple re(3);
+    re[0] = py::array_t<double>({number_of_ghosts, py::ssize_t(3)},
+                                self.ghostCoordinates.data());
+    re[1] = py::array_t<int>(number_of_ghosts, self.ghostMaster.data());
+    re[2] = py::array_t<int>({number_of_ghosts, py::ssize_t(3)},
+                             self.ghostShift.data());
+    return re;
   }, R"pbdoc(
+     Get the ghosts of the last ``build_periodic``, the same arrays as it
+     returns.
+
+     The arrays are copies of the internal storage.
+
+     Returns:
+         2darray, 1darray, 2darray: coordinates_of_ghosts,
+             master_particle_of_ghosts, shifts_of_ghosts
+     )pbdoc")
+      .def("shrink",
+           [](NeighList &self) { nbl_shrink(&self); },
+           R"pbdoc(
+           Release the memory that is not needed by the current neighbor lists.
+
+           Repeated builds reuse (and only grow) the memory of previous builds,
+           so a list built for a large configuration keeps its memory when it
+           is rebuilt for a smaller one. The lists themselves are kept.
+           )pbdoc")
+      .def("get_memory_usage",
+           [](NeighList &self) {
+    std::size_t allocated;
+    std::size_t used;
+    nbl_get_memory_usage(&self, &allocated, &used);
+
+    py::tuple re(2);
+    re[0] = allocated;
+    re[1] = used;
+    return re;
+  }, R"pbdoc(
+     Get the memory held by the neighbor list.
+
+     Returns:
+         int, int: allocated_bytes, used_bytes
+     )pbdoc");
+
+  py::class_<PyTileIterator>(module, "TileIterator", py::module_local())
+      .def("__iter__",
+           [](PyTileIterator & self) -> PyTileIterator & { return self; })
+      .def("__next__", [](PyTileIterator & self) {
+    NeighList & neigh = self.neigh.cast<NeighList &>();
+    if (neigh.tiles != self.tiles)
+    {
+      throw std::runtime_error("The neighbor list was rebuilt during the "
+                               "iteration over its tiles!");
+    }
+    if (self.tile >= neigh.numberOfTiles) { throw py::stop_iteration(); }
+
+    NeighListOne const * lists;
+    {
+      py::gil_scoped_release release;
+      lists = nbl_get_tile(&neigh, self.tile);
+    }
+    if (lists == nullptr)
+    {
+      throw std::runtime_error("Collision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+
+    int const begin = self.tile * neigh.builtTileSize;
+    int const end = begin + lists[self.neighborListIndex].numberOfParticles;
+    py::tuple csr = csr_views(
+        lists, neigh.numberOfNeighborLists, self.neighborListIndex, self.tiles);
+    self.tile++;
+
+    py::tuple re(3);
+    re[0] = begin;
+    re[1] = end;
+    re[2] = csr;
+    return re;
+  });
+
+  module.def("create", &create_neigh_list, R"pbdoc(
      Create a new NeighList object.
 
+     With a positive ``max_list_size``, a build that needs more entries in
+     one neighbor list raises a RuntimeError instead of allocating them.
+
      Returns:
          NeighList: neighList
-     )pbdoc"
+     )pbdoc",
+     py::arg("max_list_size") = 0
   );
 
   // cannot bind `nbl_get_neigh_kim` directly, since it has pointer arguments
@@ -163,12 +1049,242 @@ PYBIND11_MODULE(neighlist, module)
     return (void const *) &nbl_get_neigh;
   });
 
+  module.def("build_batch",
+             [](py::array_t<double> coords,
+                py::array_t<int> offsets,
+                double const influence_distance,
+                py::array_t<double> cutoffs,
+                py::object need_neigh,
+                py::object cells,
+                py::object pbcs,
+                py::object neighs,
+                int const num_threads,
+                bool const half,
+                bool const shared_storage,
+                bool const store_distances,
+                std::string const & engine,
+                py::object const & hints,
+                double const bin_size_factor,
+                py::object const & species,
+                py::object const & species_cutoffs) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+    int const number_of_configs = static_cast<int>(offsets.size()) - 1;
+
+    if (number_of_configs < 0)
+    {
+      throw std::runtime_error("\"offsets\" is empty!");
+    }
+    int const * offsets_data = offsets.data();
+    for (int c = 0; c < number_of_configs; c++)
+    {
+      if (offsets_data[c] < 0 || offsets_data[c + 1] < offsets_data[c]
+          || offsets_data[c + 1] > natoms)
+      {
+        throw std::runtime_error("\"offsets\" is not an increasing sequence "
+                                 "of indices of \"coords\"!");
+      }
+    }
+
+    py::array_t<int> need_neigh_array;
+    if (need_neigh.is_none())
+    {
+      need_neigh_array = py::array_t<int>(natoms);
+      std::fill(need_neigh_array.mutable_data(),
+                need_neigh_array.mutable_data() + natoms,
+                1);
+    }
+    else
+    {
+      need_neigh_array = need_neigh.cast<py::array_t<int> >();
+      if (need_neigh_array.size() != natoms)
+      {
+        throw std::runtime_error("\"coords\" size and \"need_neigh\" size "
+                                 "do not match!");
+      }
+    }
+
+    py::array_t<double> cells_array;
+    py::array_t<int> pbcs_array;
+    if (!cells.is_none())
+    {
+      cells_array = cells.cast<py::array_t<double> >();
+      if (cells_array.size() != 9 * number_of_configs)
+      {
+        throw std::runtime_error("\"cells\" size does not match the number "
+                                 "of configurations!");
+      }
+      if (pbcs.is_none())
+      {
+        pbcs_array = py::array_t<int>(3 * number_of_configs);
+        std::fill(pbcs_array.mutable_data(),
+                  pbcs_array.mutable_data() + 3 * number_of_configs,
+                  1);
+      }
+      else
+      {
+        pbcs_array = pbcs.cast<py::array_t<int> >();
+        if (pbcs_array.size() != 3 * number_of_configs)
+        {
+          throw std::runtime_error("\"pbcs\" size does not match the number "
+                                   "of configurations!");
+        }
+      }
+    }
+
+    int const number_of_cutoffs = static_cast<int>(cutoffs.size());
+    int const engine_id = get_engine(engine);
+    double const bin_factor = get_bin_size_factor(bin_size_factor);
+    std::vector<int> const model_hints
+        = get_hints(hints, number_of_cutoffs, half);
+    int number_of_species;
+    std::vector<double> const pair_cutoffs
+        = get_species_cutoffs(species_cutoffs, number_of_species);
+    std::vector<int> const species_code
+        = get_species(species, natoms, number_of_species);
+
+    // the NeighList objects to build, new ones or those of `neighs`
+    py::list result;
+    if (neighs.is_none())
+    {
+      for (int c = 0; c < number_of_configs; c++)
+      {
+        result.append(py::cast(std::unique_ptr<NeighList, PyNeighListDestroy>(
+            new NeighList)));
+      }
+    }
+    else
+    {
+      result = py::list(neighs);
+      if (static_cast<int>(result.size()) != number_of_configs)
+      {
+        throw std::runtime_error("\"neighs\" size does not match the number "
+                                 "of configurations!");
+      }
+    }
+
+    std::vector<NeighList *> neigh_lists(number_of_configs);
+    for (int c = 0; c < number_of_configs; c++)
+    {
+      NeighList &neigh = result[c].cast<NeighList &>();
+      neigh.skin = 0.0;
+      neigh.half = half ? 1 : 0;
+      neigh.sharedStorage = shared_storage ? 1 : 0;
+      neigh.storeDistances = store_distances ? 1 : 0;
+      neigh.engine = engine_id;
+      neigh.binSizeFactor = bin_factor;
+      neigh.tileSize = 0;
+      neigh.hints = model_hints;
+      neigh.numberOfSpecies = number_of_species;
+      neigh.speciesCutoffs = pair_cutoffs;
+      if (number_of_species > 0)
+      {
+        neigh.speciesCode.assign(species_code.begin() + offsets_data[c],
+                                 species_code.begin() + offsets_data[c + 1]);
+      }
+      else
+      {
+        neigh.speciesCode.clear();
+      }
+      neigh_lists[c] = &neigh;
+    }
+
+    // the configurations are built concurrently
+    std::vector<NeighList *> sorted_lists(neigh_lists);
+    std::sort(sorted_lists.begin(), sorted_lists.end());
+    if (std::adjacent_find(sorted_lists.begin(), sorted_lists.end())
+        != sorted_lists.end())
+    {
+      throw std::runtime_error("\"neighs\" contains a NeighList twice!");
+    }
+
+    double const * coords_data = coords.data();
+    double const * cutoffs_data = cutoffs.data();
+    int const * need_neigh_data = need_neigh_array.data();
+    double const * cells_data = cells.is_none() ? nullptr : cells_array.data();
+    int const * pbcs_data = cells.is_none() ? nullptr : pbcs_array.data();
+    std::vector<int> errors(number_of_configs, 0);
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build_batch(neigh_lists.data(),
+                              number_of_configs,
+                              offsets_data,
+                              coords_data,
+                              cells_data,
+                              pbcs_data,
+                              influence_distance,
+                              number_of_cutoffs,
+                              cutoffs_data,
+                              need_neigh_data,
+                              errors.data(),
+                              num_threads);
+    }
+    if (error == 1)
+    {
+      int const c = static_cast<int>(
+          std::find(errors.begin(), errors.end(), 1) - errors.begin());
+      throw std::runtime_error("Building configuration "
+                               + std::to_string(c)
+                               + " failed! In inverting the cell matrix, the "
+                                 "determinant is 0! or\nCell size too large! "
+                                 "(partilces fly away) or\nCollision of "
+                                 "atoms happened! or\nThe neighbor list is "
+                                 "too large!");
+    }
+
+    return result;
+  }, R"pbdoc(
+     Build the neighbor lists of many configurations in one call.
+
+     Configuration ``c`` is made of particles
+     ``offsets[c]:offsets[c + 1]`` of ``coords`` (and ``need_neigh``, which
+     defaults to all ones), where the particles are numbered from 0 in each
+     configuration. The configurations are split across ``num_threads``
+     threads (all the available cores if ``num_threads <= 0``), with the
+     GIL released, which avoids the overhead of calling ``build`` from
+     Python for each of many small configurations.
+
+     If ``cells`` (of shape ``(len(offsets) - 1, 3, 3)``) is given, the
+     configurations are periodic along ``pbcs`` (of shape
+     ``(len(offsets) - 1, 3)``, all periodic by default), and they are built
+     as by ``NeighList.build_periodic``, whose ghosts are returned by
+     ``NeighList.get_ghosts``. Otherwise, they are built as by
+     ``NeighList.build``.
+
+     The lists are built into new NeighList objects, or into those of
+     ``neighs``, e.g. returned by an earlier ``build_batch``, reusing their
+     memory. ``species`` is split by ``offsets`` like ``coords``.
+
+     Returns:
+         list: the NeighList of each configuration
+     )pbdoc",
+     py::arg("coords").noconvert(),
+     py::arg("offsets").noconvert(),
+     py::arg("influence_distance"),
+     py::arg("cutoffs").noconvert(),
+     py::arg("need_neigh") = py::none(),
+     py::arg("cells") = py::none(),
+     py::arg("pbcs") = py::none(),
+     py::arg("neighs") = py::none(),
+     py::arg("num_threads") = 1,
+     py::arg("half") = false,
+     py::arg("shared_storage") = false,
+     py::arg("store_distances") = false,
+     py::arg("engine") = "auto",
+     py::arg("hints") = py::none(),
+     py::arg("bin_size_factor") = 1.0,
+     py::arg("species") = py::none(),
+     py::arg("species_cutoffs") = py::none());
+
   module.def("create_paddings",
              [](double const influence_distance,
                 py::array_t<double> cell,
                 py::array_t<int> pbc,
                 py::array_t<double> coords,
-                py::array_t<int> species) {
+                py::array_t<int> species,
+                int const num_threads,
+                bool const return_shifts) {
     int const natoms_1 = static_cast<int>(coords.size() / 3);
     int const natoms_2 = static_cast<int>(species.size());
 
@@ -183,69 +1299,467 @@ PYBIND11_MODULE(neighlist, module)
     double const * coords_data = coords.data();
     int const * species_data = species.data();
 
-    int number_of_pads;
-    std::vector<double> pad_coords;
-    std::vector<int> pad_species;
-    std::vector<int> pad_image;
-
-    int error = nbl_create_paddings(natoms,
-                                    influence_distance,
-                                    cell_data,
-                                    pbc_data,
-                                    coords_data,
-                                    species_data,
-                                    number_of_pads,
-                                    pad_coords,
-                                    pad_species,
-                                    pad_image);
+    PaddingPlan plan;
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_plan_paddings(
+          plan, natoms, influence_distance, cell_data, pbc_data, coords_data);
+    }
     if (error == 1)
     {
       throw std::runtime_error(
           "In inverting the cell matrix, the determinant is 0!");
     }
 
-    // pack as a 2D numpy array
-    auto coordinates_of_paddings
-        = py::array(py::buffer_info(pad_coords.data(),
-                                    sizeof(double),
-                                    py::format_descriptor<double>::format(),
-                                    2,
-                                    {number_of_pads, 3},
-                                    {sizeof(double) * 3, sizeof(double)}));
+    int const number_of_pads = plan.numberOfPaddings;
 
-    // pack as a numpy array
-    auto species_code_of_paddings
-        = py::array(py::buffer_info(pad_species.data(),
-                                    sizeof(int),
-                                    py::format_descriptor<int>::format(),
-                                    1,
-                                    {number_of_pads},
-                                    {sizeof(int)}));
+    // the paddings are written directly into the numpy arrays
+    py::array_t<double> coordinates_of_paddings({number_of_pads, 3});
+    py::array_t<int> species_code_of_paddings(number_of_pads);
+    py::array_t<int> master_particle_of_paddings(number_of_pads);
+    int const number_of_shifts = return_shifts ? number_of_pads : 0;
+    py::array_t<int> shifts_of_paddings({number_of_shifts, 3});
 
-    // pack as a numpy array
-    auto master_particle_of_paddings
-        = py::array(py::buffer_info(pad_image.data(),
-                                    sizeof(int),
-                                    py::format_descriptor<int>::format(),
-                                    1,
-                                    {number_of_pads},
-                                    {sizeof(int)}));
+    double * pad_coords = coordinates_of_paddings.mutable_data();
+    int * pad_species = species_code_of_paddings.mutable_data();
+    int * pad_image = master_particle_of_paddings.mutable_data();
+    int * pad_shifts
+        = return_shifts ? shifts_of_paddings.mutable_data() : nullptr;
+    {
+      py::gil_scoped_release release;
+      nbl_fill_paddings(plan,
+                        species_data,
+                        pad_coords,
+                        pad_species,
+                        pad_image,
+                        pad_shifts,
+                        num_threads);
+    }
 
-    py::tuple re(3);
+    py::tuple re(return_shifts ? 4 : 3);
     re[0] = coordinates_of_paddings;
     re[1] = species_code_of_paddings;
     re[2] = master_particle_of_paddings;
+    if (return_shifts) { re[3] = shifts_of_paddings; }
     return re;
   }, R"pbdoc(
      Create padding.
 
+     The images are filled by ``num_threads`` threads (all the available
+     cores if ``num_threads <= 0``).
+
+     With ``return_shifts=True``, the shift of each padding (in units of the
+     cell vectors) is returned as well, so that the paddings can be moved
+     with their master particles by ``refresh_paddings``.
+
      Returns:
          2darray, 1darray, 1darray: coordinates_of_paddings,
              species_code_of_paddings, master_particle_of_paddings
+         or, with ``return_shifts=True``,
+         2darray, 1darray, 1darray, 2darray: coordinates_of_paddings,
+             species_code_of_paddings, master_particle_of_paddings,
+             shifts_of_paddings
      )pbdoc",
      py::arg("influence_distance"),
      py::arg("cell").noconvert(),
      py::arg("pbc").noconvert(),
      py::arg("coords").noconvert(),
-     py::arg("species").noconvert());
+     py::arg("species").noconvert(),
+     py::arg("num_threads") = 1,
+     py::arg("return_shifts") = false);
+
+  module.def("refresh_paddings",
+             [](py::array_t<double> coords,
+                py::array_t<double> cell,
+                py::array_t<double, py::array::c_style> pad_coords,
+                py::array_t<int> master,
+                py::array_t<int> shifts,
+                py::object reference_coords,
+                double const skin,
+                int const num_threads) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+    int const number_of_pads = static_cast<int>(master.size());
+
+    if ((pad_coords.size() != 3 * number_of_pads)
+        || (shifts.size() != 3 * number_of_pads))
+    {
+      throw std::runtime_error("\"pad_coords\", \"master\" and \"shifts\" "
+                               "sizes do not match!");
+    }
+
+    double const * coords_data = coords.data();
+    double const * cell_data = cell.data();
+    int const * master_data = master.data();
+    int const * shifts_data = shifts.data();
+    for (int p = 0; p < number_of_pads; p++)
+    {
+      if (master_data[p] < 0 || master_data[p] >= natoms)
+      {
+        throw std::runtime_error("master[" + std::to_string(p) + "] = "
+                                 + std::to_string(master_data[p])
+                                 + " is not a particle!");
+      }
+    }
+
+    // the paddings are no longer complete once a particle has moved more
+    // than skin / 2 since they were created
+    if (!reference_coords.is_none())
+    {
+      auto reference = reference_coords.cast<py::array_t<double> >();
+      if (reference.size() != coords.size())
+      {
+        throw std::runtime_error("\"reference_coords\" and \"coords\" "
+                                 "sizes do not match!");
+      }
+
+      if (nbl_check_displacement(natoms, coords_data, reference.data(), skin))
+      {
+        return false;
+      }
+    }
+
+    double * pad_coords_data = pad_coords.mutable_data();
+    {
+      py::gil_scoped_release release;
+      nbl_refresh_paddings(number_of_pads,
+                           cell_data,
+                           coords_data,
+                           master_data,
+                           shifts_data,
+                           pad_coords_data,
+                           num_threads);
+    }
+
+    return true;
+  }, R"pbdoc(
+     Move the paddings with their master particles, in place.
+
+     The coordinates of padding ``p`` are set to
+     ``coords[master[p]] + shifts[p] @ cell``, where ``master`` and ``shifts``
+     come from ``create_paddings(..., return_shifts=True)``. Since
+     ``pad_coords`` is written in place, it can be (a view of) the
+     coordinates registered with a KIM compute arguments object.
+
+     If the paddings are created with ``influence_distance + skin``, they
+     stay complete until a particle has moved more than ``skin / 2`` from
+     ``reference_coords``, its position when the paddings were created. In
+     that case, nothing is written and ``False`` is returned, and the
+     paddings have to be created again. A change of the cell is not
+     checked.
+
+     Returns:
+         bool: whether the paddings are refreshed
+     )pbdoc",
+     py::arg("coords").noconvert(),
+     py::arg("cell").noconvert(),
+     py::arg("pad_coords").noconvert(),
+     py::arg("master").noconvert(),
+     py::arg("shifts").noconvert(),
+     py::arg("reference_coords") = py::none(),
+     py::arg("skin") = 0.0,
+     py::arg("num_threads") = 1);
+
+  module.def("fold_paddings",
+             [](py::array_t<int> master,
+                py::object forces,
+                py::object particle_energy,
+                py::object particle_virial,
+                int const num_threads) {
+    int const number_of_pads = static_cast<int>(master.size());
+
+    // the arrays to fold and their number of values per particle
+    std::vector<double *> arrays;
+    std::vector<int> columns;
+    py::ssize_t total = -1;
+    auto add_array
+        = [&](py::object obj, char const * name, int const number_of_columns) {
+      if (obj.is_none()) { return; }
+      if (!py::isinstance<py::array_t<double, py::array::c_style> >(obj))
+      {
+        throw std::runtime_error("\"" + std::string(name)
+                                 + "\" is not a C-contiguous float64 "
+                                   "array!");
+      }
+      auto array = obj.cast<py::array_t<double, py::array::c_style> >();
+      py::ssize_t const rows = array.size() / number_of_columns;
+      if ((array.size() % number_of_columns != 0)
+          || (total >= 0 && rows != total))
+      {
+        throw std::runtime_error("\"" + std::string(name)
+                                 + "\" size does not match!");
+      }
+      total = rows;
+      arrays.push_back(array.mutable_data());
+      columns.push_back(number_of_columns);
+    };
+    add_array(forces, "forces", 3);
+    add_array(particle_energy, "particle_energy", 1);
+    add_array(particle_virial, "particle_virial", 6);
+
+    if (arrays.empty()) { return; }
+
+    int const natoms = static_cast<int>(total - number_of_pads);
+    if (natoms < 0)
+    {
+      throw std::runtime_error("The arrays have fewer rows than \"master\"!");
+    }
+
+    int const * master_data = master.data();
+    for (int p = 0; p < number_of_pads; p++)
+    {
+      if (master_data[p] < 0 || master_data[p] >= natoms)
+      {
+        throw std::runtime_error("master[" + std::to_string(p) + "] = "
+                                 + std::to_string(master_data[p])
+                                 + " is not a particle!");
+      }
+    }
+
+    {
+      py::gil_scoped_release release;
+      nbl_fold_paddings(natoms,
+                        number_of_pads,
+                        master_data,
+                        static_cast<int>(arrays.size()),
+                        arrays.data(),
+                        columns.data(),
+                        num_threads);
+    }
+  }, R"pbdoc(
+     Add the forces, particle energies and particle virials of the paddings
+     to those of their master particles, in place.
+
+     Each array has a row for each particle, followed by a row for each
+     padding, i.e. it is the array computed for the padded configuration
+     (e.g. the forces of shape ``(len(coords) + len(master), 3)``). After
+     the call, the rows of the particles hold the sums, the same as from
+     ``np.add.at(forces, master, forces[len(coords):])`` and then taking
+     ``forces[:len(coords)]``. The rows of the paddings are left unchanged.
+     The arrays that are ``None`` are skipped.
+
+     The particles are split across ``num_threads`` threads (all the
+     available cores if ``num_threads <= 0``), and the result does not
+     depend on the number of threads.
+     )pbdoc",
+     py::arg("master").noconvert(),
+     py::arg("forces") = py::none(),
+     py::arg("particle_energy") = py::none(),
+     py::arg("particle_virial") = py::none(),
+     py::arg("num_threads") = 1);
+
+  module.def("build_padded",
+             [](NeighList &neigh,
+                py::array_t<double> coords,
+                py::array_t<int> species,
+                py::array_t<double> cell,
+                py::array_t<int> pbc,
+                double const influence_distance,
+                py::array_t<double> cutoffs,
+                int const num_threads,
+                bool const half,
+                bool const shared_storage,
+                bool const store_distances,
+                std::string const & engine,
+                py::object const & hints,
+                double const bin_size_factor,
+                py::object const & species_cutoffs) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+
+    if (species.size() != natoms)
+    {
+      throw std::runtime_error("\"coords\" size and \"species\" size do not "
+                               "match!");
+    }
+
+    double const * coords_data = coords.data();
+    int const * species_data = species.data();
+    double const * cell_data = cell.data();
+    int const * pbc_data = pbc.data();
+    int const number_of_cutoffs = static_cast<int>(cutoffs.size());
+    double const * cutoffs_data = cutoffs.data();
+
+    int const engine_id = get_engine(engine);
+    double const bin_factor = get_bin_size_factor(bin_size_factor);
+    std::vector<int> const model_hints
+        = get_hints(hints, number_of_cutoffs, half);
+    int number_of_species;
+    std::vector<double> const pair_cutoffs
+        = get_species_cutoffs(species_cutoffs, number_of_species);
+    if (number_of_species > 0)
+    {
+      get_species(species, natoms, number_of_species);
+    }
+
+    neigh.half = half ? 1 : 0;
+    neigh.sharedStorage = shared_storage ? 1 : 0;
+    neigh.storeDistances = store_distances ? 1 : 0;
+    neigh.engine = engine_id;
+    neigh.binSizeFactor = bin_factor;
+    neigh.tileSize = 0;
+    neigh.hints = model_hints;
+    // the species of the particles and paddings are set by nbl_build_padded
+    neigh.numberOfSpecies = number_of_species;
+    neigh.speciesCutoffs = pair_cutoffs;
+    neigh.speciesCode.clear();
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_build_padded(&neigh,
+                               natoms,
+                               coords_data,
+                               species_data,
+                               cell_data,
+                               pbc_data,
+                               influence_distance,
+                               number_of_cutoffs,
+                               cutoffs_data,
+                               num_threads);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("In inverting the cell matrix, the determinant "
+                               "is 0! or\nCell size too large! (partilces fly "
+                               "away) or\nCollision of atoms happened! or\n"
+                               "The neighbor list is too large!");
+    }
+
+    // the arrays keep the configuration alive, even if a later build has to
+    // allocate a new one
+    auto * owner = new std::shared_ptr<PaddedConfiguration>(neigh.padded);
+    py::capsule base(owner, [](void * p) {
+      delete static_cast<std::shared_ptr<PaddedConfiguration> *>(p);
+    });
+
+    PaddedConfiguration & padded = *neigh.padded;
+    py::ssize_t const total = natoms + padded.numberOfPaddings;
+    py::ssize_t const number_of_pads = padded.numberOfPaddings;
+
+    py::tuple re(5);
+    re[0] = py::array_t<double>(
+        {total, py::ssize_t(3)}, padded.coordinates.data(), base);
+    re[1] = py::array_t<int>(total, padded.speciesCode.data(), base);
+    re[2] = py::array_t<int>(total, padded.needNeighbors.data(), base);
+    re[3] = py::array_t<int>(
+        number_of_pads, padded.masterOfPaddings.data(), base);
+    re[4] = py::array_t<int>(
+        {number_of_pads, py::ssize_t(3)}, padded.shiftOfPaddings.data(), base);
+    return re;
+  }, R"pbdoc(
+     Create the paddings of a periodic configuration and build the neighbor
+     list of the padded configuration, in one call.
+
+     This does the same as ``create_paddings``, concatenating the particles
+     and the paddings, and ``neigh.build``, but without the GIL and without
+     allocating new arrays at each call. The padded configuration is written
+     into buffers owned by ``neigh``, and the returned arrays are views of
+     them. The particles come first, followed by the paddings, and only the
+     particles need neighbors, so ``need_neigh`` is also the
+     ``particle_contributing`` of a KIM model.
+
+     The next call with the same ``neigh`` writes into the same buffers, so
+     the arrays, and the pointers registered with a KIM compute arguments
+     object, stay valid and are updated in place. Only if the number of
+     particles and paddings exceeds the room of the buffers are new ones
+     allocated (which can be checked by comparing the arrays, e.g. with
+     ``np.shares_memory``); the old arrays then keep the old configuration.
+
+     The paddings can be moved with their master particles by
+     ``refresh_paddings``. With ``hints``, the lists that the model requests
+     for the noncontributing particles are also built for the paddings.
+     ``species_cutoffs`` applies to the codes in ``species``, which are
+     also those of the paddings.
+
+     Returns:
+         2darray, 1darray, 1darray, 1darray, 2darray: coords, species,
+             need_neigh, master_particle_of_paddings, shifts_of_paddings
+     )pbdoc",
+     py::arg("neigh"),
+     py::arg("coords").noconvert(),
+     py::arg("species").noconvert(),
+     py::arg("cell").noconvert(),
+     py::arg("pbc").noconvert(),
+     py::arg("influence_distance"),
+     py::arg("cutoffs").noconvert(),
+     py::arg("num_threads") = 1,
+     py::arg("half") = false,
+     py::arg("shared_storage") = false,
+     py::arg("store_distances") = false,
+     py::arg("engine") = "auto",
+     py::arg("hints") = py::none(),
+     py::arg("bin_size_factor") = 1.0,
+     py::arg("species_cutoffs") = py::none());
+
+  module.def("get_spatial_order",
+             [](py::array_t<double> coords) {
+    int const natoms = static_cast<int>(coords.size() / 3);
+    double const * coords_data = coords.data();
+
+    py::array_t<int> order(natoms);
+    int * order_data = order.mutable_data();
+    {
+      py::gil_scoped_release release;
+      nbl_get_spatial_order(natoms, coords_data, order_data);
+    }
+
+    return order;
+  }, R"pbdoc(
+     Get the order of the particles along a Morton (Z-order) curve.
+
+     Particles that are close in space are close in this order. Permuting
+     the particles (with ``permute``) into this order before building the
+     neighbor list improves the cache locality of both the build and the
+     traversal of the neighbors in the model compute.
+
+     Returns:
+         1darray: order, such that ``coords[order]`` is sorted along the curve
+     )pbdoc",
+     py::arg("coords").noconvert());
+
+  module.def("permute",
+             [](py::array_t<int> order, py::array array, bool const inverse) {
+    int const natoms = static_cast<int>(order.size());
+
+    if (array.ndim() < 1 || array.shape(0) != natoms)
+    {
+      throw std::runtime_error("The first dimension of \"array\" is not "
+                               "the size of \"order\"!");
+    }
+    if (!(array.flags() & py::array::c_style) || !array.writeable())
+    {
+      throw std::runtime_error("\"array\" is not C-contiguous and "
+                               "writeable!");
+    }
+
+    int const * order_data = order.data();
+    std::size_t const row_size
+        = natoms > 0 ? static_cast<std::size_t>(array.nbytes()) / natoms : 0;
+    void * array_data = array.mutable_data();
+
+    int error;
+    {
+      py::gil_scoped_release release;
+      error = nbl_permute(natoms, row_size, order_data, inverse, array_data);
+    }
+    if (error == 1)
+    {
+      throw std::runtime_error("\"order\" is not a permutation!");
+    }
+  }, R"pbdoc(
+     Reorder the rows of an array in place.
+
+     With ``inverse=False``, row ``j`` becomes the old row ``order[j]``, i.e.
+     ``array[:] = array[order]``. With ``inverse=True``, the permutation is
+     undone, i.e. ``array[order] = array``.
+
+     Since the memory of ``array`` is reused, the arrays registered with a
+     KIM compute arguments object (coordinates, species codes, contributing
+     flags) can be permuted before ``compute``, and the outputs (forces,
+     partial particle energy, ...) can be permuted back after it.
+     )pbdoc",
+     py::arg("order").noconvert(),
+     py::arg("array"),
+     py::arg("inverse") = false);
 }
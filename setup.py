@@ -146,6 +146,11 @@ class BuildExt(build_ext):
 
         link_opts = self.l_opts.get(compiler_type, [])
 
+        # std::thread is used by the neighbor list
+        if compiler_type == "unix" and has_flag(self.compiler, "-pthread"):
+            opts.append("-pthread")
+            link_opts.append("-pthread")
+
         kim_extra_link_args = inquire_kim_api("--libs-only-other")
         for link_arg in kim_extra_link_args:
             link_opts.append(link_arg)
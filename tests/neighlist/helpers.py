@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def create_graphite_unit_cell(alat=2.46, d=3.35):
+
+    cell = np.zeros((3, 3), dtype=np.double)
+    cell[0][0] = alat
+    cell[1][0] = 0.5 * alat
+    cell[1][1] = np.sqrt(3) * 0.5 * alat
+    cell[2][2] = 2 * d
+
+    coords = np.empty((4, 3), dtype=np.double)
+    coords[0] = np.zeros((3), dtype=np.double)
+    coords[1] = (cell[0] + cell[1]) / 3.0
+    coords[2] = (cell[0] + cell[1]) / 3.0 + cell[2] / 2.0
+    coords[3] = (cell[0] + cell[1]) * 2 / 3.0 + cell[2] / 2.0
+
+    species = np.array([1, 1, 2, 2], dtype=np.intc)
+
+    return cell, coords, species
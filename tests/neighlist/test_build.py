@@ -0,0 +1,1072 @@
+import tempfile
+
+import numpy as np
+import pytest
+
+from kimpy import neighlist as nl
+
+from helpers import create_graphite_unit_cell
+
+
+def create_random_config(natoms=500, density=0.08, seed=1):
+
+    rng = np.random.default_rng(seed)
+    length = (natoms / density) ** (1.0 / 3.0)
+    coords = rng.random((natoms, 3)) * length
+    return np.asarray(coords, dtype=np.double)
+
+
+def get_all_neigh(neigh, cutoffs, natoms):
+
+    all_neigh = []
+    for k in range(len(cutoffs)):
+        for i in range(natoms):
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            all_neigh.append(list(neighbors))
+    return all_neigh
+
+
+def get_neigh_sets(neigh, cutoffs, natoms):
+    return [sorted(neighbors) for neighbors in get_all_neigh(neigh, cutoffs, natoms)]
+
+
+def test_num_threads():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    need_neigh[::3] = 0
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    serial = get_all_neigh(neigh, cutoffs, natoms)
+
+    for num_threads in [2, 3, 0]:
+        neigh = nl.create()
+        neigh.build(coords, influence_dist, cutoffs, need_neigh, num_threads)
+        assert get_all_neigh(neigh, cutoffs, natoms) == serial
+
+
+def test_build_periodic():
+
+    cell, contrib_coords, contrib_species = create_graphite_unit_cell()
+    n_contrib = contrib_coords.shape[0]
+
+    cutoffs = np.array([3.36, 3.37], dtype=np.double)
+    influence_dist = cutoffs[1]
+    pbc = np.array([1, 1, 1], dtype=np.intc)
+
+    # reference from explicit padding atoms
+    pad_coords, pad_species, _ = nl.create_paddings(
+        influence_dist, cell, pbc, contrib_coords, contrib_species
+    )
+    coords = np.asarray(np.concatenate((contrib_coords, pad_coords)), dtype=np.double)
+    need_neigh = np.concatenate((np.ones(n_contrib), np.zeros(len(pad_coords))))
+    need_neigh = np.asarray(need_neigh, dtype=np.intc)
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+    need_neigh = np.ones(n_contrib, dtype=np.intc)
+    periodic_neigh = nl.create()
+    ghost_coords, ghost_master, ghost_shifts = periodic_neigh.build_periodic(
+        contrib_coords, cell, pbc, influence_dist, cutoffs, need_neigh
+    )
+
+    assert len(ghost_coords) < len(pad_coords)
+    assert np.allclose(ghost_coords, contrib_coords[ghost_master] + ghost_shifts @ cell)
+
+    all_coords = np.concatenate((contrib_coords, ghost_coords))
+
+    for k in range(len(cutoffs)):
+        for i in range(n_contrib):
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            _, periodic_neighbors = periodic_neigh.get_neigh(cutoffs, k, i)
+            expected = sorted(map(tuple, np.round(coords[neighbors], 8)))
+            got = sorted(map(tuple, np.round(all_coords[periodic_neighbors], 8)))
+            assert got == expected
+
+    # ghosts do not have neighbors
+    num_neigh, _ = periodic_neigh.get_neigh(cutoffs, 0, n_contrib)
+    assert num_neigh == 0
+
+    # the ghosts are numbered the same way with more threads
+    threaded_neigh = nl.create()
+    ghosts = threaded_neigh.build_periodic(
+        contrib_coords, cell, pbc, influence_dist, cutoffs, need_neigh, num_threads=3
+    )
+    assert np.array_equal(ghosts[1], ghost_master)
+    assert np.array_equal(ghosts[2], ghost_shifts)
+    assert np.array_equal(threaded_neigh.get_csr(1)[2], periodic_neigh.get_csr(1)[2])
+
+
+def test_build_periodic_small_cell():
+
+    # the cutoff spans several cells, so the images are gathered per grid cell
+    cell, contrib_coords, contrib_species = create_graphite_unit_cell()
+    n_contrib = contrib_coords.shape[0]
+
+    cutoffs = np.array([6.0, 10.0], dtype=np.double)
+    influence_dist = cutoffs[1]
+    pbc = np.array([1, 1, 0], dtype=np.intc)
+
+    pad_coords, _, _ = nl.create_paddings(
+        influence_dist, cell, pbc, contrib_coords, contrib_species
+    )
+    coords = np.asarray(np.concatenate((contrib_coords, pad_coords)), dtype=np.double)
+    need_neigh = np.concatenate((np.ones(n_contrib), np.zeros(len(pad_coords))))
+    need_neigh = np.asarray(need_neigh, dtype=np.intc)
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+    need_neigh = np.ones(n_contrib, dtype=np.intc)
+    periodic_neigh = nl.create()
+    ghost_coords, ghost_master, ghost_shifts = periodic_neigh.build_periodic(
+        contrib_coords, cell, pbc, influence_dist, cutoffs, need_neigh, num_threads=2
+    )
+    assert np.allclose(ghost_coords, contrib_coords[ghost_master] + ghost_shifts @ cell)
+
+    all_coords = np.concatenate((contrib_coords, ghost_coords))
+
+    for k in range(len(cutoffs)):
+        for i in range(n_contrib):
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            _, periodic_neighbors = periodic_neigh.get_neigh(cutoffs, k, i)
+            expected = sorted(map(tuple, np.round(coords[neighbors], 8)))
+            got = sorted(map(tuple, np.round(all_coords[periodic_neighbors], 8)))
+            assert got == expected
+
+
+def test_skin():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    skin = 0.4
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh, skin=skin)
+
+    # small displacements keep the current lists
+    rng = np.random.default_rng(2)
+    new_coords = coords + rng.uniform(-0.1, 0.1, coords.shape)
+    assert not neigh.update(new_coords)
+
+    ref_neigh = nl.create()
+    ref_neigh.build(new_coords, influence_dist, cutoffs, need_neigh)
+
+    for k, cut in enumerate(cutoffs):
+        for i in range(natoms):
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            _, ref_neighbors = ref_neigh.get_neigh(cutoffs, k, i)
+            rij = np.linalg.norm(new_coords[neighbors] - new_coords[i], axis=1)
+            assert set(neighbors[rij < cut]) == set(ref_neighbors)
+
+    # a particle moving more than half the skin triggers a rebuild
+    new_coords[0] += 0.3
+    assert neigh.update(new_coords)
+    assert not neigh.update(new_coords)
+
+
+def test_get_csr():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    need_neigh[::3] = 0
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+    for k in range(len(cutoffs)):
+        num_neigh, begin_index, neigh_list = neigh.get_csr(k)
+        # 64-bit offsets, 32-bit particle indices
+        assert begin_index.dtype == np.int64
+        assert neigh_list.dtype == np.intc
+
+        for i in range(natoms):
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            start = begin_index[i]
+            assert np.array_equal(neigh_list[start : start + num_neigh[i]], neighbors)
+
+    # read-only views, which keep the lists of the time they were taken
+    assert not neigh_list.flags.writeable
+    assert np.shares_memory(neigh_list, neigh.get_csr(1)[2])
+    expected = neigh_list.copy()
+    coords[0] += 0.5
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    assert not np.shares_memory(neigh_list, neigh.get_csr(1)[2])
+    num_neigh = neigh.get_csr(1)[0]
+    expected_num_neigh = num_neigh.copy()
+    neigh.move_particle(coords, 1, coords[1] + 0.5)
+    assert np.array_equal(num_neigh, expected_num_neigh)
+    big_coords = create_random_config(natoms=4 * natoms)
+    neigh.build(big_coords, influence_dist, cutoffs, np.ones(4 * natoms, dtype=np.intc))
+    neigh.shrink()
+    del neigh
+    assert np.array_equal(neigh_list, expected)
+    assert np.array_equal(num_neigh, expected_num_neigh)
+
+
+def get_pairs(neigh, neighbor_list_index):
+
+    num_neigh, begin_index, neigh_list = neigh.get_csr(neighbor_list_index)
+
+    pairs = []
+    for i in range(len(num_neigh)):
+        start = begin_index[i]
+        for j in neigh_list[start : start + num_neigh[i]]:
+            pairs.append((i, j))
+    return pairs
+
+
+def test_max_list_size():
+
+    coords = create_random_config(natoms=300)
+    natoms = coords.shape[0]
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, need_neigh, num_threads=4)
+
+    # the 64-bit offsets of the chunks add up as in a serial build
+    sizes = []
+    for k in range(len(cutoffs)):
+        num_neigh, begin_index, neigh_list = ref.get_csr(k)
+        assert begin_index.dtype == np.int64
+        assert begin_index[0] == 0
+        assert np.array_equal(begin_index[1:], np.cumsum(num_neigh)[:-1])
+        assert begin_index[-1] + num_neigh[-1] == len(neigh_list)
+        sizes.append(len(neigh_list))
+
+    neigh = nl.create(max_list_size=max(sizes))
+    neigh.build(coords, influence_dist, cutoffs, need_neigh, num_threads=4)
+    assert get_neigh_sets(neigh, cutoffs, natoms) == get_neigh_sets(
+        ref, cutoffs, natoms
+    )
+
+    # one entry less does not fit
+    neigh = nl.create(max_list_size=max(sizes) - 1)
+    with pytest.raises(RuntimeError):
+        neigh.build(coords, influence_dist, cutoffs, need_neigh, num_threads=4)
+
+    cell, coords, _ = create_graphite_unit_cell()
+    pbc = np.ones(3, dtype=np.intc)
+    need_neigh = np.ones(coords.shape[0], dtype=np.intc)
+    neigh = nl.create(max_list_size=1)
+    with pytest.raises(RuntimeError):
+        neigh.build_periodic(coords, cell, pbc, influence_dist, cutoffs, need_neigh)
+
+    with pytest.raises(RuntimeError):
+        nl.create(max_list_size=-1)
+
+
+def test_half():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    need_neigh[::3] = 0
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+    half_neigh = nl.create()
+    half_neigh.build(coords, influence_dist, cutoffs, need_neigh, half=True)
+
+    for k in range(len(cutoffs)):
+        full_pairs = set(frozenset(p) for p in get_pairs(neigh, k))
+        half_pairs = get_pairs(half_neigh, k)
+
+        # each pair is stored once
+        assert len(half_pairs) == len(set(frozenset(p) for p in half_pairs))
+        assert set(frozenset(p) for p in half_pairs) == full_pairs
+
+    with pytest.raises(RuntimeError):
+        half_neigh.get_neigh(cutoffs, 0, 0)
+
+
+def test_reuse_memory():
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+
+    neigh = nl.create()
+    for natoms, seed in [(500, 1), (100, 2), (300, 3), (500, 4)]:
+        coords = create_random_config(natoms=natoms, seed=seed)
+        need_neigh = np.ones(natoms, dtype=np.intc)
+        neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+        # a rebuilt list is the same as a new one
+        ref_neigh = nl.create()
+        ref_neigh.build(coords, influence_dist, cutoffs, need_neigh)
+        expected = get_all_neigh(ref_neigh, cutoffs, natoms)
+        assert get_all_neigh(neigh, cutoffs, natoms) == expected
+
+    # memory of the largest build is kept
+    coords = create_random_config(natoms=100, seed=5)
+    need_neigh = np.ones(100, dtype=np.intc)
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    allocated, used = neigh.get_memory_usage()
+    assert allocated > used
+
+    expected = get_all_neigh(neigh, cutoffs, 100)
+    neigh.shrink()
+    shrunk_allocated, shrunk_used = neigh.get_memory_usage()
+    assert shrunk_used == used
+    assert shrunk_allocated < allocated
+    assert get_all_neigh(neigh, cutoffs, 100) == expected
+
+
+def test_spatial_order():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+    species = np.arange(natoms, dtype=np.intc)
+
+    order = nl.get_spatial_order(coords)
+    assert sorted(order) == list(range(natoms))
+
+    # permute in place
+    sorted_coords = coords.copy()
+    nl.permute(order, sorted_coords)
+    nl.permute(order, species)
+    assert np.array_equal(sorted_coords, coords[order])
+    assert np.array_equal(species, order)
+
+    # neighbors are the same particles, with new indices
+    cutoffs = np.array([3.5], dtype=np.double)
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    neigh = nl.create()
+    neigh.build(coords, cutoffs[0], cutoffs, need_neigh)
+    sorted_neigh = nl.create()
+    sorted_neigh.build(sorted_coords, cutoffs[0], cutoffs, need_neigh)
+    for j in range(natoms):
+        _, neighbors = sorted_neigh.get_neigh(cutoffs, 0, j)
+        _, expected = neigh.get_neigh(cutoffs, 0, order[j])
+        assert sorted(order[neighbors]) == sorted(expected)
+
+    # per-particle outputs are permuted back
+    forces = sorted_coords.copy()
+    nl.permute(order, forces, inverse=True)
+    assert np.array_equal(forces, coords)
+
+    with pytest.raises(RuntimeError):
+        nl.permute(np.zeros(natoms, dtype=np.intc), forces)
+
+
+def test_shared_storage():
+
+    coords = create_random_config()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([3.5, 2.0, 3.0], dtype=np.double)
+    influence_dist = cutoffs[0]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    shared_neigh = nl.create()
+    shared_neigh.build(coords, influence_dist, cutoffs, need_neigh, shared_storage=True)
+
+    for i in range(natoms):
+        _, largest = shared_neigh.get_neigh(cutoffs, 0, i)
+        for k in range(len(cutoffs)):
+            num_neigh, neighbors = shared_neigh.get_neigh(cutoffs, k, i)
+            _, expected = neigh.get_neigh(cutoffs, k, i)
+            assert sorted(neighbors) == sorted(expected)
+            # neighbors within a smaller cutoff are a prefix
+            assert list(neighbors) == list(largest[:num_neigh])
+
+    # all the lists share one array of neighbors
+    _, used = neigh.get_memory_usage()
+    _, shared_used = shared_neigh.get_memory_usage()
+    assert shared_used < used
+    assert len(shared_neigh.get_csr(1)[2]) == len(neigh.get_csr(0)[2])
+
+
+def test_store_distances():
+
+    cell, coords, species = create_graphite_unit_cell()
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 4.0], dtype=np.double)
+    influence_dist = cutoffs[1]
+    pbc = np.ones(3, dtype=np.intc)
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    neigh = nl.create()
+    ghost_coords, _, _ = neigh.build_periodic(
+        coords, cell, pbc, influence_dist, cutoffs, need_neigh, store_distances=True
+    )
+    all_coords = np.concatenate((coords, ghost_coords))
+
+    for k in range(len(cutoffs)):
+        num_neigh, begin_index, neighbor_list = neigh.get_csr(k)
+        displacements, distances = neigh.get_distances(k)
+        assert displacements.shape == (len(neighbor_list), 3)
+        assert distances.shape == (len(neighbor_list),)
+
+        for i in range(natoms):
+            begin = begin_index[i]
+            end = begin + num_neigh[i]
+            expected = all_coords[neighbor_list[begin:end]] - coords[i]
+            assert np.allclose(displacements[begin:end], expected)
+            assert np.allclose(distances[begin:end], np.linalg.norm(expected, axis=1))
+
+    # read-only views, which outlive the storage of the list
+    assert not distances.flags.writeable
+    assert np.shares_memory(distances, neigh.get_distances(1)[1])
+    expected = distances.copy()
+    neigh.build_periodic(
+        coords + 0.1,
+        cell,
+        pbc,
+        influence_dist,
+        cutoffs,
+        need_neigh,
+        store_distances=True,
+    )
+    assert not np.shares_memory(distances, neigh.get_distances(1)[1])
+    neigh.shrink()
+    assert np.array_equal(distances, expected)
+
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    with pytest.raises(RuntimeError):
+        neigh.get_distances(0)
+
+
+def test_engine():
+
+    # a slab with a large vacuum, and a particle that flew away
+    coords = create_random_config(natoms=200)
+    coords[:100, 2] += 100.0
+    coords[0] = [300.0, -300.0, 300.0]
+    natoms = coords.shape[0]
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    # the order of neighbors depends on the grid
+    all_neigh = []
+    for engine in ["auto", "dense", "sparse", "brute"]:
+        neigh = nl.create()
+        neigh.build(coords, influence_dist, cutoffs, need_neigh, engine=engine)
+        all_neigh.append(get_neigh_sets(neigh, cutoffs, natoms))
+    assert all_neigh[0] == all_neigh[1]
+    assert all_neigh[0] == all_neigh[2]
+    assert all_neigh[0] == all_neigh[3]
+
+    # the dense grid would be too large
+    coords[0] = [1.0e4, -1.0e4, 1.0e4]
+    with pytest.raises(RuntimeError):
+        neigh.build(coords, influence_dist, cutoffs, need_neigh, engine="dense")
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    assert get_neigh_sets(neigh, cutoffs, natoms) == all_neigh[0]
+
+    with pytest.raises(RuntimeError):
+        neigh.build(coords, influence_dist, cutoffs, need_neigh, engine="octree")
+
+
+def test_create_paddings():
+
+    cell, coords, species = create_graphite_unit_cell()
+    influence_dist = 5.0
+    pbc = np.array([1, 1, 0], dtype=np.intc)
+
+    pad_coords, pad_species, pad_image = nl.create_paddings(
+        influence_dist, cell, pbc, coords, species
+    )
+    assert np.array_equal(pad_species, species[pad_image])
+
+    for num_threads in [2, 0]:
+        re = nl.create_paddings(
+            influence_dist, cell, pbc, coords, species, num_threads=num_threads
+        )
+        assert np.array_equal(re[0], pad_coords)
+        assert np.array_equal(re[1], pad_species)
+        assert np.array_equal(re[2], pad_image)
+
+    # all the images within the influence distance of a particle are paddings
+    paddings = set(tuple(np.round(x, 6)) for x in pad_coords)
+    for i in range(-3, 4):
+        for j in range(-3, 4):
+            if i == 0 and j == 0:
+                continue
+            images = coords + i * cell[0] + j * cell[1]
+            for x in images:
+                if np.min(np.linalg.norm(coords - x, axis=1)) < influence_dist:
+                    assert tuple(np.round(x, 6)) in paddings
+
+
+def test_refresh_paddings():
+
+    cell, coords, species = create_graphite_unit_cell()
+    natoms = coords.shape[0]
+    influence_dist = 5.0
+    skin = 1.0
+    pbc = np.ones(3, dtype=np.intc)
+
+    pad_coords, _, pad_image, pad_shifts = nl.create_paddings(
+        influence_dist + skin, cell, pbc, coords, species, return_shifts=True
+    )
+    assert np.allclose(pad_coords, coords[pad_image] + pad_shifts @ cell)
+
+    # the paddings are written in place, e.g. into the registered coordinates
+    all_coords = np.concatenate((coords, pad_coords))
+    reference_coords = coords.copy()
+
+    coords = coords + 0.2
+    refreshed = nl.refresh_paddings(
+        coords,
+        cell,
+        all_coords[natoms:],
+        pad_image,
+        pad_shifts,
+        reference_coords=reference_coords,
+        skin=skin,
+    )
+    assert refreshed
+    assert np.allclose(all_coords[natoms:], coords[pad_image] + pad_shifts @ cell)
+
+    # moved more than skin / 2
+    moved_coords = coords + 0.2
+    refreshed = nl.refresh_paddings(
+        moved_coords,
+        cell,
+        all_coords[natoms:],
+        pad_image,
+        pad_shifts,
+        reference_coords=reference_coords,
+        skin=skin,
+    )
+    assert not refreshed
+    assert np.allclose(all_coords[natoms:], coords[pad_image] + pad_shifts @ cell)
+
+    with pytest.raises(RuntimeError):
+        nl.refresh_paddings(
+            coords, cell, all_coords[natoms:], pad_image[1:], pad_shifts
+        )
+
+
+def test_build_padded():
+
+    cell, coords, species = create_graphite_unit_cell()
+    influence_dist = 5.0
+    cutoffs = np.array([4.0, 5.0])
+    pbc = np.ones(3, dtype=np.intc)
+
+    pad_coords, pad_species, pad_image = nl.create_paddings(
+        influence_dist, cell, pbc, coords, species
+    )
+    ref_coords = np.concatenate((coords, pad_coords))
+    ref_species = np.concatenate((species, pad_species))
+    ref_need_neigh = np.concatenate(
+        (np.ones(len(coords)), np.zeros(len(pad_coords)))
+    ).astype(np.intc)
+    ref = nl.create()
+    ref.build(ref_coords, influence_dist, cutoffs, ref_need_neigh)
+    ref_neigh = get_all_neigh(ref, cutoffs, len(ref_coords))
+
+    neigh = nl.create()
+    all_coords, all_species, need_neigh, image, shifts = nl.build_padded(
+        neigh, coords, species, cell, pbc, influence_dist, cutoffs
+    )
+    assert np.array_equal(all_coords, ref_coords)
+    assert np.array_equal(all_species, ref_species)
+    assert np.array_equal(need_neigh, ref_need_neigh)
+    assert np.array_equal(image, pad_image)
+    assert np.allclose(all_coords[len(coords) :], coords[image] + shifts @ cell)
+    assert get_all_neigh(neigh, cutoffs, len(all_coords)) == ref_neigh
+
+    # the same buffers are updated in place
+    re = nl.build_padded(neigh, coords, species, cell, pbc, influence_dist, cutoffs)
+    assert np.shares_memory(re[0], all_coords)
+    assert np.array_equal(re[0], ref_coords)
+
+    # without particles, there are no paddings
+    re = nl.build_padded(
+        neigh,
+        np.zeros((0, 3)),
+        np.zeros(0, dtype=np.intc),
+        cell,
+        pbc,
+        influence_dist,
+        cutoffs,
+    )
+    assert re[0].shape == (0, 3)
+    assert all(len(a) == 0 for a in re)
+
+    with pytest.raises(RuntimeError):
+        nl.build_padded(neigh, coords, species[1:], cell, pbc, influence_dist, cutoffs)
+
+
+def test_fold_paddings():
+
+    cell, coords, species = create_graphite_unit_cell()
+    natoms = coords.shape[0]
+    pbc = np.ones(3, dtype=np.intc)
+    _, _, pad_image = nl.create_paddings(5.0, cell, pbc, coords, species)
+
+    rng = np.random.default_rng(0)
+    total = natoms + len(pad_image)
+    forces = rng.standard_normal((total, 3))
+    particle_energy = rng.standard_normal(total)
+    particle_virial = rng.standard_normal((total, 6))
+
+    ref_forces = forces.copy()
+    ref_energy = particle_energy.copy()
+    ref_virial = particle_virial.copy()
+    np.add.at(ref_forces, pad_image, ref_forces[natoms:])
+    np.add.at(ref_energy, pad_image, ref_energy[natoms:])
+    np.add.at(ref_virial, pad_image, ref_virial[natoms:])
+
+    for num_threads in [1, 2]:
+        f = forces.copy()
+        e = particle_energy.copy()
+        v = particle_virial.copy()
+        nl.fold_paddings(pad_image, f, e, v, num_threads=num_threads)
+        assert np.allclose(f, ref_forces)
+        assert np.allclose(e, ref_energy)
+        assert np.allclose(v, ref_virial)
+
+    f = forces.copy()
+    nl.fold_paddings(pad_image, forces=f)
+    assert np.allclose(f, ref_forces)
+
+    with pytest.raises(RuntimeError):
+        nl.fold_paddings(pad_image, forces, particle_energy[1:])
+
+
+def test_build_batch():
+
+    cell, graphite_coords, _ = create_graphite_unit_cell()
+    configs = [create_random_config(natoms, seed=natoms) for natoms in [5, 30, 1, 12]]
+    configs.append(graphite_coords)
+    offsets = np.cumsum([0] + [len(c) for c in configs]).astype(np.intc)
+    coords = np.concatenate(configs)
+    influence_dist = 3.0
+    cutoffs = np.array([2.0, 3.0])
+
+    neighs = nl.build_batch(coords, offsets, influence_dist, cutoffs, num_threads=2)
+    assert len(neighs) == len(configs)
+    for c, config in enumerate(configs):
+        natoms = len(config)
+        need_neigh = np.ones(natoms, dtype=np.intc)
+        ref = nl.create()
+        ref.build(config, influence_dist, cutoffs, need_neigh)
+        assert get_all_neigh(neighs[c], cutoffs, natoms) == get_all_neigh(
+            ref, cutoffs, natoms
+        )
+
+    # periodic configurations, rebuilt into the same lists
+    cells = np.array([cell * 4 for _ in configs])
+    pbcs = np.ones((len(configs), 3), dtype=np.intc)
+    pbcs[0] = [1, 1, 0]
+    re = nl.build_batch(
+        coords, offsets, influence_dist, cutoffs, cells=cells, pbcs=pbcs, neighs=neighs
+    )
+    assert all(a is b for a, b in zip(re, neighs))
+    for c, config in enumerate(configs):
+        natoms = len(config)
+        need_neigh = np.ones(natoms, dtype=np.intc)
+        ref = nl.create()
+        ghosts = ref.build_periodic(
+            config, cells[c], pbcs[c], influence_dist, cutoffs, need_neigh
+        )
+        for x, y in zip(neighs[c].get_ghosts(), ghosts):
+            assert np.array_equal(x, y)
+        ntotal = natoms + len(ghosts[1])
+        assert get_all_neigh(neighs[c], cutoffs, ntotal) == get_all_neigh(
+            ref, cutoffs, ntotal
+        )
+
+    with pytest.raises(RuntimeError):
+        nl.build_batch(coords, offsets[::-1].copy(), influence_dist, cutoffs)
+
+
+def test_move_particle():
+
+    coords = create_random_config(natoms=200)
+    natoms = coords.shape[0]
+    influence_dist = 3.5
+    cutoffs = np.array([2.0, 3.5])
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    need_neigh[::4] = 0
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+        i = rng.integers(natoms)
+        old_position = coords[i].copy()
+        before = get_all_neigh(neigh, cutoffs, natoms)
+
+        neigh.move_particle(coords, i, coords[i] + rng.normal(0, 0.5, 3))
+
+        ref = nl.create()
+        ref.build(coords, influence_dist, cutoffs, need_neigh)
+        assert get_neigh_sets(neigh, cutoffs, natoms) == get_neigh_sets(
+            ref, cutoffs, natoms
+        )
+
+        # a rejected move is rolled back exactly
+        if rng.random() < 0.5:
+            neigh.undo_move(coords)
+            assert np.array_equal(coords[i], old_position)
+            assert get_all_neigh(neigh, cutoffs, natoms) == before
+
+    with pytest.raises(RuntimeError):
+        neigh.move_particle(coords, 0, coords[1].copy())
+
+    half = nl.create()
+    half.build(coords, influence_dist, cutoffs, need_neigh, half=True)
+    with pytest.raises(RuntimeError):
+        half.move_particle(coords, 0, coords[0] + 0.1)
+
+
+def test_hints():
+
+    coords = create_random_config(natoms=200)
+    natoms = coords.shape[0]
+    influence_dist = 3.5
+    cutoffs = np.array([3.5, 2.0])
+    contributing = np.zeros(natoms, dtype=np.intc)
+    contributing[: natoms // 2] = 1
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, np.ones(natoms, dtype=np.intc))
+    ref_neigh = get_all_neigh(ref, cutoffs, natoms)
+
+    for hints in [[1, 1], [0, 1], [1, 0], [0, 0]]:
+        hints = np.array(hints, dtype=np.intc)
+        neigh = nl.create()
+        neigh.build(coords, influence_dist, cutoffs, contributing, hints=hints)
+        all_neigh = get_all_neigh(neigh, cutoffs, natoms)
+        for k in range(len(cutoffs)):
+            for i in range(natoms):
+                m = k * natoms + i
+                if contributing[i] or not hints[k]:
+                    assert all_neigh[m] == ref_neigh[m]
+                else:
+                    assert all_neigh[m] == []
+
+    with pytest.raises(RuntimeError):
+        neigh.build(
+            coords,
+            influence_dist,
+            cutoffs,
+            contributing,
+            hints=np.array([1], dtype=np.intc),
+        )
+
+
+def test_bin_size_factor():
+
+    coords = create_random_config(natoms=300)
+    natoms = coords.shape[0]
+    cutoffs = np.array([2.0, 4.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    need_neigh[::3] = 0
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, need_neigh)
+    ref_neigh = get_neigh_sets(ref, cutoffs, natoms)
+
+    # the order of neighbors depends on the grid
+    for factor in [0.5, 0.3]:
+        for engine in ["dense", "sparse"]:
+            neigh = nl.create()
+            neigh.build(
+                coords,
+                influence_dist,
+                cutoffs,
+                need_neigh,
+                engine=engine,
+                bin_size_factor=factor,
+            )
+            assert get_neigh_sets(neigh, cutoffs, natoms) == ref_neigh
+
+    cell, coords, _ = create_graphite_unit_cell()
+    natoms = coords.shape[0]
+    pbc = np.ones(3, dtype=np.intc)
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    ref = nl.create()
+    ref_ghosts = ref.build_periodic(
+        coords, cell, pbc, influence_dist, cutoffs, need_neigh
+    )
+    neigh = nl.create()
+    ghosts = neigh.build_periodic(
+        coords, cell, pbc, influence_dist, cutoffs, need_neigh, bin_size_factor=0.4
+    )
+    ref_coords = np.concatenate((coords, ref_ghosts[0]))
+    all_coords = np.concatenate((coords, ghosts[0]))
+    for k in range(len(cutoffs)):
+        for i in range(natoms):
+            _, ref_neighbors = ref.get_neigh(cutoffs, k, i)
+            _, neighbors = neigh.get_neigh(cutoffs, k, i)
+            expected = sorted(map(tuple, np.round(ref_coords[ref_neighbors], 8)))
+            got = sorted(map(tuple, np.round(all_coords[neighbors], 8)))
+            assert got == expected
+
+    for factor in [0.0, 1.5]:
+        with pytest.raises(RuntimeError):
+            neigh.build(
+                coords, influence_dist, cutoffs, need_neigh, bin_size_factor=factor
+            )
+
+
+def test_engines_agree():
+
+    # coordinates on a grid of 1/8, so that distances are exact: pairs lie
+    # exactly at a cutoff, and particles exactly on bin edges
+    crystal = np.array(np.meshgrid(*[np.arange(8.0) / 2.0] * 3)).reshape(3, -1).T
+
+    rng = np.random.default_rng(3)
+    cloud = np.round(rng.random((150, 3)) * 12.0 * 8.0) / 8.0
+    cloud = np.concatenate((cloud, cloud[:20] + [3.5, 0.0, 0.0]))
+    cloud = np.concatenate((cloud, cloud[20:40] + [0.0, 0.0, -2.0]))
+    cloud = np.unique(cloud, axis=0)
+
+    cutoffs = np.array([2.0, 3.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+
+    for coords in [crystal, cloud]:
+        coords = np.ascontiguousarray(coords, dtype=np.double)
+        natoms = coords.shape[0]
+        need_neigh = np.ones(natoms, dtype=np.intc)
+
+        # brute force reference
+        rsq = ((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(rsq, np.inf)
+        ref_neigh = [
+            list(np.nonzero(rsq[i] < cut * cut)[0])
+            for cut in cutoffs
+            for i in range(natoms)
+        ]
+        assert np.any(rsq == cutoffs[0] ** 2) and np.any(rsq == cutoffs[1] ** 2)
+
+        for engine, factor in [
+            ("dense", 1.0),
+            ("dense", 0.5),
+            ("sparse", 1.0),
+            ("sparse", 0.5),
+            ("brute", 1.0),
+        ]:
+            neigh = nl.create()
+            neigh.build(
+                coords,
+                influence_dist,
+                cutoffs,
+                need_neigh,
+                engine=engine,
+                bin_size_factor=factor,
+            )
+            assert get_neigh_sets(neigh, cutoffs, natoms) == ref_neigh
+
+
+def test_species_cutoffs():
+
+    coords = create_random_config(natoms=300)
+    natoms = coords.shape[0]
+    cutoffs = np.array([2.0, 4.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+    rng = np.random.default_rng(2)
+    species = rng.integers(0, 2, natoms).astype(np.intc)
+    species_cutoffs = np.array([[1.5, 3.0], [3.0, 4.5]])
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, need_neigh)
+    ref_neigh = get_neigh_sets(ref, cutoffs, natoms)
+
+    neigh = nl.create()
+    neigh.build(
+        coords,
+        influence_dist,
+        cutoffs,
+        need_neigh,
+        species=species,
+        species_cutoffs=species_cutoffs,
+    )
+    all_neigh = get_neigh_sets(neigh, cutoffs, natoms)
+    for k in range(len(cutoffs)):
+        for i in range(natoms):
+            m = k * natoms + i
+            expected = [
+                j
+                for j in ref_neigh[m]
+                if np.linalg.norm(coords[i] - coords[j])
+                < species_cutoffs[species[i], species[j]]
+            ]
+            assert all_neigh[m] == expected
+
+    for kwargs in [
+        dict(species=species),
+        dict(species_cutoffs=species_cutoffs),
+        dict(species=species + 2, species_cutoffs=species_cutoffs),
+        dict(species=species, species_cutoffs=np.array([[1.0, 2.0], [3.0, 4.0]])),
+    ]:
+        with pytest.raises(RuntimeError):
+            neigh.build(coords, influence_dist, cutoffs, need_neigh, **kwargs)
+
+
+def test_build_subset():
+
+    coords = create_random_config(natoms=300)
+    natoms = coords.shape[0]
+    cutoffs = np.array([2.0, 4.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    subset = np.arange(5, natoms, 7, dtype=np.intc)
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, np.ones(natoms, dtype=np.intc))
+    ref_neigh = get_neigh_sets(ref, cutoffs, natoms)
+
+    neigh = nl.create()
+    neigh.build_subset(coords, influence_dist, cutoffs, subset, num_threads=2)
+    all_neigh = get_neigh_sets(neigh, cutoffs, natoms)
+    for k in range(len(cutoffs)):
+        number_of_neighbors, begin_index, neighbor_list = neigh.get_csr(k)
+        assert len(number_of_neighbors) == len(subset)
+        for r, i in enumerate(subset):
+            begin = begin_index[r]
+            neighbors = neighbor_list[begin : begin + number_of_neighbors[r]]
+            assert sorted(neighbors) == ref_neigh[k * natoms + i]
+        for i in range(natoms):
+            m = k * natoms + i
+            if i in subset:
+                assert all_neigh[m] == ref_neigh[m]
+            else:
+                assert all_neigh[m] == []
+
+    for subset in [[2, 1], [1, 1], [-1], [natoms]]:
+        with pytest.raises(RuntimeError):
+            neigh.build_subset(
+                coords, influence_dist, cutoffs, np.array(subset, dtype=np.intc)
+            )
+
+
+def test_tile_size():
+
+    coords = create_random_config(natoms=300)
+    natoms = coords.shape[0]
+    cutoffs = np.array([2.0, 4.5], dtype=np.double)
+    influence_dist = cutoffs[1]
+    need_neigh = np.ones(natoms, dtype=np.intc)
+
+    ref = nl.create()
+    ref.build(coords, influence_dist, cutoffs, need_neigh)
+    ref_neigh = get_all_neigh(ref, cutoffs, natoms)
+
+    neigh = nl.create()
+    neigh.build(coords, influence_dist, cutoffs, need_neigh, tile_size=64)
+    number_of_neighbors, _, _ = neigh.get_csr(0)
+    assert len(number_of_neighbors) == 64
+
+    # get_neigh builds the tile of a particle when it is needed, and the
+    # neighbors of the tiles built before stay valid
+    first = neigh.get_csr(1)
+    assert get_all_neigh(neigh, cutoffs, natoms) == ref_neigh
+    assert np.array_equal(first[0], neigh.get_csr(1)[0])
+    for tile in [1, 0, 4, 2, 3]:
+        neigh.build_tile(tile)
+        number_of_neighbors, _, _ = neigh.get_csr(0)
+        assert len(number_of_neighbors) == min(64, natoms - 64 * tile)
+    with pytest.raises(RuntimeError):
+        neigh.build_tile(5)
+
+    # shrinking keeps what the next tiles are built from
+    neigh.build(coords, influence_dist, cutoffs, need_neigh, tile_size=64)
+    neigh.shrink()
+    neigh.build_tile(1)
+    _, neighbors = neigh.get_neigh(cutoffs, 1, 100)
+    assert list(neighbors) == ref_neigh[natoms + 100]
+
+    for k in range(len(cutoffs)):
+        tiles = list(neigh.iter_tiles(k))
+        assert [(begin, end) for begin, end, _ in tiles] == [
+            (0, 64),
+            (64, 128),
+            (128, 192),
+            (192, 256),
+            (256, 300),
+        ]
+        for begin, end, csr in tiles:
+            number_of_neighbors, begin_index, neighbor_list = csr
+            for r in range(end - begin):
+                b = begin_index[r]
+                neighbors = neighbor_list[b : b + number_of_neighbors[r]]
+                assert list(neighbors) == ref_neigh[k * natoms + begin + r]
+
+    # a rebuild during the iteration is detected
+    tiles = neigh.iter_tiles(0)
+    next(tiles)
+    neigh.build(coords, influence_dist, cutoffs, need_neigh, tile_size=64)
+    with pytest.raises(RuntimeError):
+        next(tiles)
+
+    # the tiles can be stored in a file
+    with tempfile.TemporaryDirectory() as directory:
+        neigh.build(
+            coords,
+            influence_dist,
+            cutoffs,
+            need_neigh,
+            tile_size=64,
+            tile_directory=directory,
+        )
+        assert get_all_neigh(neigh, cutoffs, natoms) == ref_neigh
+    assert get_all_neigh(neigh, cutoffs, natoms) == ref_neigh
+
+    neigh.build(coords, influence_dist, cutoffs, need_neigh)
+    with pytest.raises(RuntimeError):
+        neigh.iter_tiles(0)
+
+
+if __name__ == "__main__":
+    test_num_threads()
+    test_build_periodic()
+    test_build_periodic_small_cell()
+    test_skin()
+    test_get_csr()
+    test_max_list_size()
+    test_half()
+    test_reuse_memory()
+    test_spatial_order()
+    test_shared_storage()
+    test_store_distances()
+    test_engine()
+    test_create_paddings()
+    test_refresh_paddings()
+    test_build_padded()
+    test_fold_paddings()
+    test_build_batch()
+    test_move_particle()
+    test_hints()
+    test_bin_size_factor()
+    test_engines_agree()
+    test_species_cutoffs()
+    test_build_subset()
+    test_tile_size()